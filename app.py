@@ -2,25 +2,218 @@ import streamlit as st
 import streamlit.components.v1 as components
 import re
 from dotenv import load_dotenv
-import markdown
 import time
+import os
+import json
 
-from utils.llm_logic import BusinessAnalystAI, process_uploaded_file
-from utils.confluence import publish_to_confluence, get_space_pages
-from utils.export import create_docx, create_chat_pdf
-
+# .env читается до импорта utils: модули берут настройки FORTE_* при загрузке
 load_dotenv()
 
-FORTE_LOGO_URL = "https://upload.wikimedia.org/wikipedia/commons/e/e3/Fortebank_Logo.png"
+from utils.llm_logic import BusinessAnalystAI, process_uploaded_file, make_message, classify_message, \
+    invalidate_sessions_cache, FILE_MESSAGE_MARKER, FILE_PREVIEW_CHARS  # noqa: E402
+from utils.confluence import publish_document, get_space_pages, prefetch_space_pages, \
+    PAGES_LOADING  # noqa: E402
+from utils.assets import get_asset, FORTE_LOGO_URL  # noqa: E402
+from utils.export import create_docx, create_chat_pdf, chat_digest  # noqa: E402
+from utils.audio import audio_digest  # noqa: E402
+from utils.jobs import submit_job, get_job, find_job, JobQueueFull  # noqa: E402
+from utils import telemetry  # noqa: E402
+from utils.http_client import get_http_stats  # noqa: E402
+from utils.llm_client import get_route_stats  # noqa: E402
+from utils.llm_cache import get_cache_stats  # noqa: E402
+from utils.context_cache import get_context_cache_stats  # noqa: E402
+
+# Начало прохода скрипта: длительность rerun регистрируется в самом конце
+RERUN_STARTED_AT = time.perf_counter()
+
+# Сколько последних сообщений чата отрисовывается за раз
+CHAT_WINDOW = 30
+
+# Каталог Confluence загружается в фоне при старте, чтобы экспорт не ждал сеть
+prefetch_space_pages()
+
+
+def logged_in_email():
+    try:
+        if st.user.is_logged_in:
+            return st.user.email
+    except Exception:
+        pass
+    return None
+
+
+def current_user_id():
+    """Владелец сессий: email вошедшего пользователя, иначе FORTE_USER_ID (None — общий каталог)"""
+    return logged_in_email() or os.getenv("FORTE_USER_ID") or None
+
+
+def is_admin():
+    """Панель диагностики видна только вошедшим пользователям из FORTE_ADMIN_USERS.
+    FORTE_USER_ID сюда не подставляется: в однопользовательском развертывании под ним работают все.
+    "*" — явное разрешение всем, только для локального запуска"""
+    admins = [a.strip() for a in os.getenv("FORTE_ADMIN_USERS", "").split(",") if a.strip()]
+    if "*" in admins:
+        return True
+    email = logged_in_email()
+    return email is not None and email in admins
+
+
+def show_diagnostics_panel():
+    with st.expander("📈 Диагностика задержек"):
+        latency = telemetry.get_latency_stats()
+        if latency:
+            st.dataframe([
+                {"операция": name, "n": s["count"], "ошибки": s["errors"],
+                 "p50, мс": round(s["p50"] * 1000), "p95, мс": round(s["p95"] * 1000),
+                 "p99, мс": round(s["p99"] * 1000), "max, мс": round(s["max"] * 1000)}
+                for name, s in latency.items()
+            ], hide_index=True, use_container_width=True)
+        else:
+            st.caption("Замеров пока нет")
+
+        bot = st.session_state.get("analyst_bot")
+        if bot is not None and bot.turn_metrics:
+            last = bot.turn_metrics[-1]
+            st.caption(f"Последний ход: первый токен {last['ttft']:.2f} c, всего {last['total']:.2f} c")
+
+        cache = get_cache_stats()
+        st.caption(f"Кэш LLM: попаданий {cache['hits']}, промахов {cache['misses']} ({cache['hit_rate']:.0%})")
+        with st.popover("Маршруты и HTTP"):
+            st.json({"routes": get_route_stats(), "http": get_http_stats(),
+                     "context_cache": get_context_cache_stats()})
+
+        st.download_button(
+            "⬇️ Спаны (OTLP JSON)",
+            data=json.dumps(telemetry.export_otel_json(), ensure_ascii=False),
+            file_name="forte_spans.json",
+            mime="application/json",
+            use_container_width=True
+        )
+
+
+def load_sessions(bot, search, pages=1):
+    """Первые pages страниц каталога сессий: (сессии, курсор следующей страницы или None).
+    Запрашивается на каждом проходе скрипта — новые и переименованные сессии видны сразу,
+    а повторные запросы отдает TTL-кэш get_user_sessions, который сбрасывается при каждой записи"""
+    sessions, cursor = [], None
+    for _ in range(pages):
+        page, cursor = bot.get_user_sessions(search=search or None, cursor=cursor)
+        sessions += page
+        if not cursor:
+            break
+    return sessions, cursor
+
+
+def message_view(msg):
+    """Параметры отрисовки сообщения (роль, аватар, текст, подпись ли это); считаются один раз на ID.
+    Сам Markdown кэшировать негде: st.markdown передает исходный текст, а разметку строит браузер.
+    Поэтому на сервере запоминается только классификация, а объем отрисовки ограничивает окно CHAT_WINDOW"""
+    views = st.session_state.setdefault("message_views", {})
+    classify_message(msg)
+    view = views.get(msg["id"])
+    if view is None:
+        if msg["kind"] == "file":
+            view = ("user", "📎", f"Загружен файл: {msg['file_name']}", True)
+        else:
+            view = (msg["role"], "🏦" if msg["role"] == "assistant" else "👤", msg["content"], False)
+        views[msg["id"]] = view
+    return view
+
+
+def reset_chat_view():
+    """При смене сессии сбрасываем окно чата и представления сообщений прошлой сессии"""
+    st.session_state.pop("message_views", None)
+    st.session_state.chat_window = CHAT_WINDOW
+
+
+def render_mermaid(code: str):
+    html_code = f"""
+    <div class="mermaid" style="display: flex; justify-content: center; margin-top: 20px; margin-bottom: 20px;">
+        {code}
+    </div>
+    <script type="module">
+        import mermaid from 'https://cdn.jsdelivr.net/npm/mermaid@10/dist/mermaid.esm.min.mjs';
+        mermaid.initialize({{ 
+            startOnLoad: true, 
+            theme: 'base', 
+            themeVariables: {{ 
+                primaryColor: '#FEEFF2', 
+                primaryBorderColor: '#9F2349', 
+                lineColor: '#555',
+                edgeLabelBackground: '#fff', 
+                tertiaryColor: '#fff' 
+            }} 
+        }});
+    </script>
+    """
+    components.html(html_code, height=600, scrolling=True)
+
+
+def display_document_with_diagrams(text: str):
+    pattern = r"```mermaid\n(.*?)\n```"
+    parts = re.split(pattern, text, flags=re.DOTALL)
+    for i, part in enumerate(parts):
+        if i % 2 == 0:
+            if part.strip():
+                st.markdown(part)
+        else:
+            st.caption("👇 *Схема бизнес-процесса*")
+            render_mermaid(part)
+
+
+def find_active_job(session_id):
+    job = find_job(session_id, "brd")
+    if job and job["status"] in ("queued", "running"):
+        return job["id"]
+    return None
+
+
+@st.fragment(run_every=2)
+def show_brd_job_progress(job_id):
+    job = get_job(job_id)
+    if job and job["status"] in ("queued", "running"):
+        with st.status("🧠 Forte AI работает...", expanded=True):
+            if job["status"] == "queued":
+                st.write("⏳ Задача в очереди...")
+            for text in job["progress"]:
+                st.write(text)
+        return
+
+    st.session_state.brd_job_id = None
+    if job and job["status"] == "done":
+        st.session_state.final_doc = job["result"]
+        st.toast("✅ Документ успешно сформирован!")
+    elif job:
+        st.session_state.brd_job_error = job["error"]
+    st.rerun()
+
+
+def handle_user_input(user_text):
+    if "analyst_bot" in st.session_state:
+        st.session_state.messages.append(make_message("user", user_text))
+
+        if hasattr(st.session_state.analyst_bot, 'save_message_to_db'):
+            # Сообщение пользователя уйдет в базу одним запросом вместе с ответом ассистента
+            st.session_state.analyst_bot.save_message_to_db("user", user_text, flush=False)
+
+        with st.chat_message("user", avatar="👤"):
+            st.markdown(user_text)
+
+        with st.chat_message("assistant", avatar="🏦"):
+            response = st.write_stream(st.session_state.analyst_bot.stream_response(st.session_state.messages))
+
+        st.session_state.messages.append(make_message("assistant", response))
 
-st.set_page_config(
-    page_title="Forte AI Analyst",
-    page_icon="🏦",
-    layout="wide",
-    initial_sidebar_state="expanded"
-)
 
-st.markdown(f"""
+def main():
+    st.set_page_config(
+        page_title="Forte AI Analyst",
+        page_icon="🏦",
+        layout="wide",
+        initial_sidebar_state="expanded"
+    )
+
+    st.markdown(f"""
 <style>
     /* Основной фон */
     .stApp {{
@@ -117,317 +310,350 @@ st.markdown(f"""
 </style>
 """, unsafe_allow_html=True)
 
+    with st.sidebar:
+        st.image(get_asset("forte_logo.png") or FORTE_LOGO_URL, width=180)
+        st.markdown("<br>", unsafe_allow_html=True)
 
-def render_mermaid(code: str):
-    html_code = f"""
-    <div class="mermaid" style="display: flex; justify-content: center; margin-top: 20px; margin-bottom: 20px;">
-        {code}
-    </div>
-    <script type="module">
-        import mermaid from 'https://cdn.jsdelivr.net/npm/mermaid@10/dist/mermaid.esm.min.mjs';
-        mermaid.initialize({{ 
-            startOnLoad: true, 
-            theme: 'base', 
-            themeVariables: {{ 
-                primaryColor: '#FEEFF2', 
-                primaryBorderColor: '#9F2349', 
-                lineColor: '#555',
-                edgeLabelBackground: '#fff', 
-                tertiaryColor: '#fff' 
-            }} 
-        }});
-    </script>
-    """
-    components.html(html_code, height=600, scrolling=True)
-
-
-def display_document_with_diagrams(text: str):
-    pattern = r"```mermaid\n(.*?)\n```"
-    parts = re.split(pattern, text, flags=re.DOTALL)
-    for i, part in enumerate(parts):
-        if i % 2 == 0:
-            if part.strip():
-                st.markdown(part)
-        else:
-            st.caption("👇 *Схема бизнес-процесса*")
-            render_mermaid(part)
-
-
-def handle_user_input(user_text):
-    if "analyst_bot" in st.session_state:
-        st.session_state.messages.append({"role": "user", "content": user_text})
+        st.subheader("⚙️ Настройки задачи")
 
-        if hasattr(st.session_state.analyst_bot, 'save_message_to_db'):
-            st.session_state.analyst_bot.save_message_to_db("user", user_text)
+        mode_options = ["Новый продукт (MVP)", "Интеграция API", "Отчетность и Аналитика"]
+        selected_mode = st.selectbox("Режим работы AI:", mode_options, index=0)
 
-        with st.chat_message("user", avatar="👤"):
-            st.markdown(user_text)
+    if "current_mode" not in st.session_state:
+        st.session_state.current_mode = selected_mode
 
-        with st.chat_message("assistant", avatar="🏦"):
-            with st.spinner("Forte AI думает..."):
-                response = st.session_state.analyst_bot.get_response(st.session_state.messages)
-                st.markdown(response)
+    if st.session_state.current_mode != selected_mode:
+        st.session_state.current_mode = selected_mode
+        st.session_state.analyst_bot = BusinessAnalystAI(template_type=selected_mode, user_id=current_user_id())
 
-        st.session_state.messages.append({"role": "assistant", "content": response})
-
-with st.sidebar:
-    st.image(FORTE_LOGO_URL, width=180)
-    st.markdown("<br>", unsafe_allow_html=True)
-
-    st.subheader("⚙️ Настройки задачи")
-
-    mode_options = ["Новый продукт (MVP)", "Интеграция API", "Отчетность и Аналитика"]
-    selected_mode = st.selectbox("Режим работы AI:", mode_options, index=0)
+        st.session_state.messages = [
+            make_message("assistant", f"Режим переключен на **{selected_mode}**. Готов к работе!")]
+        st.session_state.final_doc = None
+        st.session_state.brd_job_id = None
+        st.session_state.uploaded_files_cache = []
+        reset_chat_view()
+        st.rerun()
 
-if "current_mode" not in st.session_state:
-    st.session_state.current_mode = selected_mode
+    if "analyst_bot" not in st.session_state:
+        try:
+            # ID сессии хранится в URL, чтобы после обновления страницы вернуться к тому же чату
+            try:
+                st.session_state.analyst_bot = BusinessAnalystAI(template_type=selected_mode,
+                                                                 session_id=st.query_params.get("session"),
+                                                                 user_id=current_user_id())
+            except PermissionError as e:
+                # Ссылка на чужую сессию — открываем новый чат, чужую историю не показываем
+                st.warning(f"⚠️ {e}. Открыт новый чат.")
+                st.session_state.analyst_bot = BusinessAnalystAI(template_type=selected_mode, user_id=current_user_id())
+        except Exception as e:
+            st.error(f"Ошибка: {e}. Проверьте .env")
+
+    if "analyst_bot" in st.session_state and st.query_params.get("session") != st.session_state.analyst_bot.session_id:
+        st.query_params["session"] = st.session_state.analyst_bot.session_id
+
+    if "messages" not in st.session_state:
+        db_history = []
+        if hasattr(st.session_state.analyst_bot, 'load_history_from_db'):
+            db_history = st.session_state.analyst_bot.load_history_from_db()
+
+        if db_history:
+            st.session_state.messages = db_history
+            st.toast("📜 История чата восстановлена из облака!")
+        else:
+            st.session_state.messages = [
+                make_message("assistant",
+                             "Привет! Я **Forte AI Analyst**. \nВы можете писать текстом, использовать **голосовой ввод** или загружать документы.")
+            ]
 
-if st.session_state.current_mode != selected_mode:
-    st.session_state.current_mode = selected_mode
-    st.session_state.analyst_bot = BusinessAnalystAI(template_type=selected_mode)
+    if "final_doc" not in st.session_state:
+        st.session_state.final_doc = None
+        if hasattr(st.session_state.analyst_bot, 'load_document_from_db'):
+            st.session_state.final_doc = st.session_state.analyst_bot.load_document_from_db()
 
-    st.session_state.messages = [
-        {"role": "assistant", "content": f"Режим переключен на **{selected_mode}**. Готов к работе!"}]
-    st.session_state.final_doc = None
-    st.session_state.uploaded_files_cache = []
-    st.rerun()
+    if "brd_job_id" not in st.session_state:
+        # После переподключения подхватываем генерацию, которая еще идет в фоне
+        st.session_state.brd_job_id = None
+        if "analyst_bot" in st.session_state:
+            st.session_state.brd_job_id = find_active_job(st.session_state.analyst_bot.session_id)
 
-if "analyst_bot" not in st.session_state:
-    try:
-        st.session_state.analyst_bot = BusinessAnalystAI(template_type=selected_mode)
-    except Exception as e:
-        st.error(f"Ошибка: {e}. Проверьте .env")
-
-if "messages" not in st.session_state:
-    db_history = []
-    if hasattr(st.session_state.analyst_bot, 'load_history_from_db'):
-        db_history = st.session_state.analyst_bot.load_history_from_db()
-
-    if db_history:
-        st.session_state.messages = db_history
-        st.toast("📜 История чата восстановлена из облака!")
-    else:
-        st.session_state.messages = [
-            {"role": "assistant",
-             "content": "Привет! Я **Forte AI Analyst**. \nВы можете писать текстом, использовать **голосовой ввод** или загружать документы."}
-        ]
+    with st.sidebar:
+        st.markdown("---")
 
-if "final_doc" not in st.session_state:
-    st.session_state.final_doc = None
+        if hasattr(st.session_state.analyst_bot, 'get_user_sessions'):
+            st.subheader("🗄️ История чатов")
 
-with st.sidebar:
-    st.markdown("---")
+            bot = st.session_state.analyst_bot
+            search = st.text_input("Поиск по названию", key="history_search_input").strip()
 
-    if hasattr(st.session_state.analyst_bot, 'get_user_sessions'):
-        st.subheader("🗄️ История чатов")
+            if st.session_state.get("history_search") != search:
+                st.session_state.history_search = search
+                st.session_state.history_pages = 1
 
-        if "history_sessions" not in st.session_state:
-            st.session_state.history_sessions = st.session_state.analyst_bot.get_user_sessions()
+            if st.button("🔄 Обновить список"):
+                invalidate_sessions_cache(bot.user_id)
+                st.rerun()
 
-        if st.button("🔄 Обновить список"):
-            st.session_state.history_sessions = st.session_state.analyst_bot.get_user_sessions()
+            history_sessions, history_cursor = load_sessions(bot, search, st.session_state.history_pages)
+            for s in history_sessions:
+                title = s.get('title') or s.get('created_at', 'Без названия')[:16]
+                if st.button(f"📄 {title}", key=s['id'], use_container_width=True):
+                    st.session_state.analyst_bot = BusinessAnalystAI(template_type=selected_mode, session_id=s['id'],
+                                                                     user_id=current_user_id())
+                    history = st.session_state.analyst_bot.load_history_from_db()
+                    if history:
+                        st.session_state.messages = history
+                        st.session_state.final_doc = st.session_state.analyst_bot.load_document_from_db()
+                        st.session_state.brd_job_id = find_active_job(st.session_state.analyst_bot.session_id)
+                        reset_chat_view()
+                        st.toast(f"Загружен чат: {title}")
+                        time.sleep(0.5)
+                        st.rerun()
+
+            if history_cursor and st.button("⬇️ Показать еще", use_container_width=True):
+                st.session_state.history_pages += 1
+                st.rerun()
+            st.markdown("---")
+
+        if st.button("🆕 Новый чат", use_container_width=True):
+            st.session_state.analyst_bot = BusinessAnalystAI(template_type=selected_mode, user_id=current_user_id())
+            st.session_state.messages = [make_message("assistant", "Начнем с чистого листа. Опишите новую задачу.")]
+            st.session_state.final_doc = None
+            st.session_state.brd_job_id = None
+            st.session_state.uploaded_files_cache = []
+            reset_chat_view()
             st.rerun()
 
-        for s in st.session_state.history_sessions:
-            title = s.get('title') or s.get('created_at', 'Без названия')[:16]
-            if st.button(f"📄 {title}", key=s['id'], use_container_width=True):
-                st.session_state.analyst_bot = BusinessAnalystAI(template_type=selected_mode, session_id=s['id'])
-                history = st.session_state.analyst_bot.load_history_from_db()
-                if history:
-                    st.session_state.messages = history
-                    st.session_state.final_doc = None
-                    st.toast(f"Загружен чат: {title}")
-                    time.sleep(0.5)
-                    st.rerun()
         st.markdown("---")
+        st.subheader("Действия")
+
+        audio_value = st.audio_input("Микрофон")
+
+        st.markdown("<div style='height: 10px'></div>", unsafe_allow_html=True)
+        with st.expander("📂 Документы"):
+            uploaded_file = st.file_uploader("Загрузить PDF/DOCX", type=["pdf", "docx", "txt", "md"])
+
+        if "uploaded_files_cache" not in st.session_state:
+            st.session_state.uploaded_files_cache = []
+
+        if uploaded_file is not None:
+            if uploaded_file.name not in st.session_state.uploaded_files_cache:
+                with st.spinner("Читаю документ..."):
+                    file_text = process_uploaded_file(uploaded_file)
+                    if not file_text.startswith("Ошибка чтения файла"):
+                        # Полный текст уходит в индекс и хранилище сессии, в чат — только начало документа
+                        chunk_count = st.session_state.analyst_bot.add_document(uploaded_file.name, file_text)
+                        context_msg = (
+                            f"📎 [{FILE_MESSAGE_MARKER} '{uploaded_file.name}']\n\n"
+                            f"Документ проиндексирован: {len(file_text)} символов, {chunk_count} фрагментов. "
+                            f"Релевантные фрагменты подставляются в контекст автоматически.\n\n"
+                            f"НАЧАЛО ДОКУМЕНТА:\n{file_text[:FILE_PREVIEW_CHARS]}..."
+                        )
+
+                        st.session_state.messages.append(make_message("user", context_msg))
+                        if hasattr(st.session_state.analyst_bot, 'save_message_to_db'):
+                            st.session_state.analyst_bot.save_message_to_db("user", context_msg, flush=False)
+
+                        ai_confirm = f"📂 Я изучил документ **{uploaded_file.name}**. Буду учитывать его при сборе требований."
+                        st.session_state.messages.append(make_message("assistant", ai_confirm))
+                        if hasattr(st.session_state.analyst_bot, 'save_message_to_db'):
+                            st.session_state.analyst_bot.save_message_to_db("assistant", ai_confirm)
+
+                        st.session_state.uploaded_files_cache.append(uploaded_file.name)
+                        st.toast(f"Файл {uploaded_file.name} обработан!")
+                        st.rerun()
+                    else:
+                        st.error(file_text)
 
-    if st.button("🆕 Новый чат", use_container_width=True):
-        st.session_state.analyst_bot = BusinessAnalystAI(template_type=selected_mode)
-        st.session_state.messages = [{"role": "assistant", "content": "Начнем с чистого листа. Опишите новую задачу."}]
-        st.session_state.final_doc = None
-        st.session_state.uploaded_files_cache = []
-        st.rerun()
+        st.markdown("---")
 
-    st.markdown("---")
-    st.subheader("Действия")
+        if st.button("📑 Сформировать ТЗ (BRD)", type="primary", use_container_width=True,
+                     disabled=bool(st.session_state.brd_job_id)):
+            if "analyst_bot" in st.session_state:
+                bot = st.session_state.analyst_bot
+                try:
+                    st.session_state.brd_job_id = submit_job(
+                        bot.session_id, "brd",
+                        bot.generate_requirements_doc, list(st.session_state.messages),
+                        on_done=bot.save_document_to_db
+                    )
+                except JobQueueFull as e:
+                    st.error(str(e))
+
+        if st.session_state.brd_job_id:
+            show_brd_job_progress(st.session_state.brd_job_id)
+
+        if st.session_state.get("brd_job_error"):
+            st.error(f"Ошибка генерации документа: {st.session_state.pop('brd_job_error')}")
+
+        if len(st.session_state.messages) > 1:
+            # PDF собирается только по запросу и только для текущей версии переписки
+            chat_key = chat_digest(st.session_state.messages)
+            if st.session_state.get("chat_pdf_key") != chat_key:
+                if st.button("📄 Подготовить историю чата (PDF)", use_container_width=True):
+                    st.session_state.chat_pdf_key = chat_key
+
+            if st.session_state.get("chat_pdf_key") == chat_key:
+                with st.spinner("Формирую PDF..."):
+                    chat_pdf = create_chat_pdf(st.session_state.messages)
+                if chat_pdf:
+                    st.download_button(
+                        label="📥 Скачать историю чата (PDF)",
+                        data=chat_pdf,
+                        file_name="Chat_History.pdf",
+                        mime="application/pdf",
+                        use_container_width=True,
+                        help="Скачать полный протокол переписки"
+                    )
+
+        if is_admin():
+            st.markdown("---")
+            show_diagnostics_panel()
 
-    audio_value = st.audio_input("Микрофон")
+        st.markdown("---")
+        st.caption(f"Version 3.1 | Supabase & ReportLab")
 
-    st.markdown("<div style='height: 10px'></div>", unsafe_allow_html=True)
-    with st.expander("📂 Документы"):
-        uploaded_file = st.file_uploader("Загрузить PDF/DOCX", type=["pdf", "docx", "txt", "md"])
+    col1, col2 = st.columns([0.8, 10])
+    with col2:
+        st.markdown(f"# Forte <span class='highlight-red'>AI Analyst</span>", unsafe_allow_html=True)
+        st.caption(f"Automated Business Requirements System | Mode: **{selected_mode}**")
 
-    if "uploaded_files_cache" not in st.session_state:
-        st.session_state.uploaded_files_cache = []
-
-    if uploaded_file is not None:
-        if uploaded_file.name not in st.session_state.uploaded_files_cache:
-            with st.spinner("Читаю документ..."):
-                file_text = process_uploaded_file(uploaded_file)
-                if "Ошибка" not in file_text:
-                    context_msg = f"📎 [СИСТЕМА: ПОЛЬЗОВАТЕЛЬ ЗАГРУЗИЛ ФАЙЛ '{uploaded_file.name}']\n\nСОДЕРЖАНИЕ:\n{file_text[:50000]}..."
+    st.markdown("<br>", unsafe_allow_html=True)
 
-                    st.session_state.messages.append({"role": "user", "content": context_msg})
-                    if hasattr(st.session_state.analyst_bot, 'save_message_to_db'):
-                        st.session_state.analyst_bot.save_message_to_db("user", context_msg)
+    if "chat_window" not in st.session_state:
+        st.session_state.chat_window = CHAT_WINDOW
 
-                    ai_confirm = f"📂 Я изучил документ **{uploaded_file.name}**. Буду учитывать его при сборе требований."
-                    st.session_state.messages.append({"role": "assistant", "content": ai_confirm})
-                    if hasattr(st.session_state.analyst_bot, 'save_message_to_db'):
-                        st.session_state.analyst_bot.save_message_to_db("assistant", ai_confirm)
+    chat_container = st.container()
+    with chat_container:
+        # Отрисовываем только последние сообщения; более ранние — по кнопке
+        hidden_count = max(0, len(st.session_state.messages) - st.session_state.chat_window)
+        if hidden_count:
+            if st.button(f"⬆️ Показать более ранние сообщения ({hidden_count})"):
+                st.session_state.chat_window += CHAT_WINDOW
+                st.rerun()
 
-                    st.session_state.uploaded_files_cache.append(uploaded_file.name)
-                    st.toast(f"Файл {uploaded_file.name} обработан!")
-                    st.rerun()
+        for msg in st.session_state.messages[hidden_count:]:
+            role, avatar, body, is_caption = message_view(msg)
+            with st.chat_message(role, avatar=avatar):
+                if is_caption:
+                    st.caption(body)
                 else:
-                    st.error(file_text)
-
-    st.markdown("---")
-
-    if st.button("📑 Сформировать ТЗ (BRD)", type="primary", use_container_width=True):
-        if "analyst_bot" in st.session_state:
-            with st.status("🧠 Forte AI работает...", expanded=True) as status:
-                def update_status_label(text):
-                    st.write(text)
-
-
-                doc = st.session_state.analyst_bot.generate_requirements_doc(
-                    st.session_state.messages,
-                    on_status_update=update_status_label
-                )
-                status.update(label="✅ Документ успешно сформирован!", state="complete", expanded=False)
-            st.session_state.final_doc = doc
+                    st.markdown(body)
+
+    st.markdown("###### Быстрые ответы:")
+    suggestions = ["✅ Да, все верно", "🔒 Добавь про безопасность", "❌ Нет, нужно исправить", "📱 Уточнить про мобайл"]
+    cols = st.columns(4)
+    for i, suggestion in enumerate(suggestions):
+        if cols[i].button(suggestion, use_container_width=True):
+            handle_user_input(suggestion)
             st.rerun()
 
-    if len(st.session_state.messages) > 1:
-        chat_pdf = create_chat_pdf(st.session_state.messages)
-        if chat_pdf:
-            st.download_button(
-                label="📥 Скачать историю чата (PDF)",
-                data=chat_pdf,
-                file_name="Chat_History.pdf",
-                mime="application/pdf",
-                use_container_width=True,
-                help="Скачать полный протокол переписки"
-            )
-
-    st.markdown("---")
-    st.caption(f"Version 3.1 | Supabase & ReportLab")
+    if audio_value:
+        if "analyst_bot" in st.session_state:
+            audio_bytes = audio_value.getvalue()
+            audio_hash = audio_digest(audio_bytes)
+            if "last_audio_hash" not in st.session_state or st.session_state.last_audio_hash != audio_hash:
+                with st.spinner("🎤 Слушаю и распознаю..."):
+                    transcribed_text = st.session_state.analyst_bot.transcribe_audio(audio_bytes)
+                    st.toast(f"Распознано: {transcribed_text[:50]}...")
+                    handle_user_input(transcribed_text)
+                    st.session_state.last_audio_hash = audio_hash
+                    st.rerun()
 
-col1, col2 = st.columns([0.8, 10])
-with col2:
-    st.markdown(f"# Forte <span class='highlight-red'>AI Analyst</span>", unsafe_allow_html=True)
-    st.caption(f"Automated Business Requirements System | Mode: **{selected_mode}**")
+    if prompt := st.chat_input("Опишите требования..."):
+        handle_user_input(prompt)
 
-st.markdown("<br>", unsafe_allow_html=True)
+    if st.session_state.final_doc:
+        st.divider()
+        st.success("✅ Документ готов! Проверьте содержимое перед отправкой.")
 
-chat_container = st.container()
-with chat_container:
-    for msg in st.session_state.messages:
-        if "СИСТЕМА: ПОЛЬЗОВАТЕЛЬ ЗАГРУЗИЛ ФАЙЛ" in msg["content"]:
-            with st.chat_message("user", avatar="📎"):
-                st.caption(f"Загружен файл: {msg['content'].split(']')[0].split('File ')[-1]}")
-        else:
-            with st.chat_message(msg["role"], avatar="🏦" if msg["role"] == "assistant" else "👤"):
-                st.markdown(msg["content"])
-
-st.markdown("###### Быстрые ответы:")
-suggestions = ["✅ Да, все верно", "🔒 Добавь про безопасность", "❌ Нет, нужно исправить", "📱 Уточнить про мобайл"]
-cols = st.columns(4)
-for i, suggestion in enumerate(suggestions):
-    if cols[i].button(suggestion, use_container_width=True):
-        handle_user_input(suggestion)
-        st.rerun()
+        tab_view, tab_edit = st.tabs(["👁️ Просмотр (Preview)", "✏️ Редактор (Source)"])
 
-if audio_value:
-    if "analyst_bot" in st.session_state:
-        audio_hash = hash(audio_value)
-        if "last_audio_hash" not in st.session_state or st.session_state.last_audio_hash != audio_hash:
-            with st.spinner("🎤 Слушаю и распознаю..."):
-                audio_bytes = audio_value.getvalue()
-                transcribed_text = st.session_state.analyst_bot.transcribe_audio(audio_bytes)
-                st.toast(f"Распознано: {transcribed_text[:50]}...")
-                handle_user_input(transcribed_text)
-                st.session_state.last_audio_hash = audio_hash
+        with tab_edit:
+            st.info("💡 Здесь вы можете вручную исправить текст.")
+            edited_text = st.text_area(
+                "Редактирование Markdown кода",
+                value=st.session_state.final_doc,
+                height=600,
+                label_visibility="collapsed"
+            )
+            if edited_text != st.session_state.final_doc:
+                st.session_state.final_doc = edited_text
                 st.rerun()
 
-if prompt := st.chat_input("Опишите требования..."):
-    handle_user_input(prompt)
-
-if st.session_state.final_doc:
-    st.divider()
-    st.success("✅ Документ готов! Проверьте содержимое перед отправкой.")
+        with tab_view:
+            display_document_with_diagrams(st.session_state.final_doc)
 
-    tab_view, tab_edit = st.tabs(["👁️ Просмотр (Preview)", "✏️ Редактор (Source)"])
+        st.divider()
 
-    with tab_edit:
-        st.info("💡 Здесь вы можете вручную исправить текст.")
-        edited_text = st.text_area(
-            "Редактирование Markdown кода",
-            value=st.session_state.final_doc,
-            height=600,
-            label_visibility="collapsed"
-        )
-        if edited_text != st.session_state.final_doc:
-            st.session_state.final_doc = edited_text
-            st.rerun()
+        st.write("### 📤 Экспорт и Публикация")
 
-    with tab_view:
-        display_document_with_diagrams(st.session_state.final_doc)
+        confluence_pages = get_space_pages()
 
-    st.divider()
+        col_word, col_conf_set = st.columns([2.5, 2.5])
 
-    st.write("### 📤 Экспорт и Публикация")
+        with col_word:
+            # Как и PDF переписки, Word собирается только по запросу и только для текущей версии документа
+            if st.session_state.get("docx_source") != st.session_state.final_doc:
+                if st.button("📝 Подготовить Word", use_container_width=True):
+                    st.session_state.docx_source = st.session_state.final_doc
 
-    if "confluence_pages" not in st.session_state:
-        with st.spinner("Подключаюсь к Confluence..."):
-            st.session_state.confluence_pages = get_space_pages()
-
-    col_word, col_conf_set = st.columns([2.5, 2.5])
-
-    with col_word:
-        docx_file = create_docx(st.session_state.final_doc)
-        st.download_button(
-            label="📝 Скачать Word",
-            data=docx_file,
-            file_name="Business_Requirements.docx",
-            mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-            use_container_width=True
-        )
-
-    with col_conf_set:
-        with st.container(border=True):
-            st.write("**Confluence Integration**")
-
-            page_options = list(st.session_state.confluence_pages.keys())
-            if page_options:
-                selected_parent_name = st.selectbox(
-                    "Родительская страница:",
-                    page_options,
-                    index=0,
-                    help="Выберите страницу, под которой будет создан этот документ"
+            if st.session_state.get("docx_source") == st.session_state.final_doc:
+                with st.spinner("Формирую Word..."):
+                    docx_file = create_docx(st.session_state.final_doc)
+                st.download_button(
+                    label="📝 Скачать Word",
+                    data=docx_file,
+                    file_name="Business_Requirements.docx",
+                    mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+                    use_container_width=True
                 )
-                selected_parent_id = st.session_state.confluence_pages[selected_parent_name]
-            else:
-                st.warning("Не удалось получить список страниц. Будет создано в корне.")
-                selected_parent_id = None
-
-            if st.button("🚀 Опубликовать в Confluence", type="primary", use_container_width=True):
-                html_body = markdown.markdown(st.session_state.final_doc)
-                title_candidate = "BRD - New Project"
-                try:
-                    match = re.search(r'^#\s+(.+)$', st.session_state.final_doc, re.MULTILINE)
-                    if match:
-                        title_candidate = match.group(1).strip()
+
+        with col_conf_set:
+            with st.container(border=True):
+                st.write("**Confluence Integration**")
+
+                page_options = list(confluence_pages.keys())
+                if page_options:
+                    selected_parent_name = st.selectbox(
+                        "Родительская страница:",
+                        page_options,
+                        index=0,
+                        help="Выберите страницу, под которой будет создан этот документ"
+                    )
+                    selected_parent_id = confluence_pages[selected_parent_name]
+                else:
+                    st.warning("Не удалось получить список страниц. Будет создано в корне.")
+                    selected_parent_id = None
+
+                pages_loading = PAGES_LOADING in confluence_pages
+                if pages_loading:
+                    st.caption("Публикация станет доступна, когда загрузится список страниц.")
+                if st.button("🚀 Опубликовать в Confluence", type="primary", use_container_width=True,
+                             disabled=pages_loading):
+                    title_candidate = "BRD - New Project"
+                    try:
+                        match = re.search(r'^#\s+(.+)$', st.session_state.final_doc, re.MULTILINE)
+                        if match:
+                            title_candidate = match.group(1).strip()
+                        else:
+                            title_candidate = f"BRD - {st.session_state.messages[-2]['content'][:30]}..."
+                    except:
+                        pass
+
+                    with st.spinner("Публикую в Confluence..."):
+                        msg = publish_document(title_candidate, st.session_state.final_doc, parent_id=selected_parent_id)
+
+                    if "✅" in msg:
+                        if "Изменений нет" not in msg:
+                            st.balloons()
+                        st.success(msg)
                     else:
-                        title_candidate = f"BRD - {st.session_state.messages[-2]['content'][:30]}..."
-                except:
-                    pass
+                        st.error(msg)
 
-                msg = publish_to_confluence(title_candidate, html_body, parent_id=selected_parent_id)
 
-                if "✅" in msg:
-                    st.balloons()
-                    st.success(msg)
-                else:
-                    st.error(msg)
\ No newline at end of file
+# Каждый проход скрипта, в том числе прерванный через st.rerun() или st.stop()
+try:
+    main()
+finally:
+    telemetry.record("streamlit.rerun", time.perf_counter() - RERUN_STARTED_AT,
+                     messages=len(st.session_state.get("messages", [])))
@@ -0,0 +1,233 @@
+"""Пакетная обработка сохраненных сессий без интерфейса: перегенерация BRD, экспорт и публикация.
+
+    python batch.py --since 2026-07-01 --until 2026-10-01 --export docx,pdf
+    python batch.py --session <id> --session <id> --regenerate --publish --parent 12345
+    python batch.py --since 2026-07-01 --regenerate --checkpoint .cache/batch/q3.jsonl   # продолжит с места остановки
+
+Сессии читаются через utils.storage (FORTE_STORAGE), вызовы модели ограничены --llm-concurrency,
+DOCX/PDF собираются в пуле процессов. Каждая завершенная сессия пишется в файл контрольных точек."""
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import threading
+import multiprocessing
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from utils import llm_client, telemetry  # noqa: E402
+from utils.storage import get_storage  # noqa: E402
+from utils.llm_logic import BusinessAnalystAI, classify_message, BRD_GENERATION_MODE  # noqa: E402
+
+DEFAULT_CHECKPOINT = os.path.join(os.getenv("FORTE_CACHE_DIR", ".cache"), "batch", "checkpoint.jsonl")
+DEFAULT_TEMPLATE = "Новый продукт (MVP)"
+
+
+def document_title(document, session):
+    match = re.search(r'^#\s+(.+)$', document, re.MULTILINE)
+    if match:
+        return match.group(1).strip()
+    if session.get("title"):
+        return f"BRD - {session['title']}"
+    return f"BRD - {session['id'][:8]}"
+
+
+def _file_stem(session_id, title):
+    slug = re.sub(r"[^\w\-]+", "_", title, flags=re.UNICODE).strip("_")[:60]
+    return f"{session_id[:8]}-{slug or 'brd'}"
+
+
+def render_files(document, formats, out_dir, stem):
+    """Выполняется в дочернем процессе: собирает DOCX/PDF и пишет их на диск"""
+    from utils.export import create_docx, create_pdf
+
+    builders = {"docx": create_docx, "pdf": create_pdf}
+    paths = []
+    os.makedirs(out_dir, exist_ok=True)
+    for fmt in formats:
+        path = os.path.join(out_dir, f"{stem}.{fmt}")
+        data = builders[fmt](document).getvalue()
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        paths.append(path)
+    return paths
+
+
+class Checkpoint:
+    """JSONL с результатами по сессиям; при повторном запуске успешные сессии пропускаются"""
+
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if record.get("status") == "done":
+                        self.done.add(record["session_id"])
+
+    def write(self, record):
+        with self._lock:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            if record["status"] == "done":
+                self.done.add(record["session_id"])
+
+
+def select_sessions(storage, args):
+    if args.session:
+        # Владелец нужен боту для проверки доступа; несуществующий ID обработается как пустая сессия
+        return [storage.get_session(session_id) or {"id": session_id, "title": None, "user_id": None}
+                for session_id in args.session]
+    sessions = storage.scan_sessions(updated_after=args.since, updated_before=args.until)
+    if args.user:
+        sessions = (s for s in sessions if s.get("user_id") == args.user)
+    return list(sessions)
+
+
+def process_session(session, args, storage, render_pool):
+    timings = {}
+    bot = BusinessAnalystAI(template_type=args.template, session_id=session["id"],
+                            user_id=session.get("user_id"), storage=storage)
+
+    started_at = time.perf_counter()
+    document = None if args.regenerate else bot.load_document_from_db()
+    generated = False
+    if document is None:
+        history = bot.load_history_from_db()
+        if not [m for m in history if m["role"] == "user" and classify_message(m)["kind"] == "text"]:
+            return {"status": "skipped", "reason": "нет сообщений пользователя"}, timings
+        document = bot.generate_requirements_doc(history, mode=args.mode, use_cache=not args.no_cache)
+        generated = True
+        # Несохраненный документ — ошибка: иначе контрольная точка навсегда пропустит сессию
+        if not args.dry_run and not bot.save_document_to_db(document):
+            timings["generate"] = time.perf_counter() - started_at
+            return {"status": "error", "error": f"не удалось сохранить документ ({storage.name})"}, timings
+    timings["generate" if generated else "load"] = time.perf_counter() - started_at
+
+    title = document_title(document, session)
+    result = {"status": "done", "title": title, "generated": generated}
+
+    if args.export:
+        started_at = time.perf_counter()
+        result["files"] = render_pool.submit(
+            render_files, document, args.export, args.out, _file_stem(session["id"], title)
+        ).result()
+        timings["render"] = time.perf_counter() - started_at
+
+    if args.publish:
+        from utils.confluence import publish_document
+        started_at = time.perf_counter()
+        message = publish_document(title, document, parent_id=args.parent)
+        timings["publish"] = time.perf_counter() - started_at
+        result["publish"] = message
+        if "✅" not in message:
+            result["status"] = "error"
+            result["error"] = message
+
+    return result, timings
+
+
+def print_summary(results, stage_times, elapsed):
+    counts = {}
+    for record in results:
+        counts[record["status"]] = counts.get(record["status"], 0) + 1
+    done = counts.get("done", 0)
+
+    print("\n=== Итог ===")
+    print(f"Сессий: {len(results)} | " + ", ".join(f"{status}: {n}" for status, n in sorted(counts.items())))
+    print(f"Время: {elapsed:.1f} c | пропускная способность: {done / elapsed * 60 if elapsed else 0:.1f} сессий/мин")
+    for stage, values in stage_times.items():
+        if values:
+            print(f"  {stage:<9} n={len(values):<4} среднее {sum(values) / len(values):6.2f} c   max {max(values):6.2f} c")
+    llm = telemetry.get_latency_stats().get("llm.invoke")
+    if llm:
+        print(f"  LLM-вызовы: {llm['count']}, p50 {llm['p50']:.2f} c, p95 {llm['p95']:.2f} c, ошибок {llm['errors']}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Пакетная обработка сессий Forte AI Analyst")
+    parser.add_argument("--session", action="append", help="ID сессии (можно несколько раз)")
+    parser.add_argument("--since", help="Сессии, обновленные начиная с даты (ISO, например 2026-07-01)")
+    parser.add_argument("--until", help="...и до даты (не включая)")
+    parser.add_argument("--user", help="Только сессии пользователя")
+    parser.add_argument("--limit", type=int, help="Обработать не больше N сессий")
+    parser.add_argument("--regenerate", action="store_true", help="Перегенерировать BRD, даже если он сохранен")
+    parser.add_argument("--mode", default=BRD_GENERATION_MODE, choices=["sections", "single"])
+    parser.add_argument("--template", default=DEFAULT_TEMPLATE, help="Режим работы AI для системного промпта")
+    parser.add_argument("--no-cache", action="store_true", help="Не использовать кэш ответов LLM")
+    parser.add_argument("--export", default="", help="Форматы через запятую: docx,pdf")
+    parser.add_argument("--out", default="exports", help="Каталог для файлов")
+    parser.add_argument("--publish", action="store_true", help="Опубликовать в Confluence (upsert)")
+    parser.add_argument("--parent", help="ID родительской страницы Confluence")
+    parser.add_argument("--workers", type=int, default=4, help="Сессий в работе одновременно")
+    parser.add_argument("--llm-concurrency", type=int, default=8, help="Одновременных запросов к модели")
+    parser.add_argument("--render-workers", type=int, default=os.cpu_count() or 2, help="Процессов для DOCX/PDF")
+    parser.add_argument("--checkpoint", default=DEFAULT_CHECKPOINT, help="Файл контрольных точек (JSONL)")
+    parser.add_argument("--restart", action="store_true", help="Игнорировать контрольные точки")
+    parser.add_argument("--dry-run", action="store_true", help="Не сохранять перегенерированные документы")
+    args = parser.parse_args(argv)
+
+    args.export = [fmt.strip() for fmt in args.export.split(",") if fmt.strip()]
+    unknown = set(args.export) - {"docx", "pdf"}
+    if unknown:
+        parser.error(f"неизвестные форматы: {', '.join(sorted(unknown))}")
+
+    storage = get_storage()
+    llm_client.set_max_concurrency(args.llm_concurrency)
+
+    checkpoint = Checkpoint(args.checkpoint)
+    sessions = select_sessions(storage, args)
+    pending = [s for s in sessions if args.restart or s["id"] not in checkpoint.done]
+    if args.limit:
+        pending = pending[:args.limit]
+    already_done = 0 if args.restart else sum(1 for s in sessions if s["id"] in checkpoint.done)
+    print(f"Хранилище: {storage.name} | сессий найдено: {len(sessions)}, "
+          f"уже обработано: {already_done}, в работе: {len(pending)}")
+    if not pending:
+        return 0
+
+    results = []
+    stage_times = {"load": [], "generate": [], "render": [], "publish": []}
+    started_at = time.perf_counter()
+
+    # spawn: рабочие процессы не наследуют потоки и соединения родителя
+    with ProcessPoolExecutor(max_workers=args.render_workers, mp_context=multiprocessing.get_context("spawn")) \
+            as render_pool, \
+            ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix="forte-batch") as executor:
+        futures = {executor.submit(process_session, s, args, storage, render_pool): s for s in pending}
+        for number, future in enumerate(as_completed(futures), 1):
+            session = futures[future]
+            try:
+                result, timings = future.result()
+            except Exception as e:
+                result, timings = {"status": "error", "error": f"{type(e).__name__}: {e}"}, {}
+            for stage, value in timings.items():
+                stage_times[stage].append(value)
+
+            record = dict(result, session_id=session["id"], timings=timings,
+                          finished_at=datetime.now(timezone.utc).isoformat())
+            checkpoint.write(record)
+            results.append(record)
+            detail = result.get("title") or result.get("error") or result.get("reason", "")
+            print(f"[{number}/{len(pending)}] {session['id'][:8]} {result['status']}: {detail}")
+
+    print_summary(results, stage_times, time.perf_counter() - started_at)
+    return 1 if any(r["status"] == "error" for r in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
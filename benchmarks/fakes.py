@@ -0,0 +1,319 @@
+"""Внутрипроцессные заменители внешних сервисов для офлайн-бенчмарков:
+фейковая модель Gemini, таблица chat_sessions в памяти и HTTP-заглушка Confluence/mermaid.ink"""
+import re
+import json
+import time
+import uuid
+import struct
+import zlib
+import threading
+from datetime import datetime, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+from langchain_core.messages import AIMessage, AIMessageChunk
+
+from utils.storage import StorageBackend
+
+LOREM = ("Система должна обеспечивать обработку заявки клиента в режиме реального времени "
+         "с проверкой лимитов, логированием операций и уведомлением ответственных сотрудников. ").split()
+
+
+def lorem_text(tokens):
+    return " ".join(LOREM[i % len(LOREM)] for i in range(tokens))
+
+
+class FakeChatModel:
+    """Сценарная замена ChatGoogleGenerativeAI: задержка до первого токена и скорость выдачи.
+    responder(messages) -> str позволяет подставить ответ под конкретный сценарий"""
+
+    def __init__(self, model="fake-model", temperature=0.3, latency=0.0, tokens_per_second=None,
+                 response_tokens=200, responder=None, cache_provider=None):
+        self.model = model
+        self.temperature = temperature
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.response_tokens = response_tokens
+        self.responder = responder
+        self.cache_provider = cache_provider
+        self.calls = 0
+        self.cached_calls = 0
+        self.prompt_chars = 0
+        self._lock = threading.Lock()
+
+    def _respond(self, messages, cached_content=None):
+        if cached_content and self.cache_provider and not self.cache_provider.is_alive(cached_content):
+            # Так Gemini отвечает на ссылку на удаленный или истекший кэш
+            raise RuntimeError(f"403 CachedContent not found (or permission denied): {cached_content}")
+        with self._lock:
+            self.calls += 1
+            self.cached_calls += bool(cached_content)
+            self.prompt_chars += sum(len(str(m.content)) for m in messages)
+        if self.responder:
+            return self.responder(messages)
+        return lorem_text(self.response_tokens)
+
+    def _tokens(self, text):
+        return [token + " " for token in text.split(" ")]
+
+    def invoke(self, messages, cached_content=None):
+        text = self._respond(messages, cached_content)
+        time.sleep(self.latency)
+        if self.tokens_per_second:
+            time.sleep(len(self._tokens(text)) / self.tokens_per_second)
+        return AIMessage(content=text)
+
+    def stream(self, messages, cached_content=None):
+        text = self._respond(messages, cached_content)
+        time.sleep(self.latency)
+        delay = 1 / self.tokens_per_second if self.tokens_per_second else 0
+        for token in self._tokens(text):
+            if delay:
+                time.sleep(delay)
+            yield AIMessageChunk(content=token)
+
+
+def fake_model_factory(models=None, **options):
+    """Фабрика для llm_client.set_chat_model_factory: одна фейковая модель на уровень.
+    Созданные модели складываются в models, чтобы потом прочитать их счетчики"""
+    def factory(model, temperature, timeout):
+        chat_model = FakeChatModel(model=model, temperature=temperature, **options)
+        if models is not None:
+            models.append(chat_model)
+        return chat_model
+    return factory
+
+
+class InMemoryStorage(StorageBackend):
+    """Таблицы chat_sessions/chat_messages в памяти; latency имитирует сетевой RTT до Supabase"""
+    name = "memory"
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.sessions = {}
+        self.messages = {}
+        self.uploads = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def _roundtrip(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def append_messages(self, session_id, title, messages, user_id=None):
+        self._roundtrip()
+        now = datetime.now(timezone.utc).isoformat()
+        with self._lock:
+            session = self.sessions.setdefault(session_id, {
+                "id": session_id, "title": None, "user_id": None, "final_doc": None,
+                "created_at": now, "updated_at": now
+            })
+            session["title"] = session["title"] or title
+            session["user_id"] = session["user_id"] or user_id
+            session["updated_at"] = now
+            rows = self.messages.setdefault(session_id, [])
+            for msg in messages:
+                self._next_id += 1
+                rows.append({"id": self._next_id, "role": msg["role"], "content": msg["content"]})
+
+    def load_history(self, session_id):
+        self._roundtrip()
+        with self._lock:
+            return [{"role": row["role"], "content": row["content"]} for row in self.messages.get(session_id, [])]
+
+    def get_session(self, session_id):
+        self._roundtrip()
+        with self._lock:
+            session = self.sessions.get(session_id)
+            return {k: session[k] for k in ("id", "title", "user_id")} if session else None
+
+    def list_sessions(self, user_id=None, search=None, cursor=None, limit=20):
+        self._roundtrip()
+        with self._lock:
+            rows = [s for s in self.sessions.values() if s["user_id"] == user_id]
+        if search:
+            rows = [s for s in rows if search.lower() in (s["title"] or "").lower()]
+        if cursor:
+            updated_at, last_id = cursor.split("|", 1)
+            rows = [s for s in rows if (s["updated_at"], s["id"]) < (updated_at, last_id)]
+        rows.sort(key=lambda s: (s["updated_at"], s["id"]), reverse=True)
+        page = [{k: s[k] for k in ("id", "title", "created_at", "updated_at")} for s in rows[:limit]]
+        next_cursor = f"{page[-1]['updated_at']}|{page[-1]['id']}" if len(rows) > limit else None
+        return page, next_cursor
+
+    def save_document(self, session_id, document):
+        self._roundtrip()
+        now = datetime.now(timezone.utc).isoformat()
+        with self._lock:
+            session = self.sessions.setdefault(session_id, {
+                "id": session_id, "title": None, "user_id": None, "created_at": now, "updated_at": now
+            })
+            session["final_doc"] = document
+
+    def load_document(self, session_id):
+        self._roundtrip()
+        with self._lock:
+            return self.sessions.get(session_id, {}).get("final_doc")
+
+    def save_upload(self, session_id, name, text, user_id=None):
+        self._roundtrip()
+        with self._lock:
+            self.uploads.setdefault(session_id, []).append({"name": name, "text": text})
+
+    def load_uploads(self, session_id):
+        self._roundtrip()
+        with self._lock:
+            return [dict(doc) for doc in self.uploads.get(session_id, [])]
+
+    def scan_sessions(self, updated_after=None, updated_before=None, batch_size=200):
+        self._roundtrip()
+        with self._lock:
+            rows = [dict(s) for s in self.sessions.values()
+                    if (not updated_after or s["updated_at"] >= updated_after)
+                    and (not updated_before or s["updated_at"] < updated_before)]
+        rows.sort(key=lambda s: (s["updated_at"], s["id"]))
+        return iter([{k: s.get(k) for k in ("id", "title", "user_id", "updated_at")} for s in rows])
+
+
+def tiny_png(width=64, height=32):
+    """Валидный серый PNG — достаточно для python-docx и xhtml2pdf"""
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+
+    raw = b"".join(b"\x00" + b"\x80" * width for _ in range(height))
+    return (b"\x89PNG\r\n\x1a\n"
+            + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 0, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(raw))
+            + chunk(b"IEND", b""))
+
+
+class StubServer:
+    """Локальный HTTP-сервер, отвечающий как Confluence REST API и mermaid.ink.
+    Адреса: {url}/wiki для CONFLUENCE_URL и {url} для FORTE_MERMAID_INK_URL"""
+
+    def __init__(self, latency=0.0, space_pages=250, page_size=100):
+        self.latency = latency
+        self.space_pages = [{"id": str(1000 + i), "title": f"Страница {i}"} for i in range(space_pages)]
+        self.page_size = page_size
+        self.created = []
+        self.published = {}
+        self.uploads = 0
+        self.requests = 0
+        self.image = tiny_png()
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="bench-stub", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, status, body, content_type="application/json"):
+                if isinstance(body, (dict, list)):
+                    body = json.dumps(body, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _begin(self):
+                with stub._lock:
+                    stub.requests += 1
+                if stub.latency:
+                    time.sleep(stub.latency)
+                return urlparse(self.path)
+
+            def _page(self, page):
+                return {
+                    "id": page["id"], "title": page["title"],
+                    "version": {"number": page["version"], "message": page["message"]},
+                    "ancestors": page["ancestors"],
+                    "_links": {"webui": f"/pages/{page['id']}"}
+                }
+
+            def _read(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                return self.rfile.read(length)
+
+            def do_GET(self):
+                url = self._begin()
+                if url.path.startswith(("/img/", "/svg/")):
+                    if url.path.startswith("/svg/"):
+                        return self._send(200, b"<svg xmlns='http://www.w3.org/2000/svg'/>", "image/svg+xml")
+                    return self._send(200, stub.image, "image/png")
+                params = parse_qs(url.query)
+                if url.path == "/wiki/rest/api/content" and "title" in params:
+                    with stub._lock:
+                        pages = [self._page(p) for p in stub.published.values() if p["title"] == params["title"][0]]
+                    return self._send(200, {"results": pages, "_links": {}})
+                if url.path == "/wiki/rest/api/content":
+                    start = int(params.get("start", ["0"])[0])
+                    limit = int(params.get("limit", [str(stub.page_size)])[0])
+                    results = stub.space_pages[start:start + limit]
+                    links = {"next": f"/rest/api/content?start={start + limit}"} if start + limit < len(stub.space_pages) else {}
+                    return self._send(200, {"results": results, "_links": links})
+                match = re.fullmatch(r"/wiki/rest/api/content/(\w+)/child/attachment", url.path)
+                if match and match.group(1) in stub.published:
+                    with stub._lock:
+                        names = sorted(stub.published[match.group(1)]["attachments"])
+                    return self._send(200, {"results": [{"title": name} for name in names], "_links": {}})
+                self._send(404, {"message": "not found"})
+
+            def do_POST(self):
+                url = self._begin()
+                body = self._read()
+                match = re.fullmatch(r"/wiki/rest/api/content/(\w+)/child/attachment", url.path)
+                if match and match.group(1) in stub.published:
+                    filename = re.search(rb'filename="([^"]+)"', body).group(1).decode("utf-8")
+                    with stub._lock:
+                        stub.published[match.group(1)]["attachments"].add(filename)
+                        stub.uploads += 1
+                    return self._send(200, {"results": [{"title": filename}]})
+                if url.path == "/wiki/rest/api/content":
+                    payload = json.loads(body or b"{}")
+                    page_id = str(uuid.uuid4().int % 10 ** 9)
+                    page = {"id": page_id, "title": payload.get("title"), "version": 1,
+                            "message": (payload.get("version") or {}).get("message"),
+                            "ancestors": payload.get("ancestors", []), "attachments": set()}
+                    with stub._lock:
+                        if any(p["title"] == page["title"] for p in stub.published.values()):
+                            return self._send(400, {"message": "A page with this title already exists"})
+                        stub.created.append(page["title"])
+                        stub.published[page_id] = page
+                    return self._send(200, self._page(page))
+                self._send(404, {"message": "not found"})
+
+            def do_PUT(self):
+                url = self._begin()
+                payload = json.loads(self._read() or b"{}")
+                match = re.fullmatch(r"/wiki/rest/api/content/(\w+)", url.path)
+                if not match or match.group(1) not in stub.published:
+                    return self._send(404, {"message": "not found"})
+                with stub._lock:
+                    page = stub.published[match.group(1)]
+                    if payload["version"]["number"] != page["version"] + 1:
+                        return self._send(409, {"message": "Version conflict"})
+                    page.update(version=payload["version"]["number"], message=payload["version"].get("message"),
+                                ancestors=payload.get("ancestors", page["ancestors"]))
+                    return self._send(200, self._page(page))
+
+        return Handler
@@ -0,0 +1,316 @@
+"""Офлайн-бенчмарки горячих путей. Запуск из корня репозитория:
+
+    python -m benchmarks.run [--quick] [--only chat,brd,...] [--output benchmarks/results/latest.json]
+
+Все внешние сервисы заменены заглушками из benchmarks/fakes.py; результаты пишутся в JSON,
+чтобы сравнивать прогоны между коммитами."""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+from datetime import datetime, timezone
+
+from benchmarks.fakes import StubServer, InMemoryStorage, fake_model_factory, lorem_text, tiny_png
+
+# Окружение задается до импорта utils: модули читают настройки при загрузке
+_cache_dir = tempfile.mkdtemp(prefix="forte-bench-")
+_stub = StubServer().start()
+os.environ.update({
+    "GOOGLE_API_KEY": "fake",
+    "FORTE_CACHE_DIR": _cache_dir,
+    "FORTE_LLM_CACHE": "0",
+    "FORTE_CONTEXT_CACHE": "0",
+    "FORTE_STORAGE": "none",
+    "FORTE_MERMAID_RENDERER": "mermaid.ink",
+    "FORTE_MERMAID_INK_URL": _stub.url,
+    "CONFLUENCE_URL": f"{_stub.url}/wiki",
+    "CONFLUENCE_USER": "bench",
+    "CONFLUENCE_API_TOKEN": "bench",
+    "CONFLUENCE_SPACE": "BENCH",
+})
+# Логотип для DOCX кладется в кэш ресурсов заранее, иначе utils.assets скачает его из сети
+os.makedirs(os.path.join(_cache_dir, "assets"))
+with open(os.path.join(_cache_dir, "assets", "forte_logo.png"), "wb") as _logo:
+    _logo.write(tiny_png())
+
+from utils import llm_client, export, confluence, telemetry, context_cache  # noqa: E402
+from utils.llm_logic import BusinessAnalystAI, process_uploaded_file, make_message  # noqa: E402
+from utils.storage import SQLiteStorage  # noqa: E402
+
+DEFAULT_OUTPUT = os.path.join("benchmarks", "results", "latest.json")
+
+SAMPLE_BRD = """# Бизнес-требования: Кредитный онлайн-конвейер
+
+## 1. Введение
+{text}
+
+## 2. Бизнес-процесс
+```mermaid
+graph TD
+    A[Заявка] --> B{{Скоринг}}
+    B -->|Одобрено| C[Выдача]
+    B -->|Отказ| D[Уведомление]
+```
+{text}
+
+## 3. Требования
+| ID | Требование | Приоритет |
+|----|------------|-----------|
+| FR.001 | {short} | Must |
+| FR.002 | {short} | Should |
+
+## 4. Жизненный цикл
+```mermaid
+stateDiagram-v2
+    [*] --> Новая
+    Новая --> Проверка
+    Проверка --> Одобрена
+    Проверка --> Отклонена
+```
+{text}
+"""
+
+
+class _File:
+    """Минимальная замена UploadedFile из Streamlit"""
+
+    def __init__(self, name, data):
+        self.name = name
+        self._data = data
+
+    def getvalue(self):
+        return self._data
+
+
+def measure(fn, repeats):
+    """Первый прогон (холодный кэш) отдельно, остальные — в статистику"""
+    timings = []
+    for _ in range(repeats):
+        started_at = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started_at)
+    warm = sorted(timings[1:]) or timings
+    return {
+        "runs": len(timings),
+        "cold": timings[0],
+        "min": warm[0],
+        "median": statistics.median(warm),
+        "p95": warm[min(len(warm) - 1, int(len(warm) * 0.95))],
+        "max": warm[-1],
+    }
+
+
+def chat_history(length):
+    history = []
+    for i in range(length):
+        role = "user" if i % 2 == 0 else "assistant"
+        history.append(make_message(role, lorem_text(60 if role == "user" else 150)))
+    return history
+
+
+def make_bot(storage=None):
+    return BusinessAnalystAI(storage=storage or InMemoryStorage())
+
+
+def bench_chat(args):
+    """Накладные расходы на ход: модель отвечает мгновенно, замеряется все вокруг нее"""
+    llm_client.set_chat_model_factory(fake_model_factory(response_tokens=150))
+    results = {}
+    for length in args.sizes:
+        bot = make_bot()
+        history = chat_history(length)
+        results[f"get_response/{length}"] = measure(lambda: bot.get_response(history, use_cache=False), args.repeats)
+        results[f"stream_response/{length}"] = measure(
+            lambda: list(bot.stream_response(history, use_cache=False)), args.repeats)
+    return results
+
+
+def bench_brd(args):
+    """Генерация BRD целиком с реалистичной задержкой модели"""
+    llm_client.set_chat_model_factory(fake_model_factory(latency=args.llm_latency, response_tokens=400))
+    history = chat_history(40)
+    results = {}
+    for mode in ("sections", "single"):
+        bot = make_bot()
+        results[f"generate_requirements_doc/{mode}"] = measure(
+            lambda: bot.generate_requirements_doc(history, mode=mode, use_cache=False), max(2, args.repeats // 2))
+    return results
+
+
+def bench_context_cache(args):
+    """BRD по сессии с крупным документом: промпт целиком против ссылки на кэш контекста"""
+    history = chat_history(20)
+    document = lorem_text(20000)
+    results = {}
+    for name, provider in (("off", None), ("fake_provider", context_cache.FakeCacheProvider())):
+        context_cache.set_provider(provider)
+        models = []
+        llm_client.set_chat_model_factory(fake_model_factory(
+            models, latency=args.llm_latency, response_tokens=400, cache_provider=provider))
+        bot = make_bot()
+        bot.add_document("spec.txt", document)
+        stats = measure(lambda: bot.generate_requirements_doc(history, use_cache=False), max(2, args.repeats // 2))
+        stats["prompt_chars"] = sum(m.prompt_chars for m in models)
+        stats["cached_calls"] = sum(m.cached_calls for m in models)
+        results[f"generate_requirements_doc/{name}"] = stats
+    context_cache.set_provider(None)
+    return results
+
+
+def _make_pdf(pages):
+    from xhtml2pdf import pisa
+    from io import BytesIO
+    paragraph = f"<p>{lorem_text(350)}</p>"
+    html = "".join(f"<h2>Страница {i + 1}</h2>{paragraph}<pdf:nextpage />" for i in range(pages))
+    buffer = BytesIO()
+    pisa.CreatePDF(f"<html><body>{html}</body></html>", dest=buffer, encoding="utf-8")
+    return buffer.getvalue()
+
+
+def _make_docx(paragraphs):
+    from docx import Document
+    from io import BytesIO
+    doc = Document()
+    for i in range(paragraphs):
+        doc.add_paragraph(f"{i + 1}. {lorem_text(80)}")
+    buffer = BytesIO()
+    doc.save(buffer)
+    return buffer.getvalue()
+
+
+def bench_extraction(args):
+    pages = 40 if args.quick else 200
+    files = {
+        f"pdf/{pages}p": _File("large.pdf", _make_pdf(pages)),
+        f"docx/{pages * 10}par": _File("large.docx", _make_docx(pages * 10)),
+    }
+    return {
+        f"process_uploaded_file/{name}": measure(lambda: process_uploaded_file(file), args.repeats)
+        for name, file in files.items()
+    }
+
+
+def bench_export(args):
+    results = {}
+    document = SAMPLE_BRD.format(text=lorem_text(300), short=lorem_text(12))
+    results["create_docx/brd"] = measure(lambda: export.create_docx(document), args.repeats)
+    for length in args.sizes:
+        messages = chat_history(length)
+        results[f"create_chat_pdf/{length}"] = measure(lambda: export.create_chat_pdf(messages), args.repeats)
+        # Одно новое сообщение: страницы до последнего чистого разрыва берутся из кэша, рендерится только хвост
+        appended = messages + [make_message("user", lorem_text(40))]
+        results[f"create_chat_pdf/{length}+1"] = measure(lambda: export.create_chat_pdf(appended), 1)
+    return results
+
+
+def bench_storage(args):
+    """save_message_to_db в зависимости от длины сессии"""
+    sqlite_path = os.path.join(_cache_dir, "bench.sqlite3")
+    backends = {
+        "memory": InMemoryStorage(),
+        "memory+rtt": InMemoryStorage(latency=args.db_latency),
+        "sqlite": SQLiteStorage(sqlite_path),
+    }
+    results = {}
+    for name, storage in backends.items():
+        for length in args.sizes:
+            bot = make_bot(storage)
+            storage.append_messages(bot.session_id, "Бенчмарк", chat_history(length))
+            results[f"save_message_to_db/{name}/{length}"] = measure(
+                lambda: bot.save_message_to_db("user", lorem_text(60)), args.repeats * 5)
+            results[f"load_history_from_db/{name}/{length}"] = measure(bot.load_history_from_db, args.repeats)
+    return results
+
+
+def bench_confluence(args):
+    document = SAMPLE_BRD.format(text=lorem_text(300), short=lorem_text(12))
+    counter = iter(range(10 ** 6))
+    results = {
+        f"fetch_space_pages/{len(_stub.space_pages)}": measure(confluence._fetch_space_pages, args.repeats),
+        "publish_document/new": measure(
+            lambda: confluence.publish_document(f"BRD {next(counter)}", document), args.repeats),
+    }
+    # Повторная публикация без изменений — один поиск страницы, без новой версии и вложений
+    confluence.publish_document("BRD повтор", document)
+    uploads = _stub.uploads
+    results["publish_document/unchanged"] = measure(
+        lambda: confluence.publish_document("BRD повтор", document), args.repeats)
+    results["publish_document/unchanged"]["uploads"] = _stub.uploads - uploads
+    changed = iter(range(10 ** 6))
+    results["publish_document/changed"] = measure(
+        lambda: confluence.publish_document("BRD повтор", f"{document}\n\nПравка {next(changed)}"), args.repeats)
+    return results
+
+
+BENCHMARKS = {
+    "chat": bench_chat,
+    "brd": bench_brd,
+    "context_cache": bench_context_cache,
+    "extraction": bench_extraction,
+    "export": bench_export,
+    "storage": bench_storage,
+    "confluence": bench_confluence,
+}
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарки Forte AI Analyst")
+    parser.add_argument("--only", help="Список групп через запятую: " + ",".join(BENCHMARKS))
+    parser.add_argument("--quick", action="store_true", help="Меньше повторов и размеров (для CI)")
+    parser.add_argument("--repeats", type=int, default=None)
+    parser.add_argument("--llm-latency", type=float, default=0.05, help="Задержка фейковой модели, с")
+    parser.add_argument("--db-latency", type=float, default=0.02, help="Имитация RTT до Supabase, с")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT)
+    args = parser.parse_args(argv)
+    args.repeats = args.repeats or (3 if args.quick else 10)
+    args.sizes = [10, 100] if args.quick else [10, 100, 500]
+
+    selected = args.only.split(",") if args.only else list(BENCHMARKS)
+    report = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "commit": _git_commit(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "config": {"repeats": args.repeats, "sizes": args.sizes,
+                   "llm_latency": args.llm_latency, "db_latency": args.db_latency},
+        "results": {},
+    }
+
+    try:
+        for name in selected:
+            print(f"▶ {name}")
+            started_at = time.perf_counter()
+            results = BENCHMARKS[name](args)
+            report["results"][name] = results
+            for case, stats in results.items():
+                print(f"  {case:<45} median {stats['median'] * 1000:9.2f} ms   cold {stats['cold'] * 1000:9.2f} ms")
+            print(f"  ({time.perf_counter() - started_at:.1f} c)")
+    finally:
+        _stub.stop()
+        shutil.rmtree(_cache_dir, ignore_errors=True)
+
+    # Разбивка по внутренним операциям (LLM, хранилище, HTTP, экспорт) за весь прогон
+    report["spans"] = telemetry.get_latency_stats()
+
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Результаты: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
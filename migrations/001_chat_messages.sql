@@ -0,0 +1,42 @@
+-- 001: append-only хранение сообщений чата.
+-- Вместо перезаписи массива chat_sessions.messages каждое сообщение хранится отдельной строкой,
+-- а клиент дописывает пачку сообщений одним вызовом append_chat_messages.
+-- Выполнить в Supabase SQL Editor. Скрипт идемпотентен.
+
+create table if not exists chat_messages (
+    id bigserial primary key,
+    session_id uuid not null references chat_sessions (id) on delete cascade,
+    role text not null,
+    content text not null,
+    created_at timestamptz not null default now()
+);
+
+create index if not exists chat_messages_session_id_idx on chat_messages (session_id, id);
+
+-- Создает сессию при первом сообщении и дописывает пачку сообщений в порядке массива.
+-- Заголовок сессии выставляется только один раз.
+create or replace function append_chat_messages(p_session_id uuid, p_title text, p_messages jsonb)
+returns void
+language sql
+as $$
+    insert into chat_sessions (id, title)
+    values (p_session_id, p_title)
+    on conflict (id) do update set title = coalesce(chat_sessions.title, excluded.title);
+
+    insert into chat_messages (session_id, role, content)
+    select p_session_id, m ->> 'role', m ->> 'content'
+    from jsonb_array_elements(p_messages) with ordinality as t (m, ord)
+    order by ord;
+$$;
+
+-- Перенос существующих сессий: разворачиваем массив messages в строки.
+-- Сессии, для которых строки уже есть, пропускаются, поэтому скрипт можно запускать повторно.
+insert into chat_messages (session_id, role, content, created_at)
+select s.id, m ->> 'role', m ->> 'content', s.created_at
+from chat_sessions s
+cross join lateral jsonb_array_elements(coalesce(s.messages, '[]'::jsonb)) with ordinality as t (m, ord)
+where not exists (select 1 from chat_messages c where c.session_id = s.id)
+order by s.created_at, s.id, ord;
+
+-- После проверки переноса столбец можно удалить:
+-- alter table chat_sessions drop column messages;
@@ -0,0 +1,6 @@
+-- 002: сформированный BRD хранится вместе с сессией чата,
+-- чтобы результат фоновой генерации не терялся при обновлении страницы.
+-- Выполнить в Supabase SQL Editor. Скрипт идемпотентен.
+
+alter table chat_sessions add column if not exists final_doc text;
+alter table chat_sessions add column if not exists final_doc_updated_at timestamptz;
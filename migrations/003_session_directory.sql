@@ -0,0 +1,35 @@
+-- 003: каталог сессий — владелец, время последнего сообщения и индексы
+-- для keyset-пагинации и поиска по заголовку.
+-- Выполнить в Supabase SQL Editor. Скрипт идемпотентен.
+
+alter table chat_sessions add column if not exists user_id text;
+alter table chat_sessions add column if not exists updated_at timestamptz not null default now();
+
+update chat_sessions s
+set updated_at = coalesce((select max(c.created_at) from chat_messages c where c.session_id = s.id), s.created_at)
+where s.updated_at is distinct from coalesce((select max(c.created_at) from chat_messages c where c.session_id = s.id), s.created_at);
+
+create index if not exists chat_sessions_user_updated_idx on chat_sessions (user_id, updated_at desc, id desc);
+
+create extension if not exists pg_trgm;
+create index if not exists chat_sessions_title_trgm_idx on chat_sessions using gin (title gin_trgm_ops);
+
+-- Новая версия функции из 001: запоминает владельца сессии и время последнего сообщения
+drop function if exists append_chat_messages(uuid, text, jsonb);
+
+create or replace function append_chat_messages(p_session_id uuid, p_title text, p_messages jsonb, p_user_id text default null)
+returns void
+language sql
+as $$
+    insert into chat_sessions (id, title, user_id, updated_at)
+    values (p_session_id, p_title, p_user_id, now())
+    on conflict (id) do update set
+        title = coalesce(chat_sessions.title, excluded.title),
+        user_id = coalesce(chat_sessions.user_id, excluded.user_id),
+        updated_at = now();
+
+    insert into chat_messages (session_id, role, content)
+    select p_session_id, m ->> 'role', m ->> 'content'
+    from jsonb_array_elements(p_messages) with ordinality as t (m, ord)
+    order by ord;
+$$;
@@ -0,0 +1,26 @@
+-- 004: полный текст загруженных документов хранится вместе с сессией,
+-- чтобы индекс retrieval восстанавливался после перезапуска и на любой реплике.
+-- Выполнить в Supabase SQL Editor. Скрипт идемпотентен.
+
+create table if not exists session_uploads (
+    id bigserial primary key,
+    session_id uuid not null references chat_sessions (id) on delete cascade,
+    name text not null,
+    content text not null,
+    created_at timestamptz not null default now()
+);
+
+create index if not exists session_uploads_session_id_idx on session_uploads (session_id, id);
+
+-- Документ может прийти раньше первого сообщения: сессия создается здесь же
+create or replace function add_session_upload(p_session_id uuid, p_name text, p_content text, p_user_id text default null)
+returns void
+language sql
+as $$
+    insert into chat_sessions (id, user_id)
+    values (p_session_id, p_user_id)
+    on conflict (id) do update set user_id = coalesce(chat_sessions.user_id, excluded.user_id);
+
+    insert into session_uploads (session_id, name, content)
+    values (p_session_id, p_name, p_content);
+$$;
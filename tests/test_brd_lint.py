@@ -0,0 +1,32 @@
+from utils.brd_lint import lint_brd
+from utils.llm_logic import BRD_HEADER, BRD_SECTIONS
+
+RAW_TEMPLATE = BRD_HEADER + "".join(template for _, _, template in BRD_SECTIONS)
+
+FILLED_SECURITY = """
+## 5. KPI по Безопасности и Compliance (ОБЯЗАТЕЛЬНО)
+* **Аутентификация:** 2FA по SMS для переводов свыше 50 000 KZT
+* **Разграничение доступа (RBAC):** роли «Клиент» и «Оператор», оператор видит только маскированный PAN
+* **Защита данных:** TLS 1.2+, PAN и ИИН маскируются в логах
+* **Лимиты и Антифрод:** (не обсуждались)
+* **Логирование:** аудит-лог всех операций перевода
+"""
+
+
+def security_violations(text):
+    return [v["message"] for v in lint_brd(text) if v["section"] == 5]
+
+
+def test_raw_template_security_section_is_not_filled():
+    assert security_violations(RAW_TEMPLATE) == ["Раздел 5 (безопасность) не заполнен"]
+
+
+def test_filled_security_section_passes():
+    sections = dict((key, template) for key, _, template in BRD_SECTIONS)
+    sections["security"] = FILLED_SECURITY
+    document = BRD_HEADER + "".join(sections[key] for key, _, _ in BRD_SECTIONS)
+    assert security_violations(document) == []
+
+
+def test_raw_template_is_not_clean():
+    assert lint_brd(RAW_TEMPLATE)
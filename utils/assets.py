@@ -0,0 +1,72 @@
+import os
+import time
+import threading
+
+from utils import http_client
+
+FORTE_LOGO_URL = "https://upload.wikimedia.org/wikipedia/commons/e/e3/Fortebank_Logo.png"
+
+# Статические ресурсы: имя файла -> источник, если локальной копии нет
+STATIC_ASSETS = {
+    "forte_logo.png": FORTE_LOGO_URL,
+}
+
+BUNDLED_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "assets")
+CACHE_DIR = os.path.join(os.getenv("FORTE_CACHE_DIR", ".cache"), "assets")
+# После неудачной загрузки ресурс не запрашивается повторно столько секунд
+ASSET_RETRY_SECONDS = 300
+
+_assets = {}
+_failed_until = {}
+_assets_lock = threading.Lock()
+
+
+def _load_asset(name):
+    for directory in (BUNDLED_DIR, CACHE_DIR):
+        path = os.path.join(directory, name)
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                return f.read()
+
+    url = STATIC_ASSETS.get(name)
+    if not url:
+        return None
+
+    response = http_client.get("assets", url)
+    if response.status_code != 200:
+        print(f"Ошибка загрузки ресурса {name}: {response.status_code}")
+        return None
+
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(os.path.join(CACHE_DIR, name), "wb") as f:
+            f.write(response.content)
+    except OSError as e:
+        print(f"Ошибка записи кэша ресурсов: {e}")
+    return response.content
+
+
+def get_asset(name):
+    """Байты статического ресурса. Загружается один раз на процесс:
+    из папки assets/, из дискового кэша или по сети"""
+    with _assets_lock:
+        if name in _assets:
+            return _assets[name]
+        if _failed_until.get(name, 0) > time.time():
+            return None
+
+    # Сеть — вне блокировки: недоступный источник не должен задерживать остальные ресурсы
+    try:
+        content = _load_asset(name)
+    except Exception as e:
+        print(f"Ошибка загрузки ресурса {name}: {e}")
+        content = None
+
+    with _assets_lock:
+        if content:
+            _assets[name] = content
+            _failed_until.pop(name, None)
+        else:
+            # Неудачу помним недолго: повторим позже, но не на каждом rerun
+            _failed_until[name] = time.time() + ASSET_RETRY_SECONDS
+    return content
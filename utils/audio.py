@@ -0,0 +1,175 @@
+import io
+import os
+import math
+import wave
+import array
+import hashlib
+
+# audioop есть в стандартной библиотеке до Python 3.12, для 3.13+ — пакет audioop-lts (в requirements.txt).
+# Без него используется медленная обработка на чистом Python — только как запасной вариант
+try:
+    import audioop
+except ImportError:
+    audioop = None
+
+# Сжатие в OGG/Opus опционально: pydub + ffmpeg. Без них отправляется WAV 16 кГц моно
+try:
+    from pydub import AudioSegment
+except ImportError:
+    AudioSegment = None
+
+TARGET_RATE = 16000
+SAMPLE_WIDTH = 2
+
+FRAME_MS = 30
+MIN_SILENCE_MS = 400
+MIN_SEGMENT_SECONDS = int(os.getenv("FORTE_AUDIO_MIN_SEGMENT", "40"))
+MAX_SEGMENT_SECONDS = int(os.getenv("FORTE_AUDIO_MAX_SEGMENT", "90"))
+SILENCE_RATIO = 0.15
+MIN_TAIL_MS = 5000
+# Полуширина фильтра перед понижением частоты, в периодах новой частоты
+ANTIALIAS_ZEROS = 4
+
+
+def audio_digest(audio_bytes):
+    return hashlib.sha256(audio_bytes).hexdigest()
+
+
+def _downmix(samples, channels):
+    return array.array("h", (
+        sum(samples[i:i + channels]) // channels for i in range(0, len(samples), channels)
+    ))
+
+
+def _lowpass_kernel(step):
+    """Оконный sinc (Хэмминг) со срезом на половине целевой частоты; step — во сколько раз понижается частота"""
+    half = int(math.ceil(ANTIALIAS_ZEROS * step))
+    kernel = []
+    for n in range(-half, half + 1):
+        x = n / step
+        sinc = math.sin(math.pi * x) / (math.pi * x) if n else 1.0
+        window = 0.54 + 0.46 * math.cos(math.pi * n / (half + 1))
+        kernel.append(sinc * window)
+    total = sum(kernel)
+    return [k / total for k in kernel], half
+
+
+def _resample(samples, rate):
+    step = rate / TARGET_RATE
+    count = int(len(samples) / step)
+    if step <= 1:
+        return array.array("h", (samples[int(i * step)] for i in range(count)))
+
+    # Перед прореживанием срезаем все выше новой частоты Найквиста, иначе высокие частоты наложатся на речь
+    kernel, half = _lowpass_kernel(step)
+    last = len(samples) - 1
+    result = array.array("h")
+    for i in range(count):
+        center = int(i * step)
+        value = 0.0
+        for k, weight in enumerate(kernel):
+            value += weight * samples[min(max(center + k - half, 0), last)]
+        result.append(max(-32768, min(32767, int(round(value)))))
+    return result
+
+
+def _to_mono_16k(frames, channels, width, rate):
+    if audioop:
+        if width != SAMPLE_WIDTH:
+            frames = audioop.lin2lin(frames, width, SAMPLE_WIDTH)
+        if channels == 2:
+            frames = audioop.tomono(frames, SAMPLE_WIDTH, 0.5, 0.5)
+        elif channels > 2:
+            frames = _downmix(array.array("h", frames), channels).tobytes()
+        if rate != TARGET_RATE:
+            # Запись целиком — один вызов, поэтому состояние ratecv не переносится между фрагментами
+            frames, _ = audioop.ratecv(frames, SAMPLE_WIDTH, 1, rate, TARGET_RATE, None)
+        return frames
+
+    if width != SAMPLE_WIDTH:
+        raise ValueError(f"Неподдерживаемая разрядность WAV без audioop: {width * 8} бит")
+    samples = array.array("h", frames)
+    if channels > 1:
+        samples = _downmix(samples, channels)
+    if rate != TARGET_RATE:
+        samples = _resample(samples, rate)
+    return samples.tobytes()
+
+
+def _rms(frame):
+    if audioop:
+        return audioop.rms(frame, SAMPLE_WIDTH)
+    samples = array.array("h", frame)
+    return int((sum(s * s for s in samples) / len(samples)) ** 0.5) if samples else 0
+
+
+def _split_on_silence(pcm):
+    """Режет запись на сегменты MIN..MAX секунд по паузам"""
+    frame_bytes = TARGET_RATE * SAMPLE_WIDTH * FRAME_MS // 1000
+    total_frames = len(pcm) // frame_bytes
+    if total_frames * FRAME_MS <= MAX_SEGMENT_SECONDS * 1000:
+        return [pcm]
+
+    levels = [_rms(pcm[i * frame_bytes:(i + 1) * frame_bytes]) for i in range(total_frames)]
+    threshold = max(levels) * SILENCE_RATIO
+
+    min_frames = MIN_SEGMENT_SECONDS * 1000 // FRAME_MS
+    max_frames = MAX_SEGMENT_SECONDS * 1000 // FRAME_MS
+    silence_frames = MIN_SILENCE_MS // FRAME_MS
+
+    segments = []
+    start = 0
+    quiet_run = 0
+    for i, level in enumerate(levels):
+        quiet_run = quiet_run + 1 if level < threshold else 0
+        length = i - start + 1
+        # Режем посередине паузы, а если пауз нет — принудительно по максимальной длине
+        if (length >= min_frames and quiet_run >= silence_frames) or length >= max_frames:
+            cut = i - quiet_run // 2 if quiet_run else i + 1
+            segments.append(pcm[start * frame_bytes:cut * frame_bytes])
+            start = cut
+            quiet_run = 0
+    if start < total_frames:
+        tail = pcm[start * frame_bytes:]
+        # Короткий хвост (обычно тишина в конце) не стоит отдельного запроса
+        if segments and (total_frames - start) * FRAME_MS < MIN_TAIL_MS:
+            segments[-1] += tail
+        else:
+            segments.append(tail)
+    return segments
+
+
+def _encode(pcm):
+    if AudioSegment is not None:
+        try:
+            segment = AudioSegment(data=pcm, sample_width=SAMPLE_WIDTH, frame_rate=TARGET_RATE, channels=1)
+            buffer = io.BytesIO()
+            segment.export(buffer, format="ogg", codec="libopus", bitrate="24k")
+            return buffer.getvalue(), "audio/ogg"
+        except Exception as e:
+            print(f"Сжатие аудио недоступно, отправляю WAV: {e}")
+
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(SAMPLE_WIDTH)
+        wav.setframerate(TARGET_RATE)
+        wav.writeframes(pcm)
+    return buffer.getvalue(), "audio/wav"
+
+
+def prepare_audio(audio_bytes):
+    """Готовит запись к распознаванию: моно 16 кГц, нарезка по паузам, сжатие.
+    Возвращает список (байты, mime_type) в порядке записи"""
+    try:
+        with wave.open(io.BytesIO(audio_bytes), "rb") as wav:
+            channels = wav.getnchannels()
+            width = wav.getsampwidth()
+            rate = wav.getframerate()
+            frames = wav.readframes(wav.getnframes())
+    except (wave.Error, EOFError):
+        # Не WAV — отправляем как есть
+        return [(audio_bytes, "audio/wav")]
+
+    pcm = _to_mono_16k(frames, channels, width, rate)
+    return [_encode(segment) for segment in _split_on_silence(pcm)]
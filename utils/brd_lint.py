@@ -0,0 +1,212 @@
+import re
+
+# Локальная проверка структуры BRD. Правила повторяют то, что раньше проверял LLM в проходе самокритики
+
+SECTION_RE = re.compile(r"^##\s+(\d+)\.\s*(.*)$", re.MULTILINE)
+MERMAID_RE = re.compile(r"```mermaid\s*\n(.*?)```", re.DOTALL)
+TABLE_SEPARATOR_RE = re.compile(r"^\s*\|?\s*:?-{3,}:?\s*(\|\s*:?-{3,}:?\s*)+\|?\s*$", re.MULTILINE)
+
+REQUIRED_SECTIONS = range(1, 8)
+MIN_SECURITY_ITEMS = 3
+# Незаполненный пункт шаблона (после отбрасывания точек в конце): пусто ("..."),
+# подсказка в скобках "(2FA, FaceID, ...)" или плейсхолдер "[Опиши ...]"
+PLACEHOLDER_RE = re.compile(r"^(?:\(.*\)|\[.*\])?$")
+
+STATE_ID = r"[A-Za-z_][A-Za-z0-9_]*"
+STATE_REF = rf"(?:\[\*\]|{STATE_ID})"
+
+_STATE_PATTERNS = [
+    ("transition", re.compile(rf"^({STATE_REF})(?::::{STATE_ID})?\s*-->\s*({STATE_REF})(?::::{STATE_ID})?\s*(?::\s*(.*))?$")),
+    ("state_as", re.compile(rf'^state\s+"[^"]*"\s+as\s+({STATE_ID})$')),
+    ("state_alias", re.compile(rf'^state\s+({STATE_ID})\s+as\s+"[^"]*"$')),
+    ("state_block", re.compile(rf"^state\s+(?:\"[^\"]*\"\s+as\s+)?({STATE_ID})\s*\{{$")),
+    ("state_special", re.compile(rf"^state\s+({STATE_ID})\s+<<(choice|fork|join)>>$")),
+    ("state_plain", re.compile(rf"^state\s+({STATE_ID})$")),
+    ("description", re.compile(rf"^({STATE_ID})\s*:\s*(.+)$")),
+    ("note_inline", re.compile(rf"^note\s+(left|right)\s+of\s+({STATE_ID})\s*:\s*(.+)$")),
+    ("note_block", re.compile(rf"^note\s+(left|right)\s+of\s+({STATE_ID})$")),
+    ("direction", re.compile(r"^direction\s+(TB|TD|BT|LR|RL)$")),
+    ("class_def", re.compile(rf"^classDef\s+{STATE_ID}\s+.+$")),
+    ("class", re.compile(rf"^class\s+{STATE_ID}(\s*,\s*{STATE_ID})*\s+{STATE_ID}$")),
+    ("bare_state", re.compile(rf"^({STATE_ID})$")),
+]
+
+
+def parse_state_diagram(code):
+    """Разбирает код stateDiagram-v2. Возвращает (состояния, переходы, ошибки);
+    ошибки — строки с номером строки диаграммы"""
+    lines = code.splitlines()
+    errors = []
+    states = set()
+    transitions = []
+
+    first = 0
+    while first < len(lines) and (not lines[first].strip() or lines[first].strip().startswith("%%")):
+        first += 1
+    if first == len(lines) or lines[first].strip() != "stateDiagram-v2":
+        return states, transitions, ["строка 1: диаграмма должна начинаться с `stateDiagram-v2`"]
+
+    depth = 0
+    in_note = False
+    for number, raw in enumerate(lines[first + 1:], start=first + 2):
+        line = raw.strip()
+        if not line or line.startswith("%%"):
+            continue
+
+        if in_note:
+            if line == "end note":
+                in_note = False
+            continue
+
+        if line == "}":
+            depth -= 1
+            if depth < 0:
+                errors.append(f"строка {number}: лишняя закрывающая скобка `}}`")
+                depth = 0
+            continue
+        if line == "--" and depth > 0:
+            continue
+
+        for kind, pattern in _STATE_PATTERNS:
+            match = pattern.match(line)
+            if not match:
+                continue
+            if kind == "transition":
+                source, target = match.group(1), match.group(2)
+                states.update(s for s in (source, target) if s != "[*]")
+                transitions.append((source, target, (match.group(3) or "").strip()))
+            elif kind == "state_block":
+                states.add(match.group(1))
+                depth += 1
+            elif kind == "note_block":
+                in_note = True
+            elif kind in ("state_as", "state_alias", "state_special", "state_plain", "description", "bare_state"):
+                states.add(match.group(1))
+            break
+        else:
+            if re.search(r"[^\x00-\x7F]", line.split(":", 1)[0]):
+                errors.append(f"строка {number}: ID состояния должен состоять из английских букв без пробелов: `{line}`")
+            else:
+                errors.append(f"строка {number}: неизвестная конструкция: `{line}`")
+
+    if depth > 0:
+        errors.append("не закрыт блок `state ... {`")
+    if in_note:
+        errors.append("не закрыт блок `note` (нет `end note`)")
+    if not transitions:
+        errors.append("в диаграмме нет ни одного перехода `-->`")
+
+    return states, transitions, errors
+
+
+def split_sections(text):
+    """Делит документ на преамбулу и разделы `## N. ...`: (преамбула, [(номер, текст раздела)])"""
+    matches = list(SECTION_RE.finditer(text))
+    if not matches:
+        return text, []
+    preamble = text[:matches[0].start()]
+    sections = []
+    for i, match in enumerate(matches):
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(text)
+        sections.append((int(match.group(1)), text[match.start():end].strip()))
+    return preamble, sections
+
+
+def merge_sections(sections):
+    """{номер: текст} из списка split_sections. Повторы одного номера (модель нередко пишет раздел дважды)
+    не теряются: их содержимое дописывается к первому вхождению без повторного заголовка"""
+    merged = {}
+    for number, section in sections:
+        if number in merged:
+            body = section.split("\n", 1)[1].strip() if "\n" in section else ""
+            if body:
+                merged[number] = f"{merged[number]}\n\n{body}"
+        else:
+            merged[number] = section
+    return merged
+
+
+def replace_sections(text, replacements):
+    """Подменяет разделы по номеру; отсутствующие разделы вставляются по порядку, повторы объединяются"""
+    preamble, sections = split_sections(text)
+    merged = merge_sections(sections)
+    merged.update(replacements)
+    body = "\n\n".join(merged[number] for number in sorted(merged))
+    return f"{preamble.rstrip()}\n\n{body}\n" if preamble.strip() else f"{body}\n"
+
+
+def _ids(text, prefix):
+    return re.findall(rf"\b{prefix}\.(\d{{3}})\b", text)
+
+
+def lint_brd(text):
+    """Возвращает список нарушений: [{"section": номер, "message": текст}]"""
+    violations = []
+
+    def violation(section, message):
+        violations.append({"section": section, "message": message})
+
+    _, section_list = split_sections(text)
+    numbers = [number for number, _ in section_list]
+    sections = merge_sections(section_list)
+
+    for number in REQUIRED_SECTIONS:
+        count = numbers.count(number)
+        if count == 0:
+            violation(number, f"Раздел {number} отсутствует")
+        elif count > 1:
+            violation(number, f"Раздел {number} повторяется {count} раза")
+    if numbers != sorted(numbers):
+        violation(None, "Разделы идут не по порядку 1–7")
+
+    user_stories = sections.get(2)
+    if user_stories is not None:
+        if not TABLE_SEPARATOR_RE.search(user_stories):
+            violation(2, "В разделе 2 нет таблицы User Stories")
+        elif not _ids(user_stories, "US"):
+            violation(2, "В таблице User Stories нет строк с ID US.xxx")
+        if "[Роль]" in user_stories:
+            violation(2, "В таблице User Stories остались плейсхолдеры шаблона `[Роль]`")
+
+    for number, prefix in ((3, "FR"), (6, "NFR")):
+        body = sections.get(number)
+        if body is None:
+            continue
+        ids = _ids(body, prefix)
+        if not ids:
+            violation(number, f"В разделе {number} нет требований с ID {prefix}.xxx")
+        # Дублем считаем повторное определение (**FR.001:**), а не ссылку на требование
+        definitions = re.findall(rf"\*\*{prefix}\.(\d{{3}})", body)
+        duplicates = sorted({i for i in definitions if definitions.count(i) > 1})
+        if duplicates:
+            violation(number, f"Повторяются ID: {', '.join(f'{prefix}.{i}' for i in duplicates)}")
+
+    security = sections.get(5)
+    if security is not None:
+        filled = []
+        for line in security.splitlines()[1:]:
+            match = re.match(r"^\s*[*-]\s+(?:\*\*[^*]+\*\*|[^:]+:)\s*(.*)$", line)
+            value = match.group(1).strip().strip("*").strip().rstrip(".").strip() if match else ""
+            if match and not PLACEHOLDER_RE.match(value):
+                filled.append(line)
+        if len(filled) < MIN_SECURITY_ITEMS:
+            violation(5, "Раздел 5 (безопасность) не заполнен")
+
+    diagram_section = sections.get(7)
+    if diagram_section is not None:
+        blocks = MERMAID_RE.findall(diagram_section)
+        if not blocks:
+            violation(7, "В разделе 7 нет блока ```mermaid")
+        for code in blocks:
+            _, _, errors = parse_state_diagram(code)
+            for error in errors:
+                violation(7, f"Mermaid: {error}")
+
+    return violations
+
+
+def format_violations(violations):
+    return "\n".join(
+        f"- [Раздел {v['section']}] {v['message']}" if v["section"] else f"- {v['message']}"
+        for v in violations
+    )
@@ -1,7 +1,15 @@
 import os
-import requests
+import re
+import hashlib
 from requests.auth import HTTPBasicAuth
-import json
+from concurrent.futures import ThreadPoolExecutor
+
+import markdown
+
+from utils import http_client
+from utils.diagrams import render_diagrams
+import time
+import threading
 
 
 def get_auth_headers():
@@ -26,42 +34,200 @@ def get_auth_headers():
     return base_url, auth, headers
 
 
-def get_space_pages():
+PAGES_TTL = int(os.getenv("FORTE_CONFLUENCE_PAGES_TTL", "600"))
+PAGES_ERROR_TTL = 30
+PAGES_BATCH_SIZE = 100
+# Пока каталог не загружен, родитель неизвестен: публиковать нельзя, иначе страница уйдет в корень
+PAGES_LOADING = "⏳ Список страниц загружается..."
+
+# Каталог страниц общий для всех сессий процесса и обновляется в фоне
+_pages_cache = {"pages": None, "expires_at": 0.0}
+_pages_lock = threading.Lock()
+_pages_thread = None
+
+
+def _fetch_space_pages():
     base_url, auth, headers = get_auth_headers()
     space_key = os.getenv("CONFLUENCE_SPACE", "DS")
 
-    if not base_url:
-        return {"⚠️ Демо режим (Нет ключей)": None}
-
     try:
         api_url = f"{base_url}/rest/api/content"
-        params = {
-            "spaceKey": space_key,
-            "type": "page",
-            "limit": 20,
-            "orderby": "history.createdDate desc",
-            "expand": "version"
-        }
+        pages = {}
+        pages[f"📂 Корень пространства"] = None
+        start = 0
+
+        while True:
+            params = {
+                "spaceKey": space_key,
+                "type": "page",
+                "start": start,
+                "limit": PAGES_BATCH_SIZE,
+                "orderby": "history.createdDate desc",
+                "expand": "version"
+            }
 
-        response = requests.get(api_url, auth=auth, headers=headers, params=params)
+            response = http_client.get("confluence", api_url, auth=auth, headers=headers, params=params)
 
-        if response.status_code == 200:
-            data = response.json()
-            pages = {}
-            pages[f"📂 Корень пространства"] = None
+            if response.status_code != 200:
+                print(f"Ошибка получения страниц: {response.status_code} - {response.text}")
+                return {f"❌ Ошибка {response.status_code}": None}, False
 
-            for page in data.get('results', []):
+            data = response.json()
+            results = data.get('results', [])
+            for page in results:
                 pages[f"📄 {page['title']}"] = page['id']
-            return pages
-        else:
-            print(f"Ошибка получения страниц: {response.status_code} - {response.text}")
-            return {f"❌ Ошибка {response.status_code}": None}
+
+            if not results or "next" not in data.get('_links', {}):
+                return pages, True
+            start += len(results)
 
     except Exception as e:
-        return {f"❌ Ошибка сети: {e}": None}
+        return {f"❌ Ошибка сети: {e}": None}, False
+
+
+def _refresh_space_pages():
+    global _pages_thread
+    try:
+        pages, ok = _fetch_space_pages()
+        with _pages_lock:
+            _pages_cache["pages"] = pages
+            _pages_cache["expires_at"] = time.time() + (PAGES_TTL if ok else PAGES_ERROR_TTL)
+    finally:
+        with _pages_lock:
+            _pages_thread = None
+
+
+def prefetch_space_pages():
+    """Запускает фоновую загрузку каталога, если его нет или он устарел"""
+    global _pages_thread
+    if not get_auth_headers()[0]:
+        return
+    with _pages_lock:
+        if _pages_thread is not None or time.time() < _pages_cache["expires_at"]:
+            return
+        _pages_thread = threading.Thread(target=_refresh_space_pages, name="confluence-pages", daemon=True)
+        _pages_thread.start()
+
+
+def invalidate_space_pages():
+    with _pages_lock:
+        _pages_cache["expires_at"] = 0.0
+    prefetch_space_pages()
+
+
+def get_space_pages():
+    """Каталог страниц пространства без ожидания сети: устаревшие данные отдаются,
+    пока в фоне загружаются свежие"""
+    if not get_auth_headers()[0]:
+        return {"⚠️ Демо режим (Нет ключей)": None}
+
+    prefetch_space_pages()
+    with _pages_lock:
+        pages = _pages_cache["pages"]
+    if pages is None:
+        return {PAGES_LOADING: None}
+    return pages
+
+
+PUBLISH_WORKERS = int(os.getenv("FORTE_CONFLUENCE_WORKERS", "4"))
+# Хэш опубликованного содержимого хранится в комментарии к версии страницы
+HASH_MARKER = "forte-hash:"
+MERMAID_RE = re.compile(r"```mermaid\s*\n([\s\S]*?)```")
 
 
-def publish_to_confluence(title, html_content, parent_id=None):
+def render_storage_body(markdown_text):
+    """Markdown BRD -> XHTML storage format Confluence: таблицы, блоки кода,
+    диаграммы Mermaid — картинками-вложениями. Возвращает (тело, {имя вложения: PNG})"""
+    codes = [match.group(1).strip() for match in MERMAID_RE.finditer(markdown_text)]
+    images = dict(zip(codes, render_diagrams(codes)))
+    attachments = {}
+
+    def replace(match):
+        code = match.group(1).strip()
+        content = images.get(code)
+        if not content:
+            # Диаграмма не отрисовалась — оставляем исходный код, чтобы не потерять ее
+            return f"\n```\n{code}\n```\n"
+        filename = f"diagram-{hashlib.sha256(code.encode('utf-8')).hexdigest()[:16]}.png"
+        attachments[filename] = content
+        return f'\n<ac:image><ri:attachment ri:filename="{filename}" /></ac:image>\n'
+
+    body = markdown.markdown(MERMAID_RE.sub(replace, markdown_text), extensions=["tables", "fenced_code"])
+    return body, attachments
+
+
+def _content_hash(title, body, parent_id):
+    return hashlib.sha256(f"{title}\0{parent_id or ''}\0{body}".encode("utf-8")).hexdigest()
+
+
+def _find_page(base_url, auth, headers, space_key, title):
+    response = http_client.get("confluence", f"{base_url}/rest/api/content", auth=auth, headers=headers, params={
+        "spaceKey": space_key,
+        "title": title,
+        "type": "page",
+        "expand": "version,ancestors"
+    })
+    if response.status_code != 200:
+        raise RuntimeError(f"поиск страницы: {response.status_code} - {response.text[:200]}")
+    results = response.json().get("results", [])
+    return results[0] if results else None
+
+
+def _parent_of(page):
+    ancestors = page.get("ancestors") or []
+    return str(ancestors[-1]["id"]) if ancestors else None
+
+
+def _published_hash(page):
+    message = (page.get("version") or {}).get("message") or ""
+    return message[len(HASH_MARKER):] if message.startswith(HASH_MARKER) else None
+
+
+def _existing_attachments(base_url, auth, headers, page_id):
+    names = set()
+    start = 0
+    while True:
+        response = http_client.get("confluence", f"{base_url}/rest/api/content/{page_id}/child/attachment",
+                                   auth=auth, headers=headers, params={"start": start, "limit": PAGES_BATCH_SIZE})
+        if response.status_code != 200:
+            raise RuntimeError(f"список вложений: {response.status_code} - {response.text[:200]}")
+        data = response.json()
+        results = data.get("results", [])
+        names.update(item["title"] for item in results)
+        if not results or "next" not in data.get("_links", {}):
+            return names
+        start += len(results)
+
+
+def _upload_attachment(base_url, auth, page_id, filename, content):
+    response = http_client.post(
+        "confluence", f"{base_url}/rest/api/content/{page_id}/child/attachment",
+        auth=auth,
+        headers={"X-Atlassian-Token": "no-check", "Accept": "application/json"},
+        files={"file": (filename, content, "image/png")},
+        data={"minorEdit": "true"}
+    )
+    if response.status_code not in (200, 201):
+        raise RuntimeError(f"вложение {filename}: {response.status_code} - {response.text[:200]}")
+
+
+def _sync_attachments(base_url, auth, headers, page_id, attachments, new_page=False):
+    """Загружает только те диаграммы, которых еще нет у страницы (имя файла содержит хэш кода)"""
+    if not attachments:
+        return 0
+    existing = set() if new_page else _existing_attachments(base_url, auth, headers, page_id)
+    missing = {name: content for name, content in attachments.items() if name not in existing}
+    if not missing:
+        return 0
+    with ThreadPoolExecutor(max_workers=min(PUBLISH_WORKERS, len(missing))) as executor:
+        list(executor.map(lambda item: _upload_attachment(base_url, auth, page_id, *item), missing.items()))
+    return len(missing)
+
+
+def publish_to_confluence(title, html_content, parent_id=None, attachments=None):
+    """Создает страницу или обновляет существующую с тем же заголовком под тем же родителем.
+    Страница с таким заголовком в другом месте пространства не трогается — публикация отклоняется.
+    Новая версия пишется, только если содержимое изменилось с прошлой публикации"""
     base_url, auth, headers = get_auth_headers()
     space_key = os.getenv("CONFLUENCE_SPACE", "DS")
 
@@ -69,28 +235,57 @@ def publish_to_confluence(title, html_content, parent_id=None):
         return "⚠️ Демо режим: API ключи не настроены."
 
     api_url = f"{base_url}/rest/api/content"
+    attachments = attachments or {}
+    digest = _content_hash(title, html_content, parent_id)
 
-    payload = {
-        "title": title,
-        "type": "page",
-        "space": {"key": space_key},
-        "body": {
-            "storage": {
-                "value": html_content,
-                "representation": "storage"
+    try:
+        page = _find_page(base_url, auth, headers, space_key, title)
+
+        if page and _parent_of(page) != (str(parent_id) if parent_id else None):
+            # Заголовки уникальны в пространстве: чужую страницу не перезаписываем и не переносим
+            return "⚠️ Ошибка: Страница с таким названием уже существует в другом разделе. Измените заголовок или тему."
+
+        if page and _published_hash(page) == digest:
+            # Хэш пишется вместе с телом, а диаграммы новой страницы грузятся после него —
+            # если загрузка тогда упала, дозагружаем недостающие вложения
+            link = base_url + page["_links"]["webui"]
+            if _sync_attachments(base_url, auth, headers, page["id"], attachments):
+                return f"✅ Диаграммы страницы дозагружены. [Открыть в Confluence]({link})"
+            return f"✅ Изменений нет — страница уже актуальна. [Открыть в Confluence]({link})"
+
+        payload = {
+            "title": title,
+            "type": "page",
+            "space": {"key": space_key},
+            "body": {
+                "storage": {
+                    "value": html_content,
+                    "representation": "storage"
+                }
             }
         }
-    }
 
-    if parent_id:
-        payload["ancestors"] = [{"id": parent_id}]
+        if page:
+            # Вложения до тела: новая версия сразу ссылается на загруженные картинки
+            _sync_attachments(base_url, auth, headers, page["id"], attachments)
+            version = page["version"]["number"] + 1
+            payload["version"] = {"number": version, "message": HASH_MARKER + digest}
+            response = http_client.put("confluence", f"{api_url}/{page['id']}", auth=auth, headers=headers, json=payload)
+            if response.status_code != 200:
+                return f"❌ Ошибка API {response.status_code}: {response.text[:200]}"
+            link = base_url + response.json()['_links']['webui']
+            return f"✅ Страница обновлена (версия {version}). [Открыть в Confluence]({link})"
 
-    try:
-        response = requests.post(api_url, auth=auth, headers=headers, json=payload)
+        if parent_id:
+            payload["ancestors"] = [{"id": parent_id}]
+        payload["version"] = {"number": 1, "message": HASH_MARKER + digest}
+        response = http_client.post("confluence", api_url, auth=auth, headers=headers, json=payload)
 
         if response.status_code == 200:
             data = response.json()
+            _sync_attachments(base_url, auth, headers, data["id"], attachments, new_page=True)
             link = base_url + data['_links']['webui']
+            invalidate_space_pages()
             return f"✅ Успешно создано! [Открыть в Confluence]({link})"
 
         elif "title already exists" in response.text.lower():
@@ -100,4 +295,12 @@ def publish_to_confluence(title, html_content, parent_id=None):
             return f"❌ Ошибка API {response.status_code}: {response.text[:200]}"
 
     except Exception as e:
-        return f"❌ Критическая ошибка: {str(e)}"
\ No newline at end of file
+        return f"❌ Критическая ошибка: {str(e)}"
+
+
+def publish_document(title, markdown_text, parent_id=None):
+    """Публикует BRD из Markdown: таблицы, диаграммы вложениями, повторная публикация без изменений — no-op"""
+    if not get_auth_headers()[0]:
+        return "⚠️ Демо режим: API ключи не настроены."
+    body, attachments = render_storage_body(markdown_text)
+    return publish_to_confluence(title, body, parent_id=parent_id, attachments=attachments)
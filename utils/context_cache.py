@@ -0,0 +1,306 @@
+import os
+import time
+import hashlib
+import threading
+
+from langchain_core.messages import SystemMessage, HumanMessage
+
+from utils.history import estimate_tokens
+
+# Явный кэш контекста Gemini опционален: google-genai идет вместе со свежим langchain-google-genai
+try:
+    from google import genai
+    from google.genai import types as genai_types
+except ImportError:
+    genai = None
+
+ENABLED = os.getenv("FORTE_CONTEXT_CACHE", "1") == "1"
+TTL = int(os.getenv("FORTE_CONTEXT_CACHE_TTL", "3600"))
+# Gemini не принимает в кэш слишком короткий контекст; слишком длинный не влезет в окно модели
+MIN_TOKENS = int(os.getenv("FORTE_CONTEXT_CACHE_MIN_TOKENS", "4096"))
+MAX_TOKENS = int(os.getenv("FORTE_CONTEXT_CACHE_MAX_TOKENS", "200000"))
+# Кэш, которому осталось жить меньше этого, пересоздаем заранее
+REFRESH_MARGIN = 60
+# После ошибки создания не повторяем попытку для того же префикса какое-то время
+ERROR_TTL = 300
+
+
+class GeminiCacheProvider:
+    """Кэш контекста на стороне Gemini API (client.caches)"""
+    name = "gemini"
+
+    def __init__(self, api_key):
+        self.client = genai.Client(api_key=api_key)
+
+    def create(self, model, system_text, ttl):
+        cache = self.client.caches.create(
+            model=model,
+            config=genai_types.CreateCachedContentConfig(
+                system_instruction=system_text,
+                display_name="forte-context",
+                ttl=f"{ttl}s",
+            ),
+        )
+        return cache.name, cache.expire_time.timestamp() if cache.expire_time else time.time() + ttl
+
+    def delete(self, name):
+        self.client.caches.delete(name=name)
+
+
+class FakeCacheProvider:
+    """Локальная замена для тестов и бенчмарков: кэши живут в памяти, TTL соблюдается"""
+    name = "fake"
+
+    def __init__(self):
+        self.caches = {}
+        self.created = 0
+
+    def create(self, model, system_text, ttl):
+        self.created += 1
+        name = f"cachedContents/fake-{self.created}"
+        expires_at = time.time() + ttl
+        self.caches[name] = {"model": model, "text": system_text, "expires_at": expires_at}
+        return name, expires_at
+
+    def delete(self, name):
+        self.caches.pop(name, None)
+
+    def is_alive(self, name):
+        cache = self.caches.get(name)
+        return bool(cache) and cache["expires_at"] > time.time()
+
+
+class CacheableMessages(list):
+    """Сообщения, у которых первый элемент — крупный стабильный префикс (промпт и документы целиком).
+    Префикс уходит модели только ссылкой на кэш провайдера; если кэша нет, отправляется fallback —
+    те же сообщения с обычным промптом и фрагментами документов. scope (ID сессии) позволяет удалить
+    кэш, который вытеснен новым префиксом той же сессии"""
+
+    def __init__(self, messages, fallback, scope=None):
+        super().__init__(messages)
+        self.fallback = list(fallback)
+        self.scope = scope
+
+    def copy(self):
+        return CacheableMessages(self, self.fallback, self.scope)
+
+    def append(self, message):
+        super().append(message)
+        self.fallback.append(message)
+
+    def extend(self, messages):
+        messages = list(messages)
+        super().extend(messages)
+        self.fallback.extend(messages)
+
+
+def _fallback(messages):
+    return _merge_system(getattr(messages, "fallback", messages))
+
+
+_provider = None
+_provider_lock = threading.Lock()
+_registry = {}
+_registry_lock = threading.Lock()
+_create_lock = threading.Lock()
+_stats = {"created": 0, "deleted": 0, "hits": 0, "fallbacks": 0, "errors": 0, "cached_tokens": 0}
+
+
+def _count(name, value=1):
+    with _registry_lock:
+        _stats[name] += value
+
+
+def set_provider(provider):
+    """Подменяет провайдера кэша (FakeCacheProvider в тестах, None — отключить)"""
+    global _provider
+    with _provider_lock:
+        _provider = provider
+    with _registry_lock:
+        _registry.clear()
+
+
+def get_provider():
+    global _provider
+    with _provider_lock:
+        if _provider is None and ENABLED and genai is not None:
+            from utils.llm_client import resolve_api_key
+            try:
+                _provider = GeminiCacheProvider(resolve_api_key())
+            except Exception as e:
+                print(f"⚠️ Кэш контекста Gemini недоступен: {e}")
+        return _provider
+
+
+def is_available():
+    return get_provider() is not None
+
+
+def fits(text):
+    """Стоит ли держать текст целиком в кэше провайдера"""
+    return MIN_TOKENS <= estimate_tokens(text) <= MAX_TOKENS
+
+
+def get_cache_name(model, system_text, scope=None):
+    """Имя живого кэша для (модель, префикс); создает кэш при первом обращении или по истечении TTL.
+    Кэш, который новый кэш заменил (тот же префикс или та же scope), удаляется у провайдера.
+    None — кэширование недоступно, вызывающий отправляет сообщения без префикса"""
+    provider = get_provider()
+    if provider is None or not fits(system_text):
+        return None
+
+    key = (provider.name, model, hashlib.sha256(system_text.encode("utf-8")).hexdigest())
+    name = _lookup(key)
+    if name is not False:
+        return name
+
+    # Параллельные разделы BRD приходят с одним префиксом одновременно — создаем кэш один раз
+    with _create_lock:
+        name = _lookup(key)
+        if name is not False:
+            return name
+        try:
+            name, expires_at = provider.create(model, system_text, TTL)
+        except Exception as e:
+            print(f"Ошибка создания кэша контекста: {e}")
+            with _registry_lock:
+                _registry[key] = {"name": None, "expires_at": time.time() + ERROR_TTL, "tokens": 0}
+                _stats["errors"] += 1
+            return None
+
+        with _registry_lock:
+            superseded = _pop_superseded(key, scope)
+            _registry[key] = {"name": name, "expires_at": expires_at,
+                              "tokens": estimate_tokens(system_text), "scope": scope}
+            _stats["created"] += 1
+        _delete(provider, superseded)
+        return name
+
+
+def _pop_superseded(key, scope):
+    """Убирает из реестра записи, которые заменяет новый кэш key, и истекшие; вызывается под _registry_lock.
+    Возвращает имена кэшей, которые еще живы у провайдера"""
+    now = time.time()
+    names = []
+    for other, entry in list(_registry.items()):
+        same_scope = scope is not None and entry.get("scope") == scope and other[:2] == key[:2]
+        if other == key or same_scope or entry["expires_at"] <= now:
+            del _registry[other]
+            if entry["name"] and entry["expires_at"] > now:
+                names.append(entry["name"])
+    return names
+
+
+def _delete(provider, names):
+    for name in names:
+        try:
+            provider.delete(name)
+            _count("deleted")
+        except Exception as e:
+            print(f"Ошибка удаления кэша контекста {name}: {e}")
+
+
+def _lookup(key):
+    """Имя живого кэша, None после недавней ошибки создания, False — кэша нет или он истекает"""
+    with _registry_lock:
+        entry = _registry.get(key)
+        if not entry or entry["expires_at"] - REFRESH_MARGIN <= time.time():
+            return False
+        if entry["name"] is not None:
+            _stats["hits"] += 1
+            _stats["cached_tokens"] += entry["tokens"]
+        return entry["name"]
+
+
+def invalidate(name):
+    """Забывает кэш, который провайдер уже не знает (удален или истек раньше срока)"""
+    with _registry_lock:
+        for key in [key for key, entry in _registry.items() if entry["name"] == name]:
+            del _registry[key]
+
+
+def is_cache_miss(error):
+    """Кэш удален или истек раньше, чем мы ожидали"""
+    text = str(error).lower()
+    return "cachedcontent" in text or "cached content" in text or "cached_content" in text
+
+
+def _merge_system(messages):
+    """Ведущие системные сообщения склеиваются в одно — как их и ожидает модель"""
+    leading = 0
+    while leading < len(messages) and isinstance(messages[leading], SystemMessage):
+        leading += 1
+    if leading < 2:
+        return messages
+    text = "\n\n".join(m.content for m in messages[:leading])
+    return [SystemMessage(content=text)] + messages[leading:]
+
+
+def _without_prefix(messages):
+    """Сообщения для запроса со ссылкой на кэш: стабильный префикс уже у провайдера,
+    остальной системный контекст (краткое содержание, фрагменты) уходит в первое сообщение пользователя"""
+    rest = list(messages[1:])
+    extra = []
+    while rest and isinstance(rest[0], SystemMessage):
+        extra.append(rest.pop(0).content)
+    if not extra:
+        return rest
+    text = "\n\n".join(extra)
+    if rest and isinstance(rest[0], HumanMessage) and isinstance(rest[0].content, str):
+        return [HumanMessage(content=f"{text}\n\n{rest[0].content}")] + rest[1:]
+    return [HumanMessage(content=text)] + rest
+
+
+def prepare(chat_model, messages):
+    """(сообщения для отправки, имя кэша или None). Первое системное сообщение — стабильный префикс.
+    Без живого кэша CacheableMessages отправляются в варианте fallback, без крупного префикса"""
+    if not messages or not isinstance(messages[0], SystemMessage) or not is_available():
+        return _fallback(messages), None
+    name = get_cache_name(getattr(chat_model, "model", ""), messages[0].content, getattr(messages, "scope", None))
+    if name is None:
+        return _fallback(messages), None
+    return _without_prefix(messages), name
+
+
+def invoke(chat_model, messages):
+    """chat_model.invoke со ссылкой на кэш контекста; истекший кэш — повтор с полным промптом"""
+    prepared, name = prepare(chat_model, messages)
+    if name is None:
+        return chat_model.invoke(prepared)
+    try:
+        return chat_model.invoke(prepared, cached_content=name)
+    except Exception as e:
+        if not is_cache_miss(e):
+            raise
+        invalidate(name)
+        _count("fallbacks")
+        return chat_model.invoke(_fallback(messages))
+
+
+def stream(chat_model, messages):
+    """Потоковый вариант invoke: вернуться к полному промпту можно только до первого чанка"""
+    prepared, name = prepare(chat_model, messages)
+    if name is None:
+        yield from chat_model.stream(prepared)
+        return
+    yielded = False
+    try:
+        for chunk in chat_model.stream(prepared, cached_content=name):
+            yielded = True
+            yield chunk
+        return
+    except Exception as e:
+        if yielded or not is_cache_miss(e):
+            raise
+        invalidate(name)
+        _count("fallbacks")
+    yield from chat_model.stream(_fallback(messages))
+
+
+def get_context_cache_stats():
+    with _registry_lock:
+        stats = dict(_stats)
+        stats["active"] = sum(1 for entry in _registry.values() if entry["name"] and entry["expires_at"] > time.time())
+    provider = _provider
+    stats["provider"] = provider.name if provider else None
+    return stats
@@ -0,0 +1,152 @@
+import os
+import base64
+import hashlib
+import subprocess
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import http_client
+
+CACHE_DIR = os.path.join(os.getenv("FORTE_CACHE_DIR", ".cache"), "diagrams")
+CACHE_MAX_BYTES = int(os.getenv("FORTE_DIAGRAM_CACHE_MB", "100")) * 1024 * 1024
+RENDER_WORKERS = int(os.getenv("FORTE_DIAGRAM_WORKERS", "4"))
+RENDER_TIMEOUT = 20
+
+
+class MermaidInkRenderer:
+    """Удаленный рендер через mermaid.ink"""
+    name = "mermaid.ink"
+
+    def __init__(self, base_url="https://mermaid.ink"):
+        self.base_url = base_url.rstrip("/")
+
+    def render(self, code, fmt="png"):
+        encoded = base64.b64encode(code.encode("utf8")).decode("ascii")
+        kind = "img" if fmt == "png" else "svg"
+        response = http_client.get("mermaid", f"{self.base_url}/{kind}/{encoded}")
+        if response.status_code == 200:
+            return response.content
+        print(f"Ошибка генерации Mermaid: {response.status_code}")
+        return None
+
+
+class MermaidCliRenderer:
+    """Локальный рендер через mermaid-cli (mmdc) для закрытого контура"""
+    name = "mmdc"
+
+    def __init__(self, executable="mmdc"):
+        self.executable = executable
+
+    def render(self, code, fmt="png"):
+        with tempfile.TemporaryDirectory() as tmp:
+            source = os.path.join(tmp, "diagram.mmd")
+            target = os.path.join(tmp, f"diagram.{fmt}")
+            with open(source, "w", encoding="utf-8") as f:
+                f.write(code)
+            subprocess.run([self.executable, "-i", source, "-o", target], check=True,
+                           capture_output=True, timeout=RENDER_TIMEOUT)
+            with open(target, "rb") as f:
+                return f.read()
+
+
+class StubRenderer:
+    """Рендер-заглушка для тестов: возвращает заранее заданные байты"""
+    name = "stub"
+
+    def __init__(self, content=b""):
+        self.content = content
+
+    def render(self, code, fmt="png"):
+        return self.content
+
+
+def _default_renderer():
+    kind = os.getenv("FORTE_MERMAID_RENDERER", "mermaid.ink")
+    if kind == "mmdc":
+        return MermaidCliRenderer(os.getenv("FORTE_MMDC_PATH", "mmdc"))
+    if kind == "stub":
+        return StubRenderer()
+    return MermaidInkRenderer(os.getenv("FORTE_MERMAID_INK_URL", "https://mermaid.ink"))
+
+
+_renderer = _default_renderer()
+_cache_lock = threading.Lock()
+
+
+def set_renderer(renderer):
+    """Подменяет бэкенд рендера (локальный mmdc, заглушка в тестах и т.п.)"""
+    global _renderer
+    _renderer = renderer
+
+
+def get_renderer():
+    return _renderer
+
+
+def _cache_path(code, fmt, renderer):
+    key = hashlib.sha256(f"{renderer.name}\0{fmt}\0{code}".encode("utf-8")).hexdigest()
+    return os.path.join(CACHE_DIR, f"{key}.{fmt}")
+
+
+def _evict():
+    # Удаляем самые давно использованные файлы, пока кэш не уложится в лимит
+    entries = []
+    total = 0
+    for entry in os.scandir(CACHE_DIR):
+        if entry.is_file() and not entry.name.endswith(".tmp"):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+    entries.sort()
+    for _, size, path in entries:
+        if total <= CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+
+
+def render_diagram(code, fmt="png"):
+    """Возвращает байты PNG/SVG диаграммы или None. Результат кэшируется на диске по хэшу кода"""
+    renderer = _renderer
+    path = _cache_path(code, fmt, renderer)
+    try:
+        with open(path, "rb") as f:
+            content = f.read()
+        os.utime(path)
+        return content
+    except OSError:
+        pass
+
+    try:
+        content = renderer.render(code, fmt)
+    except Exception as e:
+        print(f"Ошибка генерации Mermaid: {e}")
+        return None
+    if not content:
+        return None
+
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+        with _cache_lock:
+            _evict()
+    except OSError as e:
+        print(f"Ошибка записи кэша диаграмм: {e}")
+    return content
+
+
+def render_diagrams(codes, fmt="png"):
+    """Рендерит все диаграммы документа параллельно; порядок результатов совпадает с codes"""
+    unique = list(dict.fromkeys(codes))
+    if not unique:
+        return []
+    with ThreadPoolExecutor(max_workers=min(RENDER_WORKERS, len(unique))) as executor:
+        rendered = dict(zip(unique, executor.map(lambda code: render_diagram(code, fmt), unique)))
+    return [rendered[code] for code in codes]
@@ -1,16 +1,26 @@
 import markdown
-import requests
 from io import BytesIO
 from docx import Document
 from docx.shared import Pt, RGBColor, Inches
 from docx.enum.text import WD_ALIGN_PARAGRAPH
 from htmldocx import HtmlToDocx
 from xhtml2pdf import pisa
+from PyPDF2 import PdfReader, PdfWriter
+from collections import OrderedDict
+from functools import lru_cache
 import base64
+import hashlib
+import threading
+import time
 import re
 
-# Логотип
-FORTE_LOGO_URL = "https://upload.wikimedia.org/wikipedia/commons/e/e3/Fortebank_Logo.png"
+from utils.assets import get_asset
+from utils.telemetry import traced
+from utils.diagrams import render_diagram, render_diagrams, get_renderer
+
+DOCX_CACHE_SIZE = 32
+# Документ без логотипа или с неотрисованными диаграммами держим недолго, потом пробуем собрать заново
+DOCX_INCOMPLETE_TTL = 60
 
 
 def markdown_to_styled_html(markdown_text, font_name="sans-serif"):
@@ -112,25 +122,79 @@ def markdown_to_styled_html(markdown_text, font_name="sans-serif"):
     return html_template
 
 
-def create_chat_pdf(messages):
-    font_name = 'Arial'
+# Сколько готовых PDF протокола держать в памяти (по одному на версию переписки)
+CHAT_PDF_CACHE_SIZE = 64
+# Начало и конец каждого сообщения помечаются закладками PDF: по ним видно, на каких страницах лежит
+# сообщение. Новая версия протокола переиспользует страницы до последнего сообщения, начавшегося
+# с чистого листа, и перерисовывает только хвост — без лишних разрывов страниц.
+# Метка конца стоит после блока сообщения, чтобы его нижние отступы тоже считались частью сообщения.
+# Сообщение не разрывается между страницами (если помещается на одну), поэтому чистый разрыв есть почти на каждой
+CHAT_MARKER_START = "-pdf-outline: true; -pdf-outline-level: 0;"
+CHAT_MARKER_END = '<div style="-pdf-outline: true; -pdf-outline-level: 0; font-size: 1px; line-height: 1px;">&nbsp;</div>'
+
+_docx_documents = OrderedDict()
+_chat_pdf_documents = OrderedDict()
+_cache_lock = threading.Lock()
+
 
-    chat_body = "<h1>Протокол интервью (Chat Log)</h1>"
+def _lru_get(cache, key):
+    with _cache_lock:
+        value = cache.get(key)
+        if value is not None:
+            cache.move_to_end(key)
+        return value
 
+
+def _lru_put(cache, key, value, max_size=CHAT_PDF_CACHE_SIZE):
+    with _cache_lock:
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > max_size:
+            cache.popitem(last=False)
+
+
+def _chat_digests(messages):
+    """Хэши всех префиксов переписки: [хэш messages[:0], ..., хэш messages[:n]]"""
+    digest = hashlib.sha256()
+    digests = [digest.hexdigest()]
     for msg in messages:
-        role = "Клиент" if msg['role'] == 'user' else "Forte AI"
-        color = "#333" if msg['role'] == 'user' else "#9F2349"
-        bg = "#f9f9f9" if msg['role'] == 'user' else "#fff5f7"
+        digest.update(msg['role'].encode('utf-8'))
+        digest.update(b"\x00")
+        digest.update(msg['content'].encode('utf-8'))
+        digest.update(b"\x01")
+        digests.append(digest.hexdigest())
+    return digests
+
+
+def chat_digest(messages):
+    """Хэш списка сообщений, по которому кэшируется PDF протокола"""
+    return _chat_digests(messages)[-1]
 
-        text_content = markdown.markdown(msg['content'])
 
-        chat_body += f"""
-        <div style="background-color: {bg}; border-left: 4px solid {color}; padding: 10px; margin-bottom: 15px;">
-            <div style="font-weight: bold; color: {color}; margin-bottom: 5px;">{role}</div>
+@lru_cache(maxsize=2048)
+def _chat_message_html(role_name, content):
+    role = "Клиент" if role_name == 'user' else "Forte AI"
+    color = "#333" if role_name == 'user' else "#9F2349"
+    bg = "#f9f9f9" if role_name == 'user' else "#fff5f7"
+
+    text_content = markdown.markdown(content)
+
+    return f"""
+        <div style="background-color: {bg}; border-left: 4px solid {color}; padding: 10px; margin-bottom: 15px; page-break-inside: avoid;">
+            <div style="font-weight: bold; color: {color}; margin-bottom: 5px; {CHAT_MARKER_START}">{role}</div>
             <div style="font-size: 10pt;">{text_content}</div>
         </div>
+        {CHAT_MARKER_END}
         """
 
+
+def _render_chat_pdf(messages, with_title):
+    """Рендерит сообщения с новой страницы: (PdfReader, [(страница начала, страница конца)] или None)"""
+    font_name = 'Arial'
+
+    chat_body = "<h1>Протокол интервью (Chat Log)</h1>" if with_title else ""
+    chat_body += "".join(_chat_message_html(msg['role'], msg['content']) for msg in messages)
+
     full_html = f"""
     <!DOCTYPE html>
     <html>
@@ -140,6 +204,7 @@ def create_chat_pdf(messages):
             @page {{ size: A4; margin: 2cm; }}
             body {{ font-family: '{font_name}', sans-serif; font-size: 11pt; }}
             h1 {{ color: #9F2349; border-bottom: 2px solid #9F2349; }}
+            h1, h2, h3, h4, h5, h6 {{ -pdf-outline: false; }}
         </style>
     </head>
     <body>
@@ -150,37 +215,98 @@ def create_chat_pdf(messages):
 
     buffer = BytesIO()
     pisa.CreatePDF(src=full_html, dest=buffer, encoding='UTF-8')
-    buffer.seek(0)
-    return buffer
+    reader = PdfReader(BytesIO(buffer.getvalue()))
 
+    marks = [reader.get_destination_page_number(item) for item in reader.outline if not isinstance(item, list)]
+    # Разметка не распознана (например, закладки вложены) — такую версию просто не продолжаем
+    layout = list(zip(marks[0::2], marks[1::2])) if len(marks) == 2 * len(messages) else None
+    return reader, layout
+
+
+def _page_break_before(layout):
+    """Индекс последнего сообщения, которое начинается на новой странице, а предыдущее целиком выше"""
+    for index in range(len(layout) - 1, 0, -1):
+        if layout[index][0] > layout[index - 1][1]:
+            return index
+    return None
 
-def get_mermaid_image(mermaid_code):
-    try:
-        full_code = mermaid_code
 
-        graphbytes = full_code.encode("utf8")
-        base64_bytes = base64.b64encode(graphbytes)
-        base64_string = base64_bytes.decode("ascii")
+@traced("export.create_chat_pdf")
+def create_chat_pdf(messages):
+    """PDF протокола одним сплошным документом. Если в кэше есть PDF начала этой переписки,
+    его страницы до последнего чистого разрыва переиспользуются, а перерисовывается только хвост"""
+    digests = _chat_digests(messages)
+    cached = _lru_get(_chat_pdf_documents, digests[-1])
+    if cached is not None:
+        return BytesIO(cached[0])
+
+    prefix = None
+    for count in range(len(messages) - 1, 0, -1):
+        prefix = _lru_get(_chat_pdf_documents, digests[count])
+        if prefix is not None:
+            break
+
+    start = _page_break_before(prefix[1]) if prefix and prefix[1] else None
+    writer = PdfWriter()
+    if start is None:
+        reader, layout = _render_chat_pdf(messages, with_title=True)
+    else:
+        kept_pages = prefix[1][start][0]
+        for page in PdfReader(BytesIO(prefix[0])).pages[:kept_pages]:
+            writer.add_page(page)
+        reader, tail_layout = _render_chat_pdf(messages[start:], with_title=False)
+        layout = prefix[1][:start] + [(first + kept_pages, last + kept_pages) for first, last in tail_layout] \
+            if tail_layout else None
+
+    # Через PdfWriter копируются только страницы: служебные закладки в итоговый файл не попадают
+    for page in reader.pages:
+        writer.add_page(page)
+    buffer = BytesIO()
+    writer.write(buffer)
+    pdf_bytes = buffer.getvalue()
+
+    _lru_put(_chat_pdf_documents, digests[-1], (pdf_bytes, layout))
+    return BytesIO(pdf_bytes)
 
-        url = "https://mermaid.ink/img/" + base64_string
 
-        response = requests.get(url)
-        if response.status_code == 200:
-            return BytesIO(response.content)
-    except Exception as e:
-        print(f"Ошибка генерации Mermaid: {e}")
+@traced("export.get_mermaid_image")
+def get_mermaid_image(mermaid_code):
+    content = render_diagram(mermaid_code)
+    if content:
+        return BytesIO(content)
     return None
 
 
-def create_docx(markdown_text):
+def _mermaid_code(part):
+    return part.replace("```mermaid", "").replace("```", "").strip()
+
+
+@traced("export.create_docx")
+def create_docx(markdown_text, include_logo=True):
+    """Собирает DOCX; готовые байты кэшируются по хэшу текста и параметров экспорта"""
+    options = f"{include_logo}:{get_renderer().name}"
+    document_key = hashlib.sha256(f"{options}\0{markdown_text}".encode('utf-8')).hexdigest()
+    cached = _lru_get(_docx_documents, document_key)
+    if cached is not None and (cached[1] is None or cached[1] > time.time()):
+        return BytesIO(cached[0])
+
+    docx_bytes, complete = _build_docx(markdown_text, include_logo)
+    expires_at = None if complete else time.time() + DOCX_INCOMPLETE_TTL
+    _lru_put(_docx_documents, document_key, (docx_bytes, expires_at), max_size=DOCX_CACHE_SIZE)
+    return BytesIO(docx_bytes)
+
+
+def _build_docx(markdown_text, include_logo):
     doc = Document()
 
-    try:
-        response = requests.get(FORTE_LOGO_URL)
-        if response.status_code == 200:
-            doc.add_picture(BytesIO(response.content), width=Inches(2))
-    except:
-        pass
+    logo = get_asset("forte_logo.png") if include_logo else None
+    logo_added = False
+    if logo:
+        try:
+            doc.add_picture(BytesIO(logo), width=Inches(2))
+            logo_added = True
+        except Exception:
+            pass
 
     title = doc.add_heading('Business Requirements Document', 0)
     title.runs[0].font.color.rgb = RGBColor(159, 35, 73)
@@ -193,13 +319,17 @@ def create_docx(markdown_text):
 
     parts = re.split(r'(```mermaid[\s\S]*?```)', markdown_text)
 
+    # Все диаграммы документа рендерятся параллельно до сборки файла
+    diagram_codes = [_mermaid_code(part) for part in parts if part.strip().startswith("```mermaid")]
+    diagram_contents = render_diagrams(diagram_codes)
+    diagram_images = iter(diagram_contents)
+
     for part in parts:
         if not part.strip(): continue
 
         if part.strip().startswith("```mermaid"):
-            code = part.replace("```mermaid", "").replace("```", "").strip()
-            print("Generating Mermaid image for Word...")
-            img_data = get_mermaid_image(code)
+            content = next(diagram_images)
+            img_data = BytesIO(content) if content else None
 
             if img_data:
                 try:
@@ -226,5 +356,28 @@ def create_docx(markdown_text):
 
     buffer = BytesIO()
     doc.save(buffer)
-    buffer.seek(0)
-    return buffer
\ No newline at end of file
+    return buffer.getvalue(), all(diagram_contents) and (logo_added or not include_logo)
+
+
+@traced("export.create_pdf")
+def create_pdf(markdown_text):
+    """PDF документа в стилях markdown_to_styled_html; диаграммы встраиваются картинками"""
+    parts = re.split(r'(```mermaid[\s\S]*?```)', markdown_text)
+    diagram_codes = [_mermaid_code(part) for part in parts if part.strip().startswith("```mermaid")]
+    diagram_images = iter(render_diagrams(diagram_codes))
+
+    chunks = []
+    for part in parts:
+        if part.strip().startswith("```mermaid"):
+            content = next(diagram_images)
+            if content:
+                encoded = base64.b64encode(content).decode('ascii')
+                chunks.append(f'\n\n<p align="center"><img src="data:image/png;base64,{encoded}" width="450" /></p>\n\n')
+            else:
+                chunks.append("\n\n[Error: Could not generate diagram image]\n\n")
+        else:
+            chunks.append(part)
+
+    buffer = BytesIO()
+    pisa.CreatePDF(src=markdown_to_styled_html("".join(chunks)), dest=buffer, encoding='UTF-8')
+    return BytesIO(buffer.getvalue())
@@ -0,0 +1,144 @@
+import os
+import io
+import hashlib
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+# Модуль импортируется воркерами пула процессов, поэтому тяжелые зависимости подключаются внутри функций
+
+MAX_CHARS = int(os.getenv("FORTE_EXTRACT_MAX_CHARS", "2000000"))
+MAX_PAGES = int(os.getenv("FORTE_EXTRACT_MAX_PAGES", "2000"))
+MAX_WORKERS = int(os.getenv("FORTE_EXTRACT_WORKERS", str(min(4, os.cpu_count() or 1))))
+
+# Страниц в одной задаче пула и минимальный размер PDF, для которого пул вообще нужен
+PAGES_PER_TASK = 8
+PARALLEL_MIN_PAGES = 24
+
+CACHE_DIR = os.path.join(os.getenv("FORTE_CACHE_DIR", ".cache"), "extraction")
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=MAX_WORKERS)
+        return _pool
+
+
+# Разобранный документ в процессе-воркере: файл читается и парсится один раз на воркер, а не на задачу
+_worker_document = {"digest": None, "reader": None}
+
+
+def _worker_reader(path, digest):
+    if _worker_document["digest"] != digest:
+        import PyPDF2
+        with open(path, "rb") as f:
+            data = f.read()
+        _worker_document.update(digest=digest, reader=PyPDF2.PdfReader(io.BytesIO(data)))
+    return _worker_document["reader"]
+
+
+def _extract_pdf_pages(path, digest, start, end):
+    reader = _worker_reader(path, digest)
+    return [(reader.pages[i].extract_text() or "") + "\n" for i in range(start, end)]
+
+
+def _extract_pdf(data, max_chars, max_pages, digest):
+    import PyPDF2
+    reader = PyPDF2.PdfReader(io.BytesIO(data))
+    page_count = min(len(reader.pages), max_pages)
+
+    parts = []
+    size = 0
+    if page_count < PARALLEL_MIN_PAGES or MAX_WORKERS < 2:
+        for i in range(page_count):
+            text = (reader.pages[i].extract_text() or "") + "\n"
+            parts.append(text)
+            size += len(text)
+            if size >= max_chars:
+                break
+        return parts
+
+    # Воркеры получают только путь к временному файлу и диапазон страниц, а не байты PDF в каждой задаче.
+    # В полете держим не больше 2 задач на воркер, результаты забираем строго по порядку страниц
+    pool = _get_pool()
+    ranges = [(start, min(start + PAGES_PER_TASK, page_count)) for start in range(0, page_count, PAGES_PER_TASK)]
+    pending = []
+    next_range = 0
+    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as f:
+        f.write(data)
+        path = f.name
+    try:
+        while next_range < len(ranges) or pending:
+            while next_range < len(ranges) and len(pending) < MAX_WORKERS * 2:
+                start, end = ranges[next_range]
+                pending.append(pool.submit(_extract_pdf_pages, path, digest, start, end))
+                next_range += 1
+
+            for text in pending.pop(0).result():
+                parts.append(text)
+                size += len(text)
+            if size >= max_chars:
+                break
+    finally:
+        for future in pending:
+            future.cancel()
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    return parts
+
+
+def _extract_docx(data, max_chars):
+    from docx import Document
+    doc = Document(io.BytesIO(data))
+    parts = []
+    size = 0
+    for para in doc.paragraphs:
+        parts.append(para.text + "\n")
+        size += len(para.text) + 1
+        if size >= max_chars:
+            break
+    return parts
+
+
+def _cache_path(digest, max_chars, max_pages):
+    return os.path.join(CACHE_DIR, f"{digest}-{max_chars}-{max_pages}.txt")
+
+
+def extract_text(file_name, data, max_chars=MAX_CHARS, max_pages=MAX_PAGES):
+    """Извлекает текст из PDF/DOCX/TXT/MD с ограничением по символам и страницам.
+    Результат кэшируется на диске по SHA-256 содержимого файла."""
+    digest = hashlib.sha256(data).hexdigest()
+    path = _cache_path(digest, max_chars, max_pages)
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            return f.read()
+
+    name = file_name.lower()
+    if name.endswith(".pdf"):
+        parts = _extract_pdf(data, max_chars, max_pages, digest)
+    elif name.endswith(".docx"):
+        parts = _extract_docx(data, max_chars)
+    elif name.endswith(".txt") or name.endswith(".md"):
+        parts = [data.decode("utf-8")]
+    else:
+        parts = []
+
+    text = "".join(parts)[:max_chars]
+
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Ошибка записи кэша извлечения: {e}")
+
+    return text
@@ -0,0 +1,138 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+
+# Бюджет контекста в токенах. Для генерации BRD нужен более подробный контекст, чем для диалога.
+CHAT_TOKEN_BUDGET = int(os.getenv("FORTE_CHAT_TOKEN_BUDGET", "24000"))
+BRD_TOKEN_BUDGET = int(os.getenv("FORTE_BRD_TOKEN_BUDGET", "64000"))
+
+# Сколько последних сообщений всегда передается дословно
+KEEP_RECENT_MESSAGES = int(os.getenv("FORTE_KEEP_RECENT_MESSAGES", "8"))
+
+# Граница свертки двигается шагами, чтобы резюме не пересчитывалось на каждом ходе
+FOLD_STEP = 4
+
+SUMMARY_CACHE_SIZE = 512
+
+SUMMARY_PROMPT = """
+Ты ведешь протокол интервью бизнес-аналитика с заказчиком.
+Обнови краткое содержание диалога с учетом новых сообщений.
+Сохрани все факты, важные для BRD: цели, роли, сценарии, ограничения, интеграции, требования по безопасности, цифры и лимиты.
+Не добавляй ничего от себя. Верни только обновленное краткое содержание.
+
+### ТЕКУЩЕЕ КРАТКОЕ СОДЕРЖАНИЕ
+{summary}
+
+### НОВЫЕ СООБЩЕНИЯ
+{messages}
+"""
+
+# Кэш резюме общий для процесса: ключ — хэш префикса истории, значение — резюме этого префикса
+_summary_cache = OrderedDict()
+_summary_lock = threading.Lock()
+
+
+def estimate_tokens(text):
+    # Грубая оценка без токенайзера: ~4 символа на токен
+    return len(text) // 4 + 1
+
+
+def _prefix_hashes(history):
+    """hashes[i] — хэш первых i сообщений"""
+    hashes = [""]
+    digest = hashlib.sha256()
+    for msg in history:
+        digest.update(msg["role"].encode("utf-8"))
+        digest.update(b"\x00")
+        digest.update(msg["content"].encode("utf-8"))
+        digest.update(b"\x01")
+        hashes.append(digest.copy().hexdigest())
+    return hashes
+
+
+def _get_cached_summary(key):
+    with _summary_lock:
+        summary = _summary_cache.get(key)
+        if summary is not None:
+            _summary_cache.move_to_end(key)
+        return summary
+
+
+def _put_cached_summary(key, summary):
+    with _summary_lock:
+        _summary_cache[key] = summary
+        _summary_cache.move_to_end(key)
+        while len(_summary_cache) > SUMMARY_CACHE_SIZE:
+            _summary_cache.popitem(last=False)
+
+
+def _format_messages(messages):
+    lines = []
+    for msg in messages:
+        role = "Клиент" if msg["role"] == "user" else "Аналитик"
+        lines.append(f"{role}: {msg['content']}")
+    return "\n\n".join(lines)
+
+
+class HistoryManager:
+    """Укладывает историю чата в бюджет токенов: старые сообщения сворачиваются в резюме"""
+
+    def __init__(self, summarize, token_budget=CHAT_TOKEN_BUDGET, keep_recent=KEEP_RECENT_MESSAGES):
+        # summarize(prompt_text) -> str, обычно вызов LLM
+        self.summarize = summarize
+        self.token_budget = token_budget
+        self.keep_recent = keep_recent
+
+    def build(self, history, token_budget=None):
+        """Возвращает (резюме или None, сообщения для дословной передачи)"""
+        budget = token_budget or self.token_budget
+        history = [msg for msg in history if msg["role"] in ("user", "assistant")]
+
+        sizes = [estimate_tokens(msg["content"]) for msg in history]
+        if sum(sizes) <= budget:
+            return None, history
+
+        # Дословно оставляем хвост, который помещается в 3/4 бюджета (но не меньше keep_recent)
+        split = len(history)
+        used = 0
+        while split > 0:
+            size = sizes[split - 1]
+            if len(history) - split >= self.keep_recent and used + size > budget * 3 // 4:
+                break
+            used += size
+            split -= 1
+
+        split -= split % FOLD_STEP
+        if split == 0:
+            return None, history
+
+        try:
+            summary = self._summary_for_prefix(history, split)
+        except Exception as e:
+            print(f"Ошибка сжатия истории: {e}")
+            return None, history
+
+        return summary, history[split:]
+
+    def _summary_for_prefix(self, history, split):
+        hashes = _prefix_hashes(history[:split])
+
+        # Ищем самый длинный уже свернутый префикс и досворачиваем только новые сообщения
+        start, summary = 0, ""
+        for i in range(split, 0, -1):
+            cached = _get_cached_summary(hashes[i])
+            if cached is not None:
+                start, summary = i, cached
+                break
+
+        if start == split:
+            return summary
+
+        prompt = SUMMARY_PROMPT.format(
+            summary=summary or "(пока пусто)",
+            messages=_format_messages(history[start:split])
+        )
+        summary = self.summarize(prompt).strip()
+        _put_cached_summary(hashes[split], summary)
+        return summary
@@ -0,0 +1,97 @@
+import os
+import time
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from utils import telemetry
+
+# (connect, read) таймауты по внешним сервисам
+ENDPOINT_TIMEOUTS = {
+    "confluence": (5, 30),
+    "mermaid": (5, 20),
+    "assets": (5, 10),
+}
+DEFAULT_TIMEOUT = (5, 30)
+
+MAX_RETRIES = int(os.getenv("FORTE_HTTP_RETRIES", "3"))
+POOL_SIZE = int(os.getenv("FORTE_HTTP_POOL_SIZE", "20"))
+
+_session = None
+_session_lock = threading.Lock()
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def _create_session():
+    # Повторяем только идемпотентные методы: POST в Confluence создает страницу
+    retry = Retry(
+        total=MAX_RETRIES,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset({"GET", "HEAD", "PUT", "DELETE", "OPTIONS"}),
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=10, pool_maxsize=POOL_SIZE, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_session():
+    """Общая для процесса сессия requests с пулом keep-alive соединений"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = _create_session()
+        return _session
+
+
+def _record(endpoint, elapsed, error):
+    with _stats_lock:
+        stats = _stats.setdefault(endpoint, {"requests": 0, "errors": 0, "total_time": 0.0, "max_time": 0.0})
+        stats["requests"] += 1
+        stats["total_time"] += elapsed
+        stats["max_time"] = max(stats["max_time"], elapsed)
+        if error:
+            stats["errors"] += 1
+
+
+def get_http_stats():
+    """Счетчики по сервисам: число запросов, ошибок, суммарная и максимальная задержка"""
+    with _stats_lock:
+        result = {}
+        for endpoint, stats in _stats.items():
+            result[endpoint] = dict(stats, avg_time=stats["total_time"] / stats["requests"])
+        return result
+
+
+def request(endpoint, method, url, **kwargs):
+    kwargs.setdefault("timeout", ENDPOINT_TIMEOUTS.get(endpoint, DEFAULT_TIMEOUT))
+    started_at = time.perf_counter()
+    error = True
+    with telemetry.span(f"http.{endpoint}", method=method) as current:
+        try:
+            response = get_session().request(method, url, **kwargs)
+            error = response.status_code >= 400
+            current.set_attribute("status_code", response.status_code)
+            return response
+        finally:
+            _record(endpoint, time.perf_counter() - started_at, error)
+
+
+def get(endpoint, url, **kwargs):
+    return request(endpoint, "GET", url, **kwargs)
+
+
+def post(endpoint, url, **kwargs):
+    return request(endpoint, "POST", url, **kwargs)
+
+
+def put(endpoint, url, **kwargs):
+    return request(endpoint, "PUT", url, **kwargs)
@@ -0,0 +1,96 @@
+import os
+import time
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Фоновые задачи общие для процесса: результат переживает rerun и переподключение браузера
+MAX_WORKERS = int(os.getenv("FORTE_JOB_WORKERS", "2"))
+MAX_PENDING = int(os.getenv("FORTE_JOB_MAX_PENDING", "20"))
+JOB_TTL = 3600
+
+_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="forte-job")
+_jobs = {}
+_jobs_lock = threading.Lock()
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+def _cleanup():
+    now = time.time()
+    for job_id, job in list(_jobs.items()):
+        if job["finished_at"] and now - job["finished_at"] > JOB_TTL:
+            del _jobs[job_id]
+
+
+def _run(job_id, fn, args, on_done):
+    def progress(message):
+        with _jobs_lock:
+            _jobs[job_id]["progress"].append(message)
+
+    with _jobs_lock:
+        _jobs[job_id]["status"] = "running"
+        _jobs[job_id]["started_at"] = time.time()
+
+    try:
+        result = fn(*args, on_status_update=progress)
+        if on_done:
+            on_done(result)
+        with _jobs_lock:
+            _jobs[job_id].update(status="done", result=result)
+    except Exception as e:
+        print(f"Ошибка фоновой задачи {job_id}: {e}")
+        with _jobs_lock:
+            _jobs[job_id].update(status="error", error=str(e))
+    finally:
+        with _jobs_lock:
+            _jobs[job_id]["finished_at"] = time.time()
+
+
+def submit_job(session_id, kind, fn, *args, on_done=None):
+    """Ставит fn(*args, on_status_update=...) в очередь и возвращает ID задачи.
+    Если для сессии такая задача уже выполняется, возвращает ее ID"""
+    with _jobs_lock:
+        _cleanup()
+        active = [job for job in _jobs.values() if job["status"] in ("queued", "running")]
+        for job in active:
+            if job["session_id"] == session_id and job["kind"] == kind:
+                return job["id"]
+        if len(active) >= MAX_PENDING:
+            raise JobQueueFull("Слишком много задач в очереди, попробуйте позже")
+
+        job_id = str(uuid.uuid4())
+        _jobs[job_id] = {
+            "id": job_id,
+            "session_id": session_id,
+            "kind": kind,
+            "status": "queued",
+            "progress": [],
+            "result": None,
+            "error": None,
+            "created_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+        }
+
+    _executor.submit(_run, job_id, fn, args, on_done)
+    return job_id
+
+
+def get_job(job_id):
+    """Снимок состояния задачи (копия), либо None"""
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        return dict(job, progress=list(job["progress"])) if job else None
+
+
+def find_job(session_id, kind):
+    """Последняя задача данного типа для сессии — чтобы подхватить ее после переподключения"""
+    with _jobs_lock:
+        jobs = [job for job in _jobs.values() if job["session_id"] == session_id and job["kind"] == kind]
+        if not jobs:
+            return None
+        job = max(jobs, key=lambda j: j["created_at"])
+        return dict(job, progress=list(job["progress"]))
@@ -0,0 +1,155 @@
+import os
+import re
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+
+from langchain_core.messages import AIMessage
+
+ENABLED = os.getenv("FORTE_LLM_CACHE", "1") == "1"
+CACHE_PATH = os.path.join(os.getenv("FORTE_CACHE_DIR", ".cache"), "llm_cache.sqlite3")
+MAX_BYTES = int(os.getenv("FORTE_LLM_CACHE_MB", "200")) * 1024 * 1024
+MAX_AGE = int(os.getenv("FORTE_LLM_CACHE_MAX_AGE_DAYS", "30")) * 24 * 3600
+
+_stats = {"hits": 0, "misses": 0, "writes": 0, "evictions": 0}
+_stats_lock = threading.Lock()
+_init_lock = threading.Lock()
+_initialized = False
+
+
+def _connect():
+    global _initialized
+    os.makedirs(os.path.dirname(CACHE_PATH) or ".", exist_ok=True)
+    conn = sqlite3.connect(CACHE_PATH, timeout=10)
+    with _init_lock:
+        if not _initialized:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    model TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at_idx ON responses (accessed_at)")
+            conn.commit()
+            _initialized = True
+    return conn
+
+
+def _count(name, value=1):
+    with _stats_lock:
+        _stats[name] += value
+
+
+def _normalize_content(content):
+    if isinstance(content, str):
+        return re.sub(r"\s+", " ", content).strip()
+    return json.dumps(content, ensure_ascii=False, sort_keys=True)
+
+
+def make_key(model, temperature, messages):
+    """Ключ кэша: модель, температура и хэш нормализованной истории (включая системный промпт)"""
+    digest = hashlib.sha256(f"{model}\0{temperature}".encode("utf-8"))
+    for message in messages:
+        digest.update(b"\0")
+        digest.update(message.type.encode("utf-8"))
+        digest.update(b"\0")
+        digest.update(_normalize_content(message.content).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def get(key):
+    now = time.time()
+    try:
+        conn = _connect()
+        try:
+            row = conn.execute("SELECT content, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row and now - row[1] > MAX_AGE:
+                conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                conn.commit()
+                _count("evictions")
+                row = None
+            if row:
+                conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+                conn.commit()
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        print(f"Ошибка чтения кэша LLM: {e}")
+        row = None
+
+    _count("hits" if row else "misses")
+    return row[0] if row else None
+
+
+def put(key, model, content):
+    now = time.time()
+    size = len(content.encode("utf-8"))
+    try:
+        conn = _connect()
+        try:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, model, content, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model, content, size, now, now)
+            )
+            _evict(conn, now)
+            conn.commit()
+        finally:
+            conn.close()
+        _count("writes")
+    except sqlite3.Error as e:
+        print(f"Ошибка записи кэша LLM: {e}")
+
+
+def _evict(conn, now):
+    evicted = conn.execute("DELETE FROM responses WHERE created_at < ?", (now - MAX_AGE,)).rowcount
+    total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+    if total > MAX_BYTES:
+        # Удаляем давно не использованные ответы, пока не уложимся в лимит
+        rows = conn.execute("SELECT key, size FROM responses ORDER BY accessed_at").fetchall()
+        stale = []
+        for key, size in rows:
+            if total <= MAX_BYTES:
+                break
+            stale.append((key,))
+            total -= size
+        conn.executemany("DELETE FROM responses WHERE key = ?", stale)
+        evicted += len(stale)
+    if evicted:
+        _count("evictions", evicted)
+
+
+def get_cache_stats():
+    with _stats_lock:
+        stats = dict(_stats)
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+    return stats
+
+
+def model_key(chat_model, messages):
+    return make_key(getattr(chat_model, "model", ""), getattr(chat_model, "temperature", None), messages)
+
+
+def cached_invoke(chat_model, messages, use_cache=True, invoke=None):
+    """chat_model.invoke с кэшем ответов. use_cache=False — отказ от кэша на конкретном вызове.
+    invoke(chat_model, messages) заменяет сам вызов модели (например, со ссылкой на кэш контекста)"""
+    call = invoke or (lambda model, msgs: model.invoke(msgs))
+    if not (ENABLED and use_cache):
+        return call(chat_model, messages)
+
+    key = model_key(chat_model, messages)
+    content = get(key)
+    if content is not None:
+        return AIMessage(content=content)
+
+    response = call(chat_model, messages)
+    if isinstance(response.content, str) and response.content:
+        put(key, getattr(chat_model, "model", ""), response.content)
+    return response
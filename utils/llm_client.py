@@ -0,0 +1,229 @@
+import os
+import time
+import threading
+from contextlib import nullcontext
+
+from langchain_google_genai import ChatGoogleGenerativeAI
+
+from utils.llm_cache import cached_invoke
+from utils import telemetry
+from utils import context_cache
+
+DEFAULT_MODEL = "gemini-2.5-pro"
+DEFAULT_TEMPERATURE = 0.3
+# Повторы внутри клиента Gemini: каждый ждет полный таймаут, поэтому по умолчанию один —
+# дальше срабатывает переход на другой уровень модели
+MAX_RETRIES = int(os.getenv("FORTE_LLM_MAX_RETRIES", "1"))
+
+# Клиенты моделей общие для процесса: ключ — (модель, температура, таймаут)
+_models = {}
+_models_lock = threading.Lock()
+_model_factory = None
+_api_key = None
+
+
+def resolve_api_key():
+    """GOOGLE_API_KEY из окружения или st.secrets; вычисляется один раз на процесс"""
+    global _api_key
+    if _api_key:
+        return _api_key
+
+    api_key = os.getenv("GOOGLE_API_KEY")
+    if not api_key:
+        try:
+            import streamlit as st
+            if "GOOGLE_API_KEY" in st.secrets:
+                api_key = st.secrets["GOOGLE_API_KEY"]
+        except Exception:
+            pass
+    if not api_key:
+        raise ValueError("Не найден GOOGLE_API_KEY")
+
+    _api_key = api_key
+    return api_key
+
+
+def set_chat_model_factory(factory):
+    """Подменяет создание клиентов моделей (фейковая модель в бенчмарках и т.п.).
+    factory(model, temperature, timeout) возвращает объект с invoke/stream; None — Gemini"""
+    global _model_factory
+    with _models_lock:
+        _model_factory = factory
+        _models.clear()
+
+
+def get_chat_model(model=DEFAULT_MODEL, temperature=DEFAULT_TEMPERATURE, timeout=None):
+    """Потокобезопасно возвращает общий клиент модели, создавая его при первом обращении"""
+    key = (model, temperature, timeout)
+    with _models_lock:
+        chat_model = _models.get(key)
+        if chat_model is None and _model_factory is not None:
+            chat_model = _models[key] = _model_factory(model, temperature, timeout)
+        if chat_model is None:
+            chat_model = ChatGoogleGenerativeAI(
+                model=model,
+                temperature=temperature,
+                timeout=timeout,
+                max_retries=MAX_RETRIES,
+                google_api_key=resolve_api_key(),
+                convert_system_message_to_human=True
+            )
+            _models[key] = chat_model
+        return chat_model
+
+
+# Уровни моделей: быстрый для диалога и служебных задач, pro — для документов
+MODEL_TIERS = {
+    "fast": {
+        "model": os.getenv("FORTE_MODEL_FAST", "gemini-2.5-flash"),
+        "timeout": float(os.getenv("FORTE_TIMEOUT_FAST", "60")),
+    },
+    "pro": {
+        "model": os.getenv("FORTE_MODEL_PRO", DEFAULT_MODEL),
+        "timeout": float(os.getenv("FORTE_TIMEOUT_PRO", "300")),
+    },
+}
+
+# На какой уровень уйти, если модель не ответила за отведенное время
+FALLBACK_TIERS = {
+    "fast": "pro",
+    "pro": "fast",
+}
+
+# Маршрут задачи по умолчанию; переопределяется переменной FORTE_ROUTE_<ЗАДАЧА>=fast|pro
+TASK_ROUTES = {
+    "chat": "fast",
+    "transcribe": "fast",
+    "summarize": "fast",
+    "brd_draft": "pro",
+    "brd_section": "pro",
+    "brd_consistency": "pro",
+    "brd_critique": "pro",
+}
+
+_route_stats = {}
+_route_stats_lock = threading.Lock()
+
+# Общий предел одновременных запросов к модели (0 — без ограничения)
+MAX_CONCURRENCY = int(os.getenv("FORTE_LLM_MAX_CONCURRENCY", "0"))
+_concurrency = threading.BoundedSemaphore(MAX_CONCURRENCY) if MAX_CONCURRENCY else None
+
+
+def set_max_concurrency(limit):
+    """Ограничивает число одновременных вызовов модели в процессе (пакетный режим и т.п.)"""
+    global _concurrency
+    _concurrency = threading.BoundedSemaphore(limit) if limit else None
+
+
+def _slot():
+    return _concurrency or nullcontext()
+
+
+def tier_for_task(task):
+    tier = os.getenv(f"FORTE_ROUTE_{task.upper()}", TASK_ROUTES.get(task, "pro"))
+    return tier if tier in MODEL_TIERS else "pro"
+
+
+def get_tier_model(tier):
+    config = MODEL_TIERS[tier]
+    return get_chat_model(config["model"], DEFAULT_TEMPERATURE, config["timeout"])
+
+
+def model_for_task(task):
+    return get_tier_model(tier_for_task(task))
+
+
+def _is_timeout(error):
+    name = type(error).__name__
+    return isinstance(error, TimeoutError) or "Timeout" in name or "DeadlineExceeded" in name
+
+
+def _record_route(task, tier, elapsed, error=False, fallback=False):
+    with _route_stats_lock:
+        stats = _route_stats.setdefault(f"{task}:{tier}", {
+            "calls": 0, "errors": 0, "fallbacks": 0, "total_time": 0.0, "max_time": 0.0
+        })
+        stats["calls"] += 1
+        stats["total_time"] += elapsed
+        stats["max_time"] = max(stats["max_time"], elapsed)
+        if error:
+            stats["errors"] += 1
+        if fallback:
+            stats["fallbacks"] += 1
+
+
+def get_route_stats():
+    """Задержки по маршрутам "задача:уровень": вызовы, ошибки, переходы на запасной уровень"""
+    with _route_stats_lock:
+        return {
+            route: dict(stats, avg_time=stats["total_time"] / stats["calls"])
+            for route, stats in _route_stats.items()
+        }
+
+
+def _prompt_chars(messages):
+    return sum(len(m.content) if isinstance(m.content, str) else len(str(m.content)) for m in messages)
+
+
+def _invoke_tier(task, tier, messages, use_cache):
+    with _slot(), telemetry.span("llm.invoke", task=task, tier=tier, prompt_chars=_prompt_chars(messages)) as current:
+        response = cached_invoke(get_tier_model(tier), messages, use_cache=use_cache, invoke=context_cache.invoke)
+        current.set_attribute("response_chars", len(response.content) if isinstance(response.content, str) else 0)
+        return response
+
+
+def invoke(task, messages, use_cache=True):
+    """Вызов модели уровня, назначенного задаче; при таймауте — один повтор на запасном уровне"""
+    tier = tier_for_task(task)
+    started_at = time.perf_counter()
+    try:
+        response = _invoke_tier(task, tier, messages, use_cache)
+        _record_route(task, tier, time.perf_counter() - started_at)
+        return response
+    except Exception as e:
+        fallback = FALLBACK_TIERS.get(tier)
+        _record_route(task, tier, time.perf_counter() - started_at, error=True, fallback=bool(fallback and _is_timeout(e)))
+        if not fallback or not _is_timeout(e):
+            raise
+        print(f"⚠️ Таймаут модели уровня {tier} для задачи {task}, переключаюсь на {fallback}")
+
+    started_at = time.perf_counter()
+    response = _invoke_tier(task, fallback, messages, use_cache)
+    _record_route(task, fallback, time.perf_counter() - started_at)
+    return response
+
+
+def _stream_tier(task, tier, messages):
+    with _slot(), telemetry.span("llm.stream", task=task, tier=tier, prompt_chars=_prompt_chars(messages)) as current:
+        response_chars = 0
+        for chunk in context_cache.stream(get_tier_model(tier), messages):
+            if "ttft" not in current.attributes:
+                current.set_attribute("ttft", current.duration)
+            response_chars += len(chunk.content) if isinstance(chunk.content, str) else 0
+            yield chunk
+        current.set_attribute("response_chars", response_chars)
+
+
+def stream(task, messages):
+    """Потоковый вызов; на запасной уровень переходим, только если не успели отдать ни одного чанка"""
+    tier = tier_for_task(task)
+    started_at = time.perf_counter()
+    yielded = False
+    try:
+        for chunk in _stream_tier(task, tier, messages):
+            yielded = True
+            yield chunk
+        _record_route(task, tier, time.perf_counter() - started_at)
+        return
+    except Exception as e:
+        fallback = FALLBACK_TIERS.get(tier)
+        can_fallback = bool(fallback) and _is_timeout(e) and not yielded
+        _record_route(task, tier, time.perf_counter() - started_at, error=True, fallback=can_fallback)
+        if not can_fallback:
+            raise
+        print(f"⚠️ Таймаут модели уровня {tier} для задачи {task}, переключаюсь на {fallback}")
+
+    started_at = time.perf_counter()
+    for chunk in _stream_tier(task, fallback, messages):
+        yield chunk
+    _record_route(task, fallback, time.perf_counter() - started_at)
@@ -1,46 +1,71 @@
 import os
 import re
 import base64
-import streamlit as st
-from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_core.messages import HumanMessage, SystemMessage, AIMessage
-import PyPDF2
-from docx import Document
 import uuid
-from supabase import create_client, Client
+import time
+import threading
 from datetime import date
-
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-SUPABASE_KEY = os.getenv("SUPABASE_KEY")
-
-supabase: Client = None
-if SUPABASE_URL and SUPABASE_KEY:
-    try:
-        supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
-    except Exception as e:
-        print(f"⚠️ Ошибка инициализации Supabase: {e}")
-else:
-    print("⚠️ Supabase ключи не найдены. История не будет сохраняться.")
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from utils import llm_client
+from utils import llm_cache
+from utils.history import HistoryManager, BRD_TOKEN_BUDGET
+from utils.extraction import extract_text
+from utils.audio import prepare_audio, audio_digest
+from utils.brd_lint import lint_brd, format_violations, split_sections, replace_sections
+from utils.retrieval import get_document_index, format_context, CHAT_TOP_K, BRD_TOP_K
+from utils.storage import get_storage
+from utils import telemetry
+from utils import context_cache
 
 def process_uploaded_file(uploaded_file):
     try:
-        text = ""
-        if uploaded_file.name.endswith('.pdf'):
-            pdf_reader = PyPDF2.PdfReader(uploaded_file)
-            for page in pdf_reader.pages:
-                text += page.extract_text() + "\n"
-        elif uploaded_file.name.endswith('.docx'):
-            doc = Document(uploaded_file)
-            for para in doc.paragraphs:
-                text += para.text + "\n"
-        elif uploaded_file.name.endswith('.txt') or uploaded_file.name.endswith('.md'):
-            text = uploaded_file.read().decode("utf-8")
-        return text
+        return extract_text(uploaded_file.name, uploaded_file.getvalue())
     except Exception as e:
         return f"Ошибка чтения файла: {e}"
 
+FILE_MESSAGE_MARKER = "СИСТЕМА: ПОЛЬЗОВАТЕЛЬ ЗАГРУЗИЛ ФАЙЛ"
+
+# Сколько символов документа показывается в самом сообщении чата
+FILE_PREVIEW_CHARS = 1500
+
+
+FILE_NAME_RE = re.compile(re.escape(FILE_MESSAGE_MARKER) + r"\s+'([^']*)'")
+
+
+def classify_message(msg):
+    """Один раз определяет тип сообщения (обычное или загрузка файла) и присваивает ему ID"""
+    msg.setdefault("id", str(uuid.uuid4()))
+    if "kind" not in msg:
+        head = msg["content"][:300]
+        if FILE_MESSAGE_MARKER in head:
+            msg["kind"] = "file"
+            match = FILE_NAME_RE.search(head)
+            msg["file_name"] = match.group(1) if match else "документ"
+        else:
+            msg["kind"] = "text"
+    return msg
+
+
+def make_message(role, content):
+    return classify_message({"role": role, "content": content})
+
+
+def _chunk_text(chunk):
+    content = chunk.content
+    if isinstance(content, list):
+        return "".join(part.get("text", "") if isinstance(part, dict) else str(part) for part in content)
+    return content or ""
+
+
 TODAY = date.today()
 
+BRD_GENERATION_MODE = os.getenv("FORTE_BRD_MODE", "sections")
+BRD_SECTION_WORKERS = int(os.getenv("FORTE_BRD_SECTION_WORKERS", "7"))
+AUDIO_WORKERS = int(os.getenv("FORTE_AUDIO_WORKERS", "4"))
+
 BASE_SYSTEM_PROMPT = """
 Ты — Senior Business Analyst в банке ForteBank.
 Твоя задача — создавать полную техническую документацию (BRD), сочетающую бизнесовый (Agile) и технический (Waterfall) подходы.
@@ -71,16 +96,17 @@ BEHAVIOR_INSTRUCTIONS = """
 3. **Output:** Не генерируй документ, пока не получишь команду SYSTEM_GENERATE.
 """
 
-GENERATION_PROMPT = f"""
-КОМАНДА: SYSTEM_GENERATE.
-
-Сформируй документ BRD, строго следуя шаблону ниже.
-
+BRD_HEADER = f"""
 # Business Requirements Document (BRD): [Название проекта]
 **Проект:** [Название]
 **Дата:** {TODAY}
 **Автор:** Forte AI Analyst
 
+"""
+
+# Разделы шаблона BRD в порядке документа: (ключ, короткое название, шаблон)
+BRD_SECTIONS = [
+    ("intro", "1 Введение", """
 ## 1. Введение
 ### 1.1. Бизнес-цель
 (Зачем мы это делаем? Ожидаемый эффект)
@@ -88,7 +114,8 @@ GENERATION_PROMPT = f"""
 ### 1.2. Границы проекта (Scope)
 * **Входит в MVP:** ...
 * **Не входит в MVP:** ...
-
+"""),
+    ("user_stories", "2 User Stories", """
 ## 2. Пользовательские истории (User Stories)
 *Опиши потребности пользователей в формате Agile.*
 
@@ -97,7 +124,8 @@ GENERATION_PROMPT = f"""
 | US.001 | [Роль] | ... | ... |
 | US.002 | [Роль] | ... | ... |
 *(Добавь минимум 3-5 историй)*
-
+"""),
+    ("fr", "3 FR", """
 ## 3. Функциональные требования (Functional Requirements)
 *Техническая детализация требований. Каждое требование должно иметь уникальный ID (FR.xxx).*
 
@@ -105,26 +133,30 @@ GENERATION_PROMPT = f"""
 * **FR.002:** При нажатии кнопки X, система выполняет Y...
 * **FR.003:** [Опиши валидацию полей]...
 * **FR.004:** [Опиши логику обработки]...
-
+"""),
+    ("processes", "4 Процессы", """
 ## 4. Логика и Процессы
 ### 4.1. Основной сценарий (Happy Path)
 (Пошаговое описание)
 
 ### 4.2. Обработка ошибок (Edge Cases)
 (Что делать, если сервис недоступен?)
-
+"""),
+    ("security", "5 Security", """
 ## 5. KPI по Безопасности и Compliance (ОБЯЗАТЕЛЬНО)
 * **Аутентификация:** (2FA, FaceID, SMS для сумм > 50 000 KZT)
 * **Разграничение доступа (RBAC):** (Роли, матрицы доступа)
 * **Защита данных:** (Шифрование TLS 1.2+, маскирование PAN/PII)
 * **Лимиты и Антифрод:** (Ограничения сумм, проверка дублей)
 * **Логирование:** (Аудит-лог действий)
-
+"""),
+    ("nfr", "6 NFR", """
 ## 6. Нефункциональные требования (NFR)
 * **NFR.001 (Производительность):** Время отклика API не более 3 секунд.
 * **NFR.002 (Доступность):** SLA 99.9%.
 * **NFR.003 (Масштабируемость):** ...
-
+"""),
+    ("diagram", "7 Mermaid", """
 ## 7. Диаграмма процесса (Mermaid State Diagram)
 Вставь код диаграммы ниже. Используй **stateDiagram-v2**.
 
@@ -140,159 +172,385 @@ stateDiagram-v2
     Init --> Process : Start
     Process --> Success : OK
 ```
+"""),
+]
+
+GENERATION_PROMPT = f"""
+КОМАНДА: SYSTEM_GENERATE.
+
+Сформируй документ BRD, строго следуя шаблону ниже.
+
+{BRD_HEADER}
+{"".join(template for _, _, template in BRD_SECTIONS)}"""
+
+SECTION_PROMPT = """
+КОМАНДА: SYSTEM_GENERATE_SECTION.
+
+Сформируй ТОЛЬКО указанный раздел документа BRD, строго следуя шаблону ниже.
+Начни сразу с заголовка раздела. Не пиши другие разделы, вступления и пояснения.
+
+{template}"""
+
+CONSISTENCY_PROMPT = """
+[РЕЖИМ СВЕРКИ]
+Ты — Lead Architect. Документ ниже собран из разделов, написанных независимо.
+Проверь, что разделы согласованы между собой:
+1. Одинаковое название проекта и терминология во всех разделах.
+2. Сквозная нумерация US.xxx, FR.xxx, NFR.xxx без дублей.
+3. Процессы (раздел 4) и диаграмма (раздел 7) не противоречат FR.
+
+Не переписывай документ целиком. Верни ТОЛЬКО те разделы, которые нужно поправить,
+каждый целиком, начиная с заголовка `## N. ...`. Если противоречий нет, верни пустой блок.
+
+🔴 ОТВЕТ В МАРКЕРАХ:
+___START_DOCUMENT___
+...исправленные разделы...
+___END_DOCUMENT___
+
+ДОКУМЕНТ:
+{document}
 """
 
 CRITIQUE_PROMPT = """
 [РЕЖИМ САМОКРИТИКИ]
-Ты — Lead Architect. Проверь документ.
+Ты — Lead Architect. Автоматическая проверка нашла нарушения в документе BRD.
+
+НАРУШЕНИЯ:
+{violations}
 
-1. **User Stories:** Есть ли раздел 2 с User Stories?
-2. **FR/NFR:** Используются ли коды FR.xxx и NFR.xxx?
-3. **Безопасность:** Заполнен ли раздел 5?
-4. **Mermaid:** Проверь синтаксис `stateDiagram-v2`.
+Исправь только перечисленные разделы, не меняя их смысл. Отсутствующие разделы напиши по шаблону,
+опираясь только на факты из диалога выше; чего нет в диалоге — не придумывай.
+Верни каждый раздел целиком, начиная с заголовка `## N. ...`.
 
-🔴 ВЕРНИ ТОЛЬКО ИСПРАВЛЕННЫЙ ТЕКСТ ДОКУМЕНТА В МАРКЕРАХ:
+🔴 ВЕРНИ ТОЛЬКО ИСПРАВЛЕННЫЕ РАЗДЕЛЫ В МАРКЕРАХ:
 ___START_DOCUMENT___
 ...текст...
 ___END_DOCUMENT___
+
+РАЗДЕЛЫ:
+{sections}
 """
 
 
-class BusinessAnalystAI:
-    def __init__(self, template_type="Новый продукт (MVP)", session_id=None):
-        api_key = os.getenv("GOOGLE_API_KEY")
-        if not api_key and "GOOGLE_API_KEY" in st.secrets:
-            api_key = st.secrets["GOOGLE_API_KEY"]
-        if not api_key:
-            raise ValueError("Не найден GOOGLE_API_KEY")
-
-        self.chat_model = ChatGoogleGenerativeAI(
-            model="gemini-2.5-pro",
-            temperature=0.3,
-            google_api_key=api_key,
-            convert_system_message_to_human=True
-        )
+SESSIONS_PAGE_SIZE = 20
+SESSIONS_CACHE_TTL = 60
 
-        specific_instruction = PROMPT_TEMPLATES.get(template_type, PROMPT_TEMPLATES["Новый продукт (MVP)"])
-        self.full_system_prompt = f"{BASE_SYSTEM_PROMPT}\n\n### РЕЖИМ РАБОТЫ: {template_type}\n{specific_instruction}\n\n{BEHAVIOR_INSTRUCTIONS}"
+# Кэш каталога сессий общий для процесса: (хранилище, user_id, поиск, курсор, размер) -> (истекает, результат)
+_sessions_cache = {}
+_sessions_cache_lock = threading.Lock()
 
-        self.session_id = session_id if session_id else str(uuid.uuid4())
 
-    def save_message_to_db(self, role, content):
-        """Сохраняет или обновляет массив сообщений в Supabase"""
-        if supabase:
-            try:
-                response = supabase.table("chat_sessions").select("messages").eq("id", self.session_id).execute()
-
-                current_messages = []
-                if response.data:
-                    current_messages = response.data[0].get("messages", [])
-
-                title_update = {}
-                if len(current_messages) == 0 and role == 'user':
-                    clean_title = content.replace("#", "").replace("*", "").strip()[:40]
-                    title_update = {"title": clean_title + "..."}
-
-                new_message = {
-                    "role": role,
-                    "content": content,
-                    "timestamp": str(uuid.uuid4())
-                }
-                current_messages.append(new_message)
+def invalidate_sessions_cache(user_id=None):
+    with _sessions_cache_lock:
+        for key in [key for key in _sessions_cache if key[1] == user_id]:
+            del _sessions_cache[key]
 
-                data = {
-                    "id": self.session_id,
-                    "messages": current_messages,
-                    **title_update
-                }
-                supabase.table("chat_sessions").upsert(data).execute()
 
-            except Exception as e:
-                print(f"Ошибка сохранения в Supabase: {e}")
+@lru_cache(maxsize=None)
+def build_system_prompt(template_type):
+    specific_instruction = PROMPT_TEMPLATES.get(template_type, PROMPT_TEMPLATES["Новый продукт (MVP)"])
+    return f"{BASE_SYSTEM_PROMPT}\n\n### РЕЖИМ РАБОТЫ: {template_type}\n{specific_instruction}\n\n{BEHAVIOR_INSTRUCTIONS}"
+
+
+class BusinessAnalystAI:
+    def __init__(self, template_type="Новый продукт (MVP)", session_id=None, user_id=None, storage=None):
+        # Объект сессии легкий: клиенты моделей общие для процесса (llm_client),
+        # промпт режима вычисляется один раз
+        llm_client.resolve_api_key()
+        self.template_type = template_type
+        self.full_system_prompt = build_system_prompt(template_type)
+
+        self.session_id = session_id if session_id else str(uuid.uuid4())
+        self.user_id = user_id
+        self.storage = storage or get_storage()
+        self._session_exists = session_id is not None
+        if session_id:
+            self._check_owner()
+
+        self._pending_messages = []
+        self._pending_lock = threading.Lock()
+
+        self.turn_metrics = []
+
+        self.history_manager = HistoryManager(self._summarize)
+        # Для существующей сессии документы без локальной копии подтягиваются из хранилища
+        self.documents = get_document_index(self.session_id,
+                                            loader=self._load_uploads if self._session_exists else None)
+        self._prefix_cache = (0, None)
+
+    def _check_owner(self):
+        """Чужую сессию (ID из ссылки) открыть нельзя; несуществующий ID — просто новая сессия.
+        Если хранилище недоступно, бот все равно создается: загрузка истории обработает ошибку сама"""
+        try:
+            with telemetry.span("storage.get_session", backend=self.storage.name):
+                session = self.storage.get_session(self.session_id)
+        except Exception as e:
+            print(f"Ошибка проверки владельца сессии ({self.storage.name}): {e}")
+            return
+        if session is None:
+            self._session_exists = False
+        elif session.get("user_id") != self.user_id:
+            raise PermissionError("Сессия принадлежит другому пользователю")
+
+    def save_message_to_db(self, role, content, flush=True):
+        """Ставит сообщение в очередь записи. flush=False копит его до следующей отправки"""
+        with self._pending_lock:
+            self._pending_messages.append({"role": role, "content": content})
+        if flush:
+            self.flush_messages()
+
+    def flush_messages(self):
+        """Отправляет накопленные сообщения в хранилище одним пакетом (append-only)"""
+        with self._pending_lock:
+            batch, self._pending_messages = self._pending_messages, []
+        if not batch:
+            return
+
+        title = None
+        for msg in batch:
+            if msg["role"] == "user":
+                clean_title = msg["content"].replace("#", "").replace("*", "").strip()[:40]
+                title = clean_title + "..."
+                break
+
+        try:
+            with telemetry.span("storage.append_messages", backend=self.storage.name, messages=len(batch)):
+                self.storage.append_messages(self.session_id, title, batch, user_id=self.user_id)
+        except Exception as e:
+            print(f"Ошибка сохранения истории ({self.storage.name}): {e}")
+            return
+
+        # Сессия поднялась в начало каталога (или впервые в нем появилась) — кэш каталога устарел
+        invalidate_sessions_cache(self.user_id)
 
     def load_history_from_db(self):
-        if supabase:
-            try:
-                response = supabase.table("chat_sessions").select("messages").eq("id", self.session_id).execute()
-                if response.data:
-                    return response.data[0].get("messages", [])
-            except Exception as e:
-                print(f"Ошибка загрузки из Supabase: {e}")
+        try:
+            with telemetry.span("storage.load_history", backend=self.storage.name) as current:
+                history = self.storage.load_history(self.session_id)
+                current.set_attribute("messages", len(history))
+            return [classify_message(msg) for msg in history]
+        except Exception as e:
+            print(f"Ошибка загрузки истории ({self.storage.name}): {e}")
         return []
 
-    def get_user_sessions(self):
-        if supabase:
-            try:
-                response = supabase.table("chat_sessions") \
-                    .select("id, title, created_at") \
-                    .order("created_at", desc=True) \
-                    .limit(20) \
-                    .execute()
-                return response.data
-            except Exception as e:
-                print(f"Ошибка получения списка сессий: {e}")
-        return []
+    def save_document_to_db(self, document):
+        """Сохраняет сформированный BRD вместе с сессией. Возвращает True, если запись удалась"""
+        try:
+            with telemetry.span("storage.save_document", backend=self.storage.name):
+                self.storage.save_document(self.session_id, document)
+            return True
+        except Exception as e:
+            print(f"Ошибка сохранения документа ({self.storage.name}): {e}")
+            return False
+
+    def load_document_from_db(self):
+        try:
+            with telemetry.span("storage.load_document", backend=self.storage.name):
+                return self.storage.load_document(self.session_id)
+        except Exception as e:
+            print(f"Ошибка загрузки документа ({self.storage.name}): {e}")
+        return None
+
+    def get_user_sessions(self, search=None, cursor=None, limit=SESSIONS_PAGE_SIZE):
+        """Страница каталога сессий пользователя: (сессии, курсор следующей страницы или None).
+        Сортировка по времени последнего сообщения, пагинация по ключу (updated_at, id)"""
+        cache_key = (self.storage.name, self.user_id, search or "", cursor, limit)
+        now = time.time()
+        with _sessions_cache_lock:
+            cached = _sessions_cache.get(cache_key)
+            if cached and cached[0] > now:
+                return cached[1]
+
+        try:
+            with telemetry.span("storage.list_sessions", backend=self.storage.name, search=bool(search)):
+                result = self.storage.list_sessions(self.user_id, search=search, cursor=cursor, limit=limit)
+        except Exception as e:
+            print(f"Ошибка получения списка сессий ({self.storage.name}): {e}")
+            return [], None
+
+        with _sessions_cache_lock:
+            _sessions_cache[cache_key] = (now + SESSIONS_CACHE_TTL, result)
+        return result
+
+    def _transcribe_segment(self, segment):
+        data, mime_type = segment
+        message = HumanMessage(
+            content=[
+                {
+                    "type": "text",
+                    "text": "Транскрибируй аудио. Верни только текст."
+                },
+                {
+                    "type": "media",
+                    "mime_type": mime_type,
+                    "data": base64.b64encode(data).decode('utf-8')
+                }
+            ]
+        )
+        return self._invoke([message], task="transcribe").content.strip()
 
     def transcribe_audio(self, audio_bytes):
         try:
-            audio_b64 = base64.b64encode(audio_bytes).decode('utf-8')
-            message = HumanMessage(
-                content=[
-                    {
-                        "type": "text",
-                        "text": "Транскрибируй аудио. Верни только текст."
-                    },
-                    {
-                        "type": "media",
-                        "mime_type": "audio/wav",
-                        "data": audio_b64
-                    }
-                ]
-            )
-            response = self.chat_model.invoke([message])
-            return response.content
+            # Результат кэшируется по хэшу исходной записи: повторная отправка не идет в модель
+            model_name = llm_client.model_for_task("transcribe").model
+            cache_key = llm_cache.make_key(model_name, "transcribe", [HumanMessage(content=audio_digest(audio_bytes))])
+            cached = llm_cache.get(cache_key) if llm_cache.ENABLED else None
+            if cached is not None:
+                return cached
+
+            segments = prepare_audio(audio_bytes)
+            if len(segments) == 1:
+                text = self._transcribe_segment(segments[0])
+            else:
+                with ThreadPoolExecutor(max_workers=min(AUDIO_WORKERS, len(segments))) as executor:
+                    text = " ".join(part for part in executor.map(self._transcribe_segment, segments) if part)
+
+            if llm_cache.ENABLED and text:
+                llm_cache.put(cache_key, model_name, text)
+            return text
         except Exception as e:
             return f"Ошибка: {e}"
 
-    def get_response(self, history):
-        messages = [SystemMessage(content=self.full_system_prompt)]
-        for msg in history:
+    def _invoke(self, messages, task, use_cache=True):
+        return llm_client.invoke(task, messages, use_cache=use_cache)
+
+    def _summarize(self, prompt):
+        return self._invoke([HumanMessage(content=prompt)], task="summarize").content
+
+    def add_document(self, name, text):
+        """Индексирует загруженный документ и сохраняет его полный текст в хранилище сессии;
+        в промпт попадают только релевантные фрагменты"""
+        try:
+            with telemetry.span("storage.save_upload", backend=self.storage.name, chars=len(text)):
+                self.storage.save_upload(self.session_id, name, text, user_id=self.user_id)
+        except Exception as e:
+            print(f"Ошибка сохранения документа {name} ({self.storage.name}): {e}")
+        return self.documents.add_document(name, text)
+
+    def _load_uploads(self):
+        with telemetry.span("storage.load_uploads", backend=self.storage.name):
+            return self.storage.load_uploads(self.session_id)
+
+    def _stable_prefix(self):
+        """Промпт режима вместе с загруженными документами целиком — кандидат в кэш контекста провайдера.
+        None, если кэширование недоступно или документы не помещаются в кэш"""
+        documents = list(self.documents.documents)
+        if not documents or not context_cache.is_available():
+            return None
+
+        if self._prefix_cache[0] != len(documents):
+            parts = [self.full_system_prompt, "### ЗАГРУЖЕННЫЕ ДОКУМЕНТЫ"]
+            parts += [f"[{doc['name']}]\n{doc['text']}" for doc in documents]
+            text = "\n\n".join(parts)
+            self._prefix_cache = (len(documents), text if context_cache.fits(text) else None)
+        return self._prefix_cache[1]
+
+    def _build_messages(self, history, token_budget=None, top_k=CHAT_TOP_K, query_depth=3):
+        summary, recent_history = self.history_manager.build(history, token_budget=token_budget)
+
+        dynamic = []
+        if summary:
+            dynamic.append(f"### КРАТКОЕ СОДЕРЖАНИЕ ПРЕДЫДУЩЕГО ДИАЛОГА\n{summary}")
+
+        chunks = []
+        if len(self.documents):
+            # Запрос к индексу — последние сообщения диалога (без превью самих файлов)
+            recent = [m["content"][:2000] for m in history
+                      if m["role"] in ("user", "assistant") and classify_message(m)["kind"] != "file"]
+            chunks = self.documents.search("\n".join(recent[-query_depth:]), top_k=top_k)
+
+        conversation = []
+        for msg in recent_history:
             if msg["role"] == "user":
-                messages.append(HumanMessage(content=msg["content"]))
+                conversation.append(HumanMessage(content=msg["content"]))
             elif msg["role"] == "assistant":
-                messages.append(AIMessage(content=msg["content"]))
-
-        response_content = self.chat_model.invoke(messages).content
+                conversation.append(AIMessage(content=msg["content"]))
+
+        def assemble(system_text, context):
+            messages = [SystemMessage(content=system_text)]
+            if context:
+                messages.append(SystemMessage(content="\n\n".join(context)))
+            return messages + conversation
+
+        fragments = [f"### ФРАГМЕНТЫ ЗАГРУЖЕННЫХ ДОКУМЕНТОВ\n{format_context(chunks)}"] if chunks else []
+        messages = assemble(self.full_system_prompt, dynamic + fragments)
+
+        # Документы целиком уходят модели только ссылкой на живой кэш контекста (llm_client);
+        # без кэша context_cache отправит обычный вариант — промпт и top-k фрагментов
+        prefix = self._stable_prefix()
+        if prefix is None:
+            return messages
+        return context_cache.CacheableMessages(assemble(prefix, dynamic), fallback=messages, scope=self.session_id)
+
+    def _record_turn(self, started_at, first_token_at, response_content):
+        finished_at = time.perf_counter()
+        metrics = {
+            "ttft": (first_token_at or finished_at) - started_at,
+            "total": finished_at - started_at,
+            "chars": len(response_content)
+        }
+        self.turn_metrics.append(metrics)
+        telemetry.record("chat.turn", metrics["total"], ttft=metrics["ttft"], response_chars=metrics["chars"])
+
+    def get_response(self, history, use_cache=True):
+        messages = self._build_messages(history)
+
+        started_at = time.perf_counter()
+        response_content = self._invoke(messages, task="chat", use_cache=use_cache).content
+        self._record_turn(started_at, None, response_content)
 
         self.save_message_to_db("assistant", response_content)
 
         return response_content
 
-    def generate_requirements_doc(self, history, on_status_update=None):
+    def stream_response(self, history, use_cache=True):
+        """Отдает ответ модели по частям. В базу ответ сохраняется после завершения потока"""
+        messages = self._build_messages(history)
+
+        started_at = time.perf_counter()
+        chat_model = llm_client.model_for_task("chat")
+        cache_key = llm_cache.model_key(chat_model, messages) if llm_cache.ENABLED and use_cache else None
+        cached_content = llm_cache.get(cache_key) if cache_key else None
+
+        if cached_content is not None:
+            first_token_at = time.perf_counter()
+            response_content = cached_content
+            yield cached_content
+        else:
+            first_token_at = None
+            chunks = []
+            for chunk in llm_client.stream("chat", messages):
+                text = _chunk_text(chunk)
+                if not text:
+                    continue
+                if first_token_at is None:
+                    first_token_at = time.perf_counter()
+                chunks.append(text)
+                yield text
+
+            response_content = "".join(chunks)
+            if cache_key and response_content:
+                llm_cache.put(cache_key, chat_model.model, response_content)
+
+        self._record_turn(started_at, first_token_at, response_content)
+
+        self.save_message_to_db("assistant", response_content)
+
+    @telemetry.traced("brd.generate")
+    def generate_requirements_doc(self, history, on_status_update=None, mode=BRD_GENERATION_MODE, use_cache=True):
+        """mode="sections" — разделы пишутся параллельно и сверяются между собой, mode="single" — один
+        черновик целиком. В обоих режимах черновик проверяется локальным линтером, LLM правит только нарушения"""
         def update_status(msg):
             if on_status_update:
                 on_status_update(msg)
 
         update_status("🔍 Анализ данных...")
-        messages = [SystemMessage(content=self.full_system_prompt)]
-        for msg in history:
-            if msg["role"] == "user":
-                messages.append(HumanMessage(content=msg["content"]))
-            elif msg["role"] == "assistant":
-                messages.append(AIMessage(content=msg["content"]))
-
-        update_status("🏗️ Формирование User Stories и требований...")
-        messages_for_draft = messages.copy()
-        messages_for_draft.append(HumanMessage(content=GENERATION_PROMPT))
-        draft_response = self.chat_model.invoke(messages_for_draft)
-
-        update_status("🛡️ Валидация безопасности и стандартов...")
-        messages_for_critique = messages_for_draft.copy()
-        messages_for_critique.append(AIMessage(content=draft_response.content))
-        messages_for_critique.append(HumanMessage(content=CRITIQUE_PROMPT))
+        messages = self._build_messages(history, token_budget=BRD_TOKEN_BUDGET, top_k=BRD_TOP_K, query_depth=len(history))
 
-        final_response = self.chat_model.invoke(messages_for_critique)
-        raw_text = final_response.content
+        if mode == "sections":
+            raw_text = self._generate_by_sections(messages, update_status, use_cache)
+        else:
+            raw_text = self._generate_single(messages, update_status, use_cache)
 
         update_status("✨ Финализация...")
         cleaned_text = self._clean_output(raw_text)
@@ -302,6 +560,97 @@ class BusinessAnalystAI:
 
         return cleaned_text
 
+    def _generate_single(self, messages, update_status, use_cache=True):
+        update_status("🏗️ Формирование User Stories и требований...")
+        messages_for_draft = messages.copy()
+        messages_for_draft.append(HumanMessage(content=GENERATION_PROMPT))
+        draft_response = self._invoke(messages_for_draft, task="brd_draft", use_cache=use_cache)
+
+        return self._review_draft(messages, self._clean_output(draft_response.content), update_status, use_cache)
+
+    def _generate_section(self, messages, key, template, use_cache=True):
+        if key == "intro":
+            template = BRD_HEADER + template
+        messages_for_section = messages.copy()
+        messages_for_section.append(HumanMessage(content=SECTION_PROMPT.format(template=template)))
+        return self._clean_output(self._invoke(messages_for_section, task="brd_section", use_cache=use_cache).content)
+
+    def _generate_by_sections(self, messages, update_status, use_cache=True):
+        update_status(f"🏗️ Параллельно пишу {len(BRD_SECTIONS)} разделов...")
+        sections = {}
+        # Статус обновляется из основного потока: колбэк Streamlit нельзя вызывать из пула
+        with ThreadPoolExecutor(max_workers=BRD_SECTION_WORKERS) as executor:
+            futures = {
+                executor.submit(self._generate_section, messages, key, template, use_cache): (key, title)
+                for key, title, template in BRD_SECTIONS
+            }
+            for future in as_completed(futures):
+                key, title = futures[future]
+                sections[key] = future.result()
+                update_status(f"✅ Раздел «{title}» готов ({len(sections)}/{len(BRD_SECTIONS)})")
+
+        draft = "\n\n".join(sections[key] for key, _, _ in BRD_SECTIONS)
+        draft = self._reconcile_sections(draft, update_status, use_cache)
+
+        return self._review_draft(messages, draft, update_status, use_cache)
+
+    def _reconcile_sections(self, draft, update_status, use_cache=True):
+        """Сверка независимо написанных разделов: модель возвращает только разделы с противоречиями,
+        они подменяются в черновике по номеру"""
+        update_status("🛡️ Сверка разделов между собой...")
+        consistency_messages = [
+            SystemMessage(content=self.full_system_prompt),
+            HumanMessage(content=CONSISTENCY_PROMPT.format(document=draft))
+        ]
+        response = self._invoke(consistency_messages, task="brd_consistency", use_cache=use_cache).content
+        match = re.search(r"___START_DOCUMENT___(.*?)___END_DOCUMENT___", response, re.DOTALL)
+        _, fixed_sections = split_sections(match.group(1) if match else response)
+        replacements = {number: text for number, text in fixed_sections if 1 <= number <= len(BRD_SECTIONS)}
+        if not replacements:
+            return draft
+        update_status(f"🔁 Согласованы разделы: {', '.join(str(n) for n in sorted(replacements))}")
+        return replace_sections(draft, replacements)
+
+    def _review_draft(self, messages, draft, update_status, use_cache=True):
+        """Локальный линтер вместо полного прохода самокритики: LLM вызывается только при нарушениях
+        и получает список нарушений и проблемные разделы вместе с контекстом интервью (messages),
+        чтобы дописывать недостающее по фактам из диалога, а не по шаблону"""
+        update_status("🛡️ Валидация безопасности и стандартов...")
+        violations = lint_brd(draft)
+        if not violations:
+            return draft
+
+        offending = sorted({v["section"] for v in violations if v["section"]})
+        if not offending:
+            # Нарушен только порядок разделов — его исправляем без модели
+            return replace_sections(draft, {})
+
+        update_status(f"🛠️ Исправляю замечания: {len(violations)}...")
+        _, present = split_sections(draft)
+        section_texts = []
+        for number in offending:
+            # Повторы раздела отдаются модели все, чтобы она свела их в один
+            copies = [text for n, text in present if n == number]
+            if copies:
+                section_texts.append("\n\n".join(copies))
+            elif 1 <= number <= len(BRD_SECTIONS):
+                section_texts.append(f"(раздел {number} отсутствует, шаблон:)\n{BRD_SECTIONS[number - 1][2].strip()}")
+
+        critique_messages = messages.copy()
+        critique_messages.append(HumanMessage(content=CRITIQUE_PROMPT.format(
+            violations=format_violations(violations),
+            sections="\n\n".join(section_texts)
+        )))
+        fixed_text = self._clean_output(self._invoke(critique_messages, task="brd_critique", use_cache=use_cache).content)
+        _, fixed_sections = split_sections(fixed_text)
+        replacements = {number: text for number, text in fixed_sections if number in offending}
+
+        reviewed = replace_sections(draft, replacements)
+        remaining = lint_brd(reviewed)
+        if remaining:
+            print(f"⚠️ После исправления остались замечания:\n{format_violations(remaining)}")
+        return reviewed
+
     def _clean_output(self, text):
         pattern = r"___START_DOCUMENT___(.*?)___END_DOCUMENT___"
         match = re.search(pattern, text, re.DOTALL)
@@ -0,0 +1,226 @@
+import os
+import re
+import json
+import math
+import hashlib
+import threading
+from collections import Counter, OrderedDict
+
+# Локальные эмбеддинги опциональны: без sentence-transformers работает только BM25
+try:
+    from sentence_transformers import SentenceTransformer
+except ImportError:
+    SentenceTransformer = None
+
+CHUNK_SIZE = 1200
+CHUNK_OVERLAP = 200
+
+CHAT_TOP_K = int(os.getenv("FORTE_RETRIEVAL_TOP_K", "5"))
+BRD_TOP_K = int(os.getenv("FORTE_RETRIEVAL_BRD_TOP_K", "12"))
+
+EMBEDDING_MODEL = os.getenv("FORTE_EMBEDDING_MODEL")
+DOCUMENTS_DIR = os.path.join(os.getenv("FORTE_CACHE_DIR", ".cache"), "documents")
+# Сколько индексов сессий держать в памяти процесса; вытесненные восстанавливаются с диска или из хранилища
+MAX_INDEXES = int(os.getenv("FORTE_DOCUMENT_INDEXES", "64"))
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+_embedder = None
+_embedder_lock = threading.Lock()
+
+
+def tokenize(text):
+    # Упрощенный стемминг: обрезаем длинные слова до 6 символов, чтобы склонения совпадали
+    tokens = []
+    for token in _TOKEN_RE.findall(text.lower().replace("ё", "е")):
+        if len(token) < 2:
+            continue
+        tokens.append(token[:6] if len(token) > 6 else token)
+    return tokens
+
+
+def chunk_text(text, chunk_size=CHUNK_SIZE, overlap=CHUNK_OVERLAP):
+    """Режет текст на фрагменты по границам абзацев с перекрытием"""
+    paragraphs = [p.strip() for p in re.split(r"\n\s*\n|\n", text) if p.strip()]
+    chunks = []
+    current = ""
+    for paragraph in paragraphs:
+        while len(paragraph) > chunk_size:
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(paragraph[:chunk_size])
+            paragraph = paragraph[chunk_size - overlap:]
+        if current and len(current) + len(paragraph) + 1 > chunk_size:
+            chunks.append(current)
+            # Перекрытие — только в пределах места, которое абзац оставляет до chunk_size
+            room = min(overlap, chunk_size - len(paragraph) - 1)
+            current = current[-room:] if room > 0 else ""
+        current = f"{current}\n{paragraph}" if current else paragraph
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def _get_embedder():
+    global _embedder
+    if SentenceTransformer is None or not EMBEDDING_MODEL:
+        return None
+    with _embedder_lock:
+        if _embedder is None:
+            try:
+                _embedder = SentenceTransformer(EMBEDDING_MODEL)
+            except Exception as e:
+                print(f"Ошибка загрузки модели эмбеддингов: {e}")
+                _embedder = False
+    return _embedder or None
+
+
+class DocumentIndex:
+    """BM25-индекс по фрагментам загруженных документов (опционально + эмбеддинги)"""
+
+    def __init__(self, path=None, loader=None):
+        self.path = path
+        self.documents = []
+        self.chunks = []
+        self.doc_freq = Counter()
+        self.total_length = 0
+        self.vectors = []
+        self._lock = threading.Lock()
+
+        if path and os.path.exists(path):
+            try:
+                with open(path, encoding="utf-8") as f:
+                    for doc in json.load(f):
+                        self._add(doc["name"], doc["text"])
+            except Exception as e:
+                print(f"Ошибка загрузки индекса документов: {e}")
+
+        # Локальной копии нет (перезапуск, другой узел) — полный текст берем из хранилища сессий
+        if not self.documents and loader:
+            try:
+                for doc in loader():
+                    self._add(doc["name"], doc["text"])
+            except Exception as e:
+                print(f"Ошибка восстановления документов из хранилища: {e}")
+            if self.documents:
+                self._save()
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def add_document(self, name, text):
+        """Индексирует документ и возвращает число фрагментов"""
+        with self._lock:
+            count = self._add(name, text)
+            self._save()
+        return count
+
+    def _add(self, name, text):
+        self.documents.append({"name": name, "text": text})
+        new_chunks = chunk_text(text)
+        for position, chunk in enumerate(new_chunks):
+            term_freq = Counter(tokenize(chunk))
+            self.chunks.append({
+                "name": name,
+                "position": position,
+                "text": chunk,
+                "term_freq": term_freq,
+                "length": sum(term_freq.values())
+            })
+            self.doc_freq.update(term_freq.keys())
+            self.total_length += sum(term_freq.values())
+
+        embedder = _get_embedder()
+        if embedder:
+            self.vectors.extend(embedder.encode(new_chunks, normalize_embeddings=True).tolist())
+        return len(new_chunks)
+
+    def _save(self):
+        if not self.path:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, "w", encoding="utf-8") as f:
+                json.dump(self.documents, f, ensure_ascii=False)
+        except Exception as e:
+            print(f"Ошибка сохранения индекса документов: {e}")
+
+    def _bm25_ranking(self, query):
+        query_terms = set(tokenize(query))
+        if not query_terms:
+            return []
+        total = len(self.chunks)
+        avg_length = self.total_length / total if total else 0
+        scores = []
+        for i, chunk in enumerate(self.chunks):
+            score = 0.0
+            for term in query_terms:
+                tf = chunk["term_freq"].get(term)
+                if not tf:
+                    continue
+                df = self.doc_freq[term]
+                idf = math.log(1 + (total - df + 0.5) / (df + 0.5))
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * chunk["length"] / (avg_length or 1))
+                score += idf * tf * (BM25_K1 + 1) / (tf + norm)
+            if score > 0:
+                scores.append((score, i))
+        scores.sort(reverse=True)
+        return [i for _, i in scores]
+
+    def _embedding_ranking(self, query):
+        embedder = _get_embedder()
+        if not embedder or len(self.vectors) != len(self.chunks):
+            return []
+        query_vector = embedder.encode([query], normalize_embeddings=True)[0].tolist()
+        scores = [(sum(a * b for a, b in zip(query_vector, vector)), i) for i, vector in enumerate(self.vectors)]
+        scores.sort(reverse=True)
+        return [i for _, i in scores]
+
+    def search(self, query, top_k=CHAT_TOP_K):
+        """Возвращает top_k фрагментов; при наличии эмбеддингов ранги объединяются через RRF"""
+        with self._lock:
+            if not self.chunks:
+                return []
+            rankings = [self._bm25_ranking(query), self._embedding_ranking(query)]
+            fused = Counter()
+            for ranking in rankings:
+                for rank, i in enumerate(ranking):
+                    fused[i] += 1.0 / (60 + rank)
+            best = [i for i, _ in fused.most_common(top_k)]
+            # Фрагменты отдаем в порядке документа, так модели проще читать
+            best.sort(key=lambda i: (self.chunks[i]["name"], self.chunks[i]["position"]))
+            return [self.chunks[i] for i in best]
+
+
+_indexes = OrderedDict()
+_indexes_lock = threading.Lock()
+
+
+def get_document_index(session_id, loader=None):
+    """Индекс документов сессии, общий для процесса (LRU на MAX_INDEXES сессий).
+    Диск — локальная копия; loader() -> [{"name", "text"}] читает документы из хранилища сессий"""
+    with _indexes_lock:
+        index = _indexes.get(session_id)
+        if index is not None:
+            _indexes.move_to_end(session_id)
+            return index
+
+    # Индекс строится вне общей блокировки: загрузка из хранилища идет по сети
+    name = hashlib.sha256(session_id.encode("utf-8")).hexdigest()
+    index = DocumentIndex(path=os.path.join(DOCUMENTS_DIR, f"{name}.json"), loader=loader)
+    with _indexes_lock:
+        index = _indexes.setdefault(session_id, index)
+        _indexes.move_to_end(session_id)
+        while len(_indexes) > MAX_INDEXES:
+            _indexes.popitem(last=False)
+        return index
+
+
+def format_context(chunks):
+    parts = []
+    for chunk in chunks:
+        parts.append(f"[{chunk['name']}, фрагмент {chunk['position'] + 1}]\n{chunk['text']}")
+    return "\n\n".join(parts)
@@ -0,0 +1,412 @@
+import os
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from datetime import datetime, timezone
+
+# Клиент Supabase нужен только одноименному бэкенду
+try:
+    from supabase import create_client
+except ImportError:
+    create_client = None
+
+SQLITE_PATH = os.getenv("FORTE_SQLITE_PATH", os.path.join(os.getenv("FORTE_CACHE_DIR", ".cache"), "forte.sqlite3"))
+
+
+def _now():
+    return datetime.now(timezone.utc).isoformat()
+
+
+def _title_pattern(search):
+    return "%" + search.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+
+def _quoted(value):
+    """Значение для фильтра PostgREST or=(...): в ISO-времени есть зарезервированные символы `:`, `.`, `+`"""
+    return '"' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def _page(rows, limit):
+    """Отрезает лишнюю строку, запрошенную для проверки следующей страницы, и строит курсор"""
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, f"{rows[-1]['updated_at']}|{rows[-1]['id']}"
+
+
+class StorageBackend(ABC):
+    """Хранилище сессий: сообщения чата, каталог сессий и итоговый документ.
+    Методы бросают исключения — обработка ошибок на стороне вызывающего"""
+    name = "none"
+
+    @abstractmethod
+    def append_messages(self, session_id, title, messages, user_id=None):
+        """Создает сессию при необходимости и дописывает сообщения одним пакетом"""
+
+    @abstractmethod
+    def load_history(self, session_id):
+        ...
+
+    @abstractmethod
+    def get_session(self, session_id):
+        """Строка каталога {"id", "title", "user_id"} или None, если сессии нет"""
+
+    @abstractmethod
+    def list_sessions(self, user_id=None, search=None, cursor=None, limit=20):
+        """Страница сессий по убыванию (updated_at, id): (строки, курсор следующей страницы или None)"""
+
+    @abstractmethod
+    def save_document(self, session_id, document):
+        ...
+
+    @abstractmethod
+    def load_document(self, session_id):
+        ...
+
+    @abstractmethod
+    def save_upload(self, session_id, name, text, user_id=None):
+        """Полный текст загруженного документа; по нему индекс retrieval восстанавливается на любом узле"""
+
+    @abstractmethod
+    def load_uploads(self, session_id):
+        """Документы сессии в порядке загрузки: [{"name", "text"}]"""
+
+    @abstractmethod
+    def scan_sessions(self, updated_after=None, updated_before=None, batch_size=200):
+        """Все сессии всех пользователей по возрастанию (updated_at, id) — для пакетной обработки"""
+
+
+class NullStorage(StorageBackend):
+    """Хранилище не настроено: ничего не сохраняет"""
+    name = "none"
+
+    def append_messages(self, session_id, title, messages, user_id=None):
+        pass
+
+    def load_history(self, session_id):
+        return []
+
+    def get_session(self, session_id):
+        return None
+
+    def list_sessions(self, user_id=None, search=None, cursor=None, limit=20):
+        return [], None
+
+    def save_document(self, session_id, document):
+        pass
+
+    def load_document(self, session_id):
+        return None
+
+    def save_upload(self, session_id, name, text, user_id=None):
+        pass
+
+    def load_uploads(self, session_id):
+        return []
+
+    def scan_sessions(self, updated_after=None, updated_before=None, batch_size=200):
+        return iter(())
+
+
+class SupabaseStorage(StorageBackend):
+    """Таблицы chat_sessions/chat_messages в Supabase (см. migrations/)"""
+    name = "supabase"
+
+    def __init__(self, url, key):
+        if create_client is None:
+            raise RuntimeError("Пакет supabase не установлен")
+        self.client = create_client(url, key)
+
+    def append_messages(self, session_id, title, messages, user_id=None):
+        # Серверная функция создает сессию (если ее нет) и дописывает строки в chat_messages.
+        # Заголовок выставляется только если его еще нет, поэтому передаем кандидата всегда.
+        self.client.rpc("append_chat_messages", {
+            "p_session_id": session_id,
+            "p_title": title,
+            "p_messages": messages,
+            "p_user_id": user_id
+        }).execute()
+
+    def load_history(self, session_id):
+        response = self.client.table("chat_messages") \
+            .select("role, content") \
+            .eq("session_id", session_id) \
+            .order("id") \
+            .execute()
+        if response.data:
+            return response.data
+
+        # Сессии, которые еще не перенесены миграцией, хранят массив в chat_sessions.messages
+        response = self.client.table("chat_sessions").select("messages").eq("id", session_id).execute()
+        if response.data:
+            return response.data[0].get("messages") or []
+        return []
+
+    def get_session(self, session_id):
+        response = self.client.table("chat_sessions").select("id, title, user_id").eq("id", session_id).execute()
+        return response.data[0] if response.data else None
+
+    def list_sessions(self, user_id=None, search=None, cursor=None, limit=20):
+        query = self.client.table("chat_sessions").select("id, title, created_at, updated_at")
+        if user_id:
+            query = query.eq("user_id", user_id)
+        else:
+            query = query.is_("user_id", "null")
+        if search:
+            query = query.ilike("title", _title_pattern(search))
+        if cursor:
+            updated_at, last_id = (_quoted(value) for value in cursor.split("|", 1))
+            query = query.or_(f"updated_at.lt.{updated_at},and(updated_at.eq.{updated_at},id.lt.{last_id})")
+
+        response = query \
+            .order("updated_at", desc=True) \
+            .order("id", desc=True) \
+            .limit(limit + 1) \
+            .execute()
+        return _page(response.data, limit)
+
+    def save_document(self, session_id, document):
+        self.client.table("chat_sessions").upsert({
+            "id": session_id,
+            "final_doc": document,
+            "final_doc_updated_at": _now()
+        }).execute()
+
+    def load_document(self, session_id):
+        response = self.client.table("chat_sessions").select("final_doc").eq("id", session_id).execute()
+        if response.data:
+            return response.data[0].get("final_doc")
+        return None
+
+    def save_upload(self, session_id, name, text, user_id=None):
+        # Как и append_chat_messages, функция сама создает сессию, если документ пришел раньше сообщений
+        self.client.rpc("add_session_upload", {
+            "p_session_id": session_id,
+            "p_name": name,
+            "p_content": text,
+            "p_user_id": user_id
+        }).execute()
+
+    def load_uploads(self, session_id):
+        response = self.client.table("session_uploads") \
+            .select("name, content") \
+            .eq("session_id", session_id) \
+            .order("id") \
+            .execute()
+        return [{"name": row["name"], "text": row["content"]} for row in response.data]
+
+    def scan_sessions(self, updated_after=None, updated_before=None, batch_size=200):
+        last = None
+        while True:
+            query = self.client.table("chat_sessions").select("id, title, user_id, updated_at")
+            if updated_after:
+                query = query.gte("updated_at", updated_after)
+            if updated_before:
+                query = query.lt("updated_at", updated_before)
+            if last:
+                updated_at, last_id = _quoted(last["updated_at"]), _quoted(last["id"])
+                query = query.or_(f"updated_at.gt.{updated_at},and(updated_at.eq.{updated_at},id.gt.{last_id})")
+            rows = query.order("updated_at").order("id").limit(batch_size).execute().data
+            yield from rows
+            if len(rows) < batch_size:
+                return
+            last = rows[-1]
+
+
+class SQLiteStorage(StorageBackend):
+    """Локальный файл SQLite в режиме WAL для одноузловых установок и офлайн-прогонов.
+    Соединение у каждого потока свое; пакет сообщений пишется одной транзакцией"""
+    name = "sqlite"
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS chat_sessions (
+            id TEXT PRIMARY KEY,
+            title TEXT,
+            user_id TEXT,
+            final_doc TEXT,
+            final_doc_updated_at TEXT,
+            created_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS chat_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id TEXT NOT NULL REFERENCES chat_sessions (id) ON DELETE CASCADE,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            created_at TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS session_uploads (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id TEXT NOT NULL REFERENCES chat_sessions (id) ON DELETE CASCADE,
+            name TEXT NOT NULL,
+            content TEXT NOT NULL,
+            created_at TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS chat_messages_session_idx ON chat_messages (session_id, id);
+        CREATE INDEX IF NOT EXISTS session_uploads_session_idx ON session_uploads (session_id, id);
+        CREATE INDEX IF NOT EXISTS chat_sessions_user_updated_idx ON chat_sessions (user_id, updated_at DESC, id DESC);
+        CREATE INDEX IF NOT EXISTS chat_sessions_updated_idx ON chat_sessions (updated_at, id);
+    """
+
+    def __init__(self, path=SQLITE_PATH):
+        self.path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(self.SCHEMA)
+        conn.commit()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.row_factory = sqlite3.Row
+            # В WAL достаточно synchronous=NORMAL: фиксация без fsync на каждую транзакцию
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            self._local.conn = conn
+        return conn
+
+    def append_messages(self, session_id, title, messages, user_id=None):
+        now = _now()
+        conn = self._conn()
+        with conn:
+            conn.execute("""
+                INSERT INTO chat_sessions (id, title, user_id, created_at, updated_at) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (id) DO UPDATE SET
+                    title = COALESCE(chat_sessions.title, excluded.title),
+                    user_id = COALESCE(chat_sessions.user_id, excluded.user_id),
+                    updated_at = excluded.updated_at
+            """, (session_id, title, user_id, now, now))
+            conn.executemany(
+                "INSERT INTO chat_messages (session_id, role, content, created_at) VALUES (?, ?, ?, ?)",
+                [(session_id, msg["role"], msg["content"], now) for msg in messages]
+            )
+
+    def load_history(self, session_id):
+        rows = self._conn().execute(
+            "SELECT role, content FROM chat_messages WHERE session_id = ? ORDER BY id", (session_id,)
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+    def get_session(self, session_id):
+        row = self._conn().execute(
+            "SELECT id, title, user_id FROM chat_sessions WHERE id = ?", (session_id,)
+        ).fetchone()
+        return dict(row) if row else None
+
+    def list_sessions(self, user_id=None, search=None, cursor=None, limit=20):
+        conditions = ["user_id IS ?"]
+        params = [user_id]
+        if search:
+            conditions.append("title LIKE ? ESCAPE '\\'")
+            params.append(_title_pattern(search))
+        if cursor:
+            updated_at, last_id = cursor.split("|", 1)
+            conditions.append("(updated_at < ? OR (updated_at = ? AND id < ?))")
+            params += [updated_at, updated_at, last_id]
+
+        rows = self._conn().execute(
+            f"SELECT id, title, created_at, updated_at FROM chat_sessions WHERE {' AND '.join(conditions)} "
+            "ORDER BY updated_at DESC, id DESC LIMIT ?",
+            params + [limit + 1]
+        ).fetchall()
+        return _page([dict(row) for row in rows], limit)
+
+    def save_document(self, session_id, document):
+        now = _now()
+        conn = self._conn()
+        with conn:
+            conn.execute("""
+                INSERT INTO chat_sessions (id, final_doc, final_doc_updated_at, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (id) DO UPDATE SET
+                    final_doc = excluded.final_doc,
+                    final_doc_updated_at = excluded.final_doc_updated_at
+            """, (session_id, document, now, now, now))
+
+    def load_document(self, session_id):
+        row = self._conn().execute("SELECT final_doc FROM chat_sessions WHERE id = ?", (session_id,)).fetchone()
+        return row["final_doc"] if row else None
+
+    def save_upload(self, session_id, name, text, user_id=None):
+        now = _now()
+        conn = self._conn()
+        with conn:
+            conn.execute("""
+                INSERT INTO chat_sessions (id, user_id, created_at, updated_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT (id) DO UPDATE SET user_id = COALESCE(chat_sessions.user_id, excluded.user_id)
+            """, (session_id, user_id, now, now))
+            conn.execute(
+                "INSERT INTO session_uploads (session_id, name, content, created_at) VALUES (?, ?, ?, ?)",
+                (session_id, name, text, now)
+            )
+
+    def load_uploads(self, session_id):
+        rows = self._conn().execute(
+            "SELECT name, content FROM session_uploads WHERE session_id = ? ORDER BY id", (session_id,)
+        ).fetchall()
+        return [{"name": row["name"], "text": row["content"]} for row in rows]
+
+    def scan_sessions(self, updated_after=None, updated_before=None, batch_size=200):
+        last = None
+        while True:
+            conditions = ["1 = 1"]
+            params = []
+            if updated_after:
+                conditions.append("updated_at >= ?")
+                params.append(updated_after)
+            if updated_before:
+                conditions.append("updated_at < ?")
+                params.append(updated_before)
+            if last:
+                conditions.append("(updated_at > ? OR (updated_at = ? AND id > ?))")
+                params += [last["updated_at"], last["updated_at"], last["id"]]
+            rows = [dict(row) for row in self._conn().execute(
+                f"SELECT id, title, user_id, updated_at FROM chat_sessions WHERE {' AND '.join(conditions)} "
+                "ORDER BY updated_at, id LIMIT ?",
+                params + [batch_size]
+            ).fetchall()]
+            yield from rows
+            if len(rows) < batch_size:
+                return
+            last = rows[-1]
+
+
+def _default_storage():
+    """FORTE_STORAGE=supabase|sqlite|none; по умолчанию Supabase при наличии ключей, иначе SQLite"""
+    kind = os.getenv("FORTE_STORAGE", "auto")
+    url, key = os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_KEY")
+
+    if kind == "none":
+        return NullStorage()
+    if kind == "sqlite" or (kind == "auto" and not (url and key)):
+        print(f"ℹ️ История сохраняется локально: {SQLITE_PATH}")
+        return SQLiteStorage()
+    if not (url and key):
+        print("⚠️ Supabase ключи не найдены. История не будет сохраняться.")
+        return NullStorage()
+    try:
+        return SupabaseStorage(url, key)
+    except Exception as e:
+        print(f"⚠️ Ошибка инициализации Supabase: {e}")
+        return NullStorage()
+
+
+_storage = None
+_storage_lock = threading.Lock()
+
+
+def set_storage(storage):
+    """Подменяет хранилище (SQLite в тестах и бенчмарках, заглушка и т.п.)"""
+    global _storage
+    _storage = storage
+
+
+def get_storage():
+    global _storage
+    with _storage_lock:
+        if _storage is None:
+            _storage = _default_storage()
+        return _storage
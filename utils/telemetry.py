@@ -0,0 +1,167 @@
+import os
+import time
+import secrets
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+
+# Спаны и гистограммы общие для процесса; экспорт — в формате OTLP/JSON (OpenTelemetry)
+SERVICE_NAME = os.getenv("FORTE_SERVICE_NAME", "forte-ai-analyst")
+RECENT_SPANS = int(os.getenv("FORTE_TELEMETRY_SPANS", "2000"))
+SAMPLES_PER_SPAN = 1024
+
+_recent = deque(maxlen=RECENT_SPANS)
+_histograms = {}
+_lock = threading.Lock()
+_current = contextvars.ContextVar("forte_span", default=None)
+
+
+class Span:
+    def __init__(self, name, attributes, parent):
+        self.name = name
+        self.attributes = dict(attributes)
+        self.trace_id = parent.trace_id if parent else secrets.token_hex(16)
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent.span_id if parent else None
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.error = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    @property
+    def duration(self):
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e9
+
+
+def _record(name, duration, error):
+    with _lock:
+        histogram = _histograms.setdefault(name, {"count": 0, "errors": 0, "total": 0.0, "max": 0.0,
+                                                  "samples": deque(maxlen=SAMPLES_PER_SPAN)})
+        histogram["count"] += 1
+        histogram["total"] += duration
+        histogram["max"] = max(histogram["max"], duration)
+        histogram["samples"].append(duration)
+        if error:
+            histogram["errors"] += 1
+
+
+@contextmanager
+def span(name, **attributes):
+    """Замер операции: длительность попадает в гистограмму name, сам спан — в буфер экспорта.
+    Вложенные спаны наследуют trace_id и ссылаются на родителя"""
+    current = Span(name, attributes, _current.get())
+    token = _current.set(current)
+    try:
+        yield current
+    except GeneratorExit:
+        # Потребитель потока остановился раньше времени — это не ошибка операции
+        raise
+    except BaseException as e:
+        current.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        try:
+            _current.reset(token)
+        except ValueError:
+            # Генератор со спаном доиграл в другом контексте — родитель восстановится сам
+            pass
+        current.end_ns = time.time_ns()
+        _record(name, current.duration, current.error)
+        with _lock:
+            _recent.append(current)
+
+
+def traced(name):
+    """Декоратор-обертка над span для функций целиком"""
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record(name, duration, **attributes):
+    """Регистрирует уже измеренную длительность (например, rerun Streamlit)"""
+    current = Span(name, attributes, None)
+    current.end_ns = current.start_ns
+    current.start_ns -= int(duration * 1e9)
+    _record(name, duration, None)
+    with _lock:
+        _recent.append(current)
+
+
+def _percentile(samples, q):
+    index = min(len(samples) - 1, int(round(q * (len(samples) - 1))))
+    return samples[index]
+
+
+def get_latency_stats():
+    """Перцентили по именам спанов (по последним SAMPLES_PER_SPAN замерам), секунды"""
+    with _lock:
+        snapshot = {name: dict(h, samples=sorted(h["samples"])) for name, h in _histograms.items()}
+    result = {}
+    for name, h in sorted(snapshot.items()):
+        samples = h["samples"]
+        result[name] = {
+            "count": h["count"],
+            "errors": h["errors"],
+            "avg": h["total"] / h["count"],
+            "p50": _percentile(samples, 0.50),
+            "p95": _percentile(samples, 0.95),
+            "p99": _percentile(samples, 0.99),
+            "max": h["max"],
+        }
+    return result
+
+
+def _attribute(key, value):
+    if isinstance(value, bool):
+        typed = {"boolValue": value}
+    elif isinstance(value, int):
+        typed = {"intValue": str(value)}
+    elif isinstance(value, float):
+        typed = {"doubleValue": value}
+    else:
+        typed = {"stringValue": str(value)}
+    return {"key": key, "value": typed}
+
+
+def export_otel_json():
+    """Последние спаны в формате OTLP/JSON (ExportTraceServiceRequest)"""
+    with _lock:
+        spans = list(_recent)
+
+    otel_spans = []
+    for s in spans:
+        item = {
+            "traceId": s.trace_id,
+            "spanId": s.span_id,
+            "name": s.name,
+            "kind": 1,
+            "startTimeUnixNano": str(s.start_ns),
+            "endTimeUnixNano": str(s.end_ns),
+            "attributes": [_attribute(k, v) for k, v in s.attributes.items() if v is not None],
+            "status": {"code": 2, "message": s.error} if s.error else {"code": 1},
+        }
+        if s.parent_id:
+            item["parentSpanId"] = s.parent_id
+        otel_spans.append(item)
+
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [_attribute("service.name", SERVICE_NAME)]},
+            "scopeSpans": [{"scope": {"name": "forte.telemetry"}, "spans": otel_spans}],
+        }]
+    }
+
+
+def reset():
+    with _lock:
+        _recent.clear()
+        _histograms.clear()